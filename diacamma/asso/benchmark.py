@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+'''
+diacamma.asso benchmark package
+
+Run with: manage.py test diacamma.asso.benchmark
+Sizes and report file can be changed with the environment variables
+DIACAMMA_BENCHMARK_SIZES (default "1000,10000,50000") and
+DIACAMMA_BENCHMARK_REPORT (default "asso_benchmark.json").
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2026 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+from os import environ
+from time import perf_counter
+from datetime import date
+import json
+
+from django.db import connection, transaction
+
+from lucterios.CORE.models import Parameter
+from lucterios.CORE.parameters import Params
+
+from diacamma.member.models import Season, Adherent, SubscriptionBatch, TaxReceipt
+from diacamma.member.views import AdherentActiveList, AdherentRenewList, AdherentStatistic, AdherentContactList
+from diacamma.member.test_tools import set_parameters, default_subscription, generate_club
+from diacamma.member.tests_adherent import BaseAdherentTest
+from diacamma.event.views import DegreeStatistic
+from diacamma.event.test_tools import default_event_params, generate_degrees
+
+
+class QueryCounter(object):
+
+    def __init__(self):
+        self.nb_query = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.nb_query += 1
+        return execute(sql, params, many, context)
+
+
+class ClubBenchmark(BaseAdherentTest):
+
+    SEED = 0
+    DATEREF = date(2010, 1, 15)
+
+    def setUp(self):
+        BaseAdherentTest.setUp(self)
+        Parameter.change_value('member-family-type', 3)
+        Parameter.change_value('member-fields', 'firstname;lastname;tel1;tel2;email;license;higher_degree;lastdate_degree')
+        set_parameters(["team", "activite", "age", "licence", "genre", 'numero', 'birth'])
+        default_subscription()
+        default_event_params()
+        Params.clear()
+
+    def measure(self, function, rollback=False):
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            start = perf_counter()
+            with transaction.atomic():
+                function()
+                if rollback:
+                    transaction.set_rollback(True)
+            duration = perf_counter() - start
+        return {'time': round(duration, 3), 'queries': counter.nb_query}
+
+    def measure_view(self, xfer_class, url, params):
+        def call_view():
+            self.factory.xfer = xfer_class()
+            self.calljson(url, params, False)
+            self.assertNotEqual(self.json_meta['observer'], 'core.exception', url)
+        return self.measure(call_view)
+
+    def renew_all(self):
+        adherents = list(Adherent.objects.filter(subscription__season_id=10).distinct().order_by('id'))
+        for first_index in range(0, len(adherents), 500):
+            batch = SubscriptionBatch(date(2010, 9, 15), validate_bill=False)
+            batch.add_renewals(adherents[first_index:first_index + 500])
+            batch.run()
+
+    def run_benchmarks(self):
+        dateref = self.DATEREF.isoformat()
+        return {
+            'AdherentActiveList': self.measure_view(AdherentActiveList, '/diacamma.member/adherentActiveList', {'dateref': dateref}),
+            'AdherentRenewList': self.measure_view(AdherentRenewList, '/diacamma.member/adherentRenewList', {'dateref': '2010-10-01', 'enddate_delay': -90, 'reminder': False}),
+            'AdherentStatistic': self.measure_view(AdherentStatistic, '/diacamma.member/adherentStatistic', {'season': 10}),
+            'DegreeStatistic': self.measure_view(DegreeStatistic, '/diacamma.event/degreeStatistic', {'season': 10}),
+            'AdherentContactList': self.measure_view(AdherentContactList, '/diacamma.member/adherentContactList', {'dateref': dateref}),
+            'TaxReceipt.create_all': self.measure(lambda: TaxReceipt.create_all(2009), rollback=True),
+            'renewals': self.measure(self.renew_all, rollback=True),
+        }
+
+    def test_benchmark(self):
+        sizes = sorted([int(size) for size in environ.get('DIACAMMA_BENCHMARK_SIZES', '1000,10000,50000').split(',')])
+        report = {'seed': self.SEED, 'sizes': {}}
+        adherents = []
+        for size in sizes:
+            generate_start = perf_counter()
+            new_adherents = generate_club(size - len(adherents), self.SEED, first_index=len(adherents))
+            generate_degrees(new_adherents, Season.objects.get(id=10), self.SEED)
+            adherents.extend(new_adherents)
+            result = self.run_benchmarks()
+            result['generation'] = {'time': round(perf_counter() - generate_start, 3)}
+            report['sizes'][str(size)] = result
+        with open(environ.get('DIACAMMA_BENCHMARK_REPORT', 'asso_benchmark.json'), 'w') as report_file:
+            json.dump(report, report_file, indent=1, sort_keys=True)
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('event', '0006_article_nomember'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HigherDegree',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='date')),
+                ('level', models.IntegerField(default=0, verbose_name='level')),
+                ('activity', models.ForeignKey(default=None, on_delete=django.db.models.deletion.CASCADE, to='member.activity', verbose_name='activity')),
+                ('adherent', models.ForeignKey(default=None, on_delete=django.db.models.deletion.CASCADE, to='member.adherent', verbose_name='adherent')),
+                ('degree', models.ForeignKey(default=None, on_delete=django.db.models.deletion.CASCADE, to='event.degreetype', verbose_name='degree')),
+                ('subdegree', models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='event.subdegreetype', verbose_name='sub degree')),
+            ],
+            options={
+                'verbose_name': 'higher degree',
+                'verbose_name_plural': 'higher degrees',
+                'default_permissions': [],
+            },
+        ),
+    ]
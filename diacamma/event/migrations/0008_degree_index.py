@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('event', '0007_higherdegree'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='degree',
+            name='adherent',
+            field=models.ForeignKey(db_index=False, default=None, on_delete=django.db.models.deletion.CASCADE, to='member.adherent', verbose_name='adherent'),
+        ),
+        migrations.AddIndex(
+            model_name='degree',
+            index=models.Index(fields=['adherent', 'date'], name='event_degre_adheren_7b369f_idx'),
+        ),
+    ]
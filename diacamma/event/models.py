@@ -25,7 +25,7 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
 from datetime import date
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q
 from django.db.models.aggregates import Count
 from django.core.validators import MaxValueValidator, MinValueValidator
@@ -42,10 +42,11 @@ from lucterios.CORE.models import Parameter
 from lucterios.CORE.parameters import Params
 from lucterios.contacts.models import Individual
 
-from diacamma.invoice.models import Article, Bill, Detail, get_or_create_customer
+from diacamma.invoice.models import Article, Bill, Detail
 from diacamma.accounting.models import CostAccounting
-from diacamma.member.models import Activity, Adherent, Subscription, Season
+from diacamma.member.models import Activity, Adherent, Subscription, Season, FamilyDirectory, get_or_create_customers
 from diacamma.accounting.tools import get_amount_from_format_devise
+from diacamma.member.tools import bulk_create_with_signals
 
 
 class DegreeType(LucteriosModel):
@@ -88,6 +89,12 @@ class DegreeType(LucteriosModel):
     def activity_query(self):
         return Activity.get_all()
 
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        is_new = self.id is None
+        LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        if not is_new:
+            HigherDegree.refresh(Degree.objects.filter(degree=self).values('adherent_id'))
+
     class Meta(object):
         verbose_name = _('degree type')
         verbose_name_plural = _('degree types')
@@ -114,6 +121,12 @@ class SubDegreeType(LucteriosModel):
     def get_show_fields(cls):
         return ['name', 'level']
 
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        is_new = self.id is None
+        LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        if not is_new:
+            HigherDegree.refresh(Degree.objects.filter(subdegree=self).values('adherent_id'))
+
     class Meta(object):
         verbose_name = _('sub degree type')
         verbose_name_plural = _('sub degree types')
@@ -142,6 +155,8 @@ class Event(LucteriosModel):
 
     date_txt = LucteriosVirtualField(verbose_name=_('date'), compute_from='get_date_txt')
 
+    subscripter_ids = None
+
     def __str__(self):
         if Params.getvalue("member-activite-enable"):
             return "%s %s" % (self.activity, self.date)
@@ -196,6 +211,12 @@ class Event(LucteriosModel):
             return _('%s validated!') % self.event_type_txt
         return ''
 
+    def get_subscripter_ids(self):
+        if self.subscripter_ids is None:
+            season = Season.get_from_date(self.date)
+            self.subscripter_ids = set(Subscription.objects.filter(season=season).values_list('adherent_id', flat=True))
+        return self.subscripter_ids
+
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         if self.event_type == self.EVENTTYPE_EXAMINATION:
             self.date_end = None
@@ -222,11 +243,57 @@ class Event(LucteriosModel):
 
     @transition(field=status, source=STATUS_BUILDING, target=STATUS_VALID, conditions=[lambda item:item.chech_validity() == ''])
     def validate(self):
-        for participant in self.participant_set.all():
-            participant.give_result(self.xfer.getparam('degree_%d' % participant.id, 0),
-                                    self.xfer.getparam('subdegree_%d' % participant.id, 0),
-                                    self.xfer.getparam('comment_%d' % participant.id))
-            participant.create_bill()
+        participants = list(self.participant_set.all().select_related('contact'))
+        results = {}
+        for participant in participants:
+            results[participant.id] = (self.xfer.getparam('degree_%d' % participant.id, 0),
+                                       self.xfer.getparam('subdegree_%d' % participant.id, 0),
+                                       self.xfer.getparam('comment_%d' % participant.id))
+        with transaction.atomic():
+            Participant.give_results(self, participants, results)
+            self.create_bills(participants)
+
+    def _get_bill_comment(self, third, participants):
+        bill_comment = ["{[b]}%s{[/b]}: %s" % (self.event_type_txt, self.date_txt)]
+        bill_comment.append("{[i]}%s{[/i]}" % self.comment)
+        last_participant = participants[-1]
+        if (third.contact_id == last_participant.contact_id) and (self.event_type == Event.EVENTTYPE_TRAINING) and (last_participant.comment is not None) and (last_participant.comment != ''):
+            bill_comment.append(last_participant.comment)
+        return "{[br/]}".join(bill_comment)
+
+    def create_bills(self, participants):
+        participants = [participant for participant in participants if participant.article_id is not None]
+        ref_contact_ids = FamilyDirectory.get_ref_contact_ids([participant.contact_id for participant in participants])
+        participants_by_third = {}
+        for participant in participants:
+            participants_by_third.setdefault(ref_contact_ids[participant.contact_id], []).append(participant)
+        if len(participants_by_third) == 0:
+            return
+        thirds = get_or_create_customers(list(participants_by_third.keys()))
+        bills = {}
+        bill_list = Bill.objects.filter(third__in=thirds.values(), bill_type=Bill.BILLTYPE_BILL, status=Bill.STATUS_BUILDING).annotate(participant_count=Count('participant')).filter(participant_count__gte=1)
+        for bill in bill_list.select_related('third').order_by('-date'):
+            if bill.third_id not in bills:
+                bills[bill.third_id] = bill
+        for ref_contact_id, third in thirds.items():
+            if third.id not in bills:
+                bills[third.id] = Bill.objects.create(bill_type=Bill.BILLTYPE_BILL, date=date.today(), third=third)
+            bill = bills[third.id]
+            bill.comment = self._get_bill_comment(third, participants_by_third[ref_contact_id])
+            bill.save()
+            for participant in participants_by_third[ref_contact_id]:
+                participant.bill = bill
+        Participant.objects.bulk_update([participant for third_participants in participants_by_third.values() for participant in third_participants], ['bill'])
+        bills = dict([(bill.id, bill) for bill in bills.values()])
+        Detail.objects.filter(bill_id__in=bills.keys()).delete()
+        for participant in Participant.objects.filter(bill_id__in=bills.keys()).select_related('event', 'contact', 'article').order_by('id'):
+            bill = bills[participant.bill_id]
+            detail_comment = [participant.article.designation]
+            if bill.third.contact_id != participant.contact_id:
+                detail_comment.append(_("Participant: %s") % str(participant.contact))
+                if (participant.event.event_type == Event.EVENTTYPE_TRAINING) and (participant.comment is not None) and (participant.comment != ''):
+                    detail_comment.append(participant.comment)
+            Detail.create_for_bill(bill, participant.article, reduce=participant.reduce, designation="{[br/]}".join(detail_comment))
 
     class Meta(object):
         verbose_name = _('event')
@@ -277,7 +344,7 @@ class Organizer(LucteriosModel):
 
 
 class Degree(LucteriosModel):
-    adherent = models.ForeignKey(Adherent, verbose_name=_('adherent'), null=False, default=None, db_index=True, on_delete=models.CASCADE)
+    adherent = models.ForeignKey(Adherent, verbose_name=_('adherent'), null=False, default=None, db_index=False, on_delete=models.CASCADE)
     degree = models.ForeignKey(DegreeType, verbose_name=_('degree'), null=False, default=None, db_index=True, on_delete=models.PROTECT)
     subdegree = models.ForeignKey(SubDegreeType, verbose_name=_('sub degree'), null=True, default=None, db_index=True, on_delete=models.PROTECT)
     date = models.DateField(verbose_name=_('date'), null=False)
@@ -356,18 +423,19 @@ class Degree(LucteriosModel):
 
     @classmethod
     def get_higher_statistic(cls, season):
+        adherent_ids = list(Subscription.objects.filter(season=season).values_list('adherent_id', flat=True))
+        higher_degrees = HigherDegree.get_higher_degrees(Subscription.objects.filter(season=season).values('adherent_id'), season.end_date)
         static_res = []
         for activity in Activity.get_all():
             result_activity = {}
-            for adh in Adherent.objects.filter(subscription__season=season):
-                heigher_degrees = adh.get_higher_degree_ex(season.end_date)
-                for heigher_degree in heigher_degrees:
-                    if (heigher_degree is None) or (heigher_degree.degree.activity != activity):
-                        continue
-                    ident_degree = (heigher_degree.degree_id, heigher_degree.subdegree_id)
-                    if ident_degree not in result_activity:
-                        result_activity[ident_degree] = [heigher_degree.get_full_level(), heigher_degree.degree, heigher_degree.subdegree, 0]
-                    result_activity[ident_degree][3] += 1
+            for adherent_id in adherent_ids:
+                heigher_degree = higher_degrees.get((adherent_id, activity.id))
+                if heigher_degree is None:
+                    continue
+                ident_degree = (heigher_degree.degree_id, heigher_degree.subdegree_id)
+                if ident_degree not in result_activity:
+                    result_activity[ident_degree] = [heigher_degree.get_full_level(), heigher_degree.degree, heigher_degree.subdegree, 0]
+                result_activity[ident_degree][3] += 1
             new_result_activity = [(str(item[1]), str(item[2]), item[3]) for item in sorted(result_activity.values(), key=lambda item: item[0], reverse=True)]
             if Params.getvalue("member-activite-enable"):
                 static_res.append((activity, new_result_activity))
@@ -400,10 +468,75 @@ class Degree(LucteriosModel):
             return _('examination validated!')
         return ''
 
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        adherent_ids = [self.adherent_id]
+        if self.id is not None:
+            adherent_ids.extend(Degree.objects.filter(id=self.id).values_list('adherent_id', flat=True))
+        LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        HigherDegree.refresh(adherent_ids)
+
+    def delete(self, using=None):
+        adherent_id = self.adherent_id
+        LucteriosModel.delete(self, using=using)
+        HigherDegree.refresh([adherent_id])
+
     class Meta(object):
         verbose_name = _('degree')
         verbose_name_plural = _('degrees')
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['adherent', 'date']),
+        ]
+
+
+class HigherDegree(LucteriosModel):
+    adherent = models.ForeignKey(Adherent, verbose_name=_('adherent'), null=False, default=None, db_index=True, on_delete=models.CASCADE)
+    activity = models.ForeignKey(Activity, verbose_name=_('activity'), null=False, default=None, db_index=True, on_delete=models.CASCADE)
+    degree = models.ForeignKey(DegreeType, verbose_name=_('degree'), null=False, default=None, on_delete=models.CASCADE)
+    subdegree = models.ForeignKey(SubDegreeType, verbose_name=_('sub degree'), null=True, default=None, on_delete=models.CASCADE)
+    date = models.DateField(verbose_name=_('date'), null=False)
+    level = models.IntegerField(verbose_name=_('level'), null=False, default=0)
+
+    def __str__(self):
+        if (self.subdegree is None) or (Params.getvalue("event-subdegree-enable") == 0):
+            return str(self.degree)
+        else:
+            return "%s - %s" % (self.degree, self.subdegree)
+
+    def get_full_level(self):
+        if (self.subdegree is None) or (Params.getvalue("event-subdegree-enable") == 0):
+            return self.degree.level * 100000
+        else:
+            return self.degree.level * 100000 + self.subdegree.level
+
+    @classmethod
+    def refresh(cls, adherent_ids):
+        cls.objects.filter(adherent_id__in=adherent_ids).delete()
+        current_levels = {}
+        higher_degrees = []
+        for degree in Degree.objects.filter(adherent_id__in=adherent_ids).select_related('degree', 'subdegree').order_by('date', 'id'):
+            level = degree.degree.level * 100000 + (degree.subdegree.level if degree.subdegree is not None else 0)
+            ident = (degree.adherent_id, degree.degree.activity_id)
+            if (ident not in current_levels) or (level > current_levels[ident]):
+                current_levels[ident] = level
+                higher_degrees.append(cls(adherent_id=degree.adherent_id, activity_id=degree.degree.activity_id, degree_id=degree.degree_id,
+                                          subdegree_id=degree.subdegree_id, date=degree.date, level=level))
+        cls.objects.bulk_create(higher_degrees)
+
+    @classmethod
+    def get_higher_degrees(cls, adherent_ids, date_before=None):
+        query = Q(adherent_id__in=adherent_ids)
+        if date_before is not None:
+            query &= Q(date__lte=date_before)
+        higher_degrees = {}
+        for higher_degree in cls.objects.filter(query).select_related('degree', 'degree__activity', 'subdegree').order_by('date', 'level'):
+            higher_degrees[(higher_degree.adherent_id, higher_degree.activity_id)] = higher_degree
+        return higher_degrees
+
+    class Meta(object):
+        verbose_name = _('higher degree')
+        verbose_name_plural = _('higher degrees')
+        default_permissions = []
 
 
 class Participant(LucteriosModel):
@@ -421,6 +554,8 @@ class Participant(LucteriosModel):
     current_degree = LucteriosVirtualField(verbose_name=_('current'), compute_from='get_current_degree')
     article_ref_price = LucteriosVirtualField(verbose_name=_('article'), compute_from='get_article_ref_price')
 
+    degree_context = None
+
     def __str__(self):
         return str(self.contact)
 
@@ -452,7 +587,21 @@ class Participant(LucteriosModel):
         else:
             return self.article.ref_price
 
+    @classmethod
+    def prefetch_degree_context(cls, event, participants):
+        current_degrees = {}
+        contact_ids = [participant.contact_id for participant in participants]
+        for degree in Degree.objects.filter(adherent_id__in=contact_ids, degree__activity_id=event.activity_id).select_related('degree', 'subdegree').order_by('-degree__level', '-subdegree__level'):
+            if degree.adherent_id not in current_degrees:
+                current_degrees[degree.adherent_id] = degree
+        degree_types = list(DegreeType.objects.filter(activity_id=event.activity_id).order_by('level'))
+        subdegree_types = list(SubDegreeType.objects.all().order_by('level'))
+        for participant in participants:
+            participant.degree_context = (current_degrees.get(participant.contact_id), degree_types, subdegree_types)
+
     def get_current_degree_ex(self):
+        if self.degree_context is not None:
+            return self.degree_context[0]
         degree_list = Degree.objects.filter(Q(adherent_id=self.contact_id) & Q(degree__activity=self.event.activity)).distinct().order_by('-degree__level', '-subdegree__level')
         if len(degree_list) > 0:
             return degree_list[0]
@@ -474,19 +623,23 @@ class Participant(LucteriosModel):
             return None
 
     def get_is_subscripter(self):
-        return len(Subscription.objects.filter(adherent_id=self.contact_id, season=Season.get_from_date(self.event.date))) > 0
+        return self.contact_id in self.event.get_subscripter_ids()
 
     def allow_degree(self):
         degree = self.get_current_degree_ex()
+        if self.degree_context is not None:
+            return [degree_type for degree_type in self.degree_context[1] if (degree is None) or (degree_type.level >= degree.degree.level)]
         if degree is not None:
             return DegreeType.objects.filter(level__gte=degree.degree.level, activity=self.event.activity).distinct().order_by('level')
         else:
             return DegreeType.objects.filter(activity=self.event.activity).distinct().order_by('level')
 
     def allow_subdegree(self):
+        if self.degree_context is not None:
+            return self.degree_context[2]
         return SubDegreeType.objects.all().order_by('level')
 
-    def give_result(self, degree, subdegree, comment):
+    def set_result(self, degree, subdegree, comment):
         self.degree_result_id = degree
         if self.degree_result_id == 0:
             self.degree_result_id = None
@@ -494,50 +647,38 @@ class Participant(LucteriosModel):
         if self.subdegree_result_id == 0:
             self.subdegree_result_id = None
         if (self.degree_result_id is None) and not (self.subdegree_result_id is None):
-            old_degree = self.get_current_degree()
-            self.degree_result = old_degree.degree
+            old_degree = self.get_current_degree_ex()
+            if old_degree is not None:
+                self.degree_result_id = old_degree.degree_id
         if comment is not None:
             self.comment = comment
-        self.save()
-        if not (self.degree_result is None):
-            try:
-                adh = Adherent.objects.get(id=self.contact_id)
-                Degree.objects.create(adherent=adh, degree=self.degree_result,
-                                      subdegree=self.subdegree_result, date=self.event.date, event=self.event)
-            except Exception:
-                pass
-
-    def _search_or_create_bill(self):
-        high_contact = self.contact.get_final_child()
-        new_third = get_or_create_customer(high_contact.get_ref_contact().id)
-        bill_list = Bill.objects.filter(third=new_third, bill_type=Bill.BILLTYPE_BILL, status=Bill.STATUS_BUILDING).annotate(participant_count=Count('participant')).filter(participant_count__gte=1).order_by('-date')
-        if len(bill_list) > 0:
-            self.bill = bill_list[0]
-        if self.bill is None:
-            self.bill = Bill.objects.create(bill_type=1, date=date.today(), third=new_third)
-        return high_contact
+
+    def give_result(self, degree, subdegree, comment):
+        Participant.give_results(self.event, [self], {self.id: (degree, subdegree, comment)})
+
+    @classmethod
+    def give_results(cls, event, participants, results):
+        Participant.prefetch_degree_context(event, participants)
+        adherent_ids = set(Adherent.objects.filter(id__in=[participant.contact_id for participant in participants]).values_list('id', flat=True))
+        new_degrees = []
+        for participant in participants:
+            participant.set_result(*results[participant.id])
+            if (participant.degree_result_id is not None) and (participant.contact_id in adherent_ids):
+                new_degrees.append(Degree(adherent_id=participant.contact_id, degree_id=participant.degree_result_id,
+                                          subdegree_id=participant.subdegree_result_id, date=event.date, event=event))
+        with transaction.atomic():
+            if auditlog.contains(cls) and auditlog.get_state(cls._meta.app_label):
+                # the audit log compares each participant with its saved version
+                for participant in participants:
+                    participant.save()
+            else:
+                cls.objects.bulk_update(participants, ['degree_result', 'subdegree_result', 'comment'])
+            if len(new_degrees) > 0:
+                bulk_create_with_signals(Degree, new_degrees)
+                HigherDegree.refresh(set([new_degree.adherent_id for new_degree in new_degrees]))
 
     def create_bill(self):
-        if self.article is not None:
-            high_contact = self._search_or_create_bill()
-            bill_comment = ["{[b]}%s{[/b]}: %s" % (self.event.event_type_txt, self.event.date_txt)]
-            bill_comment.append("{[i]}%s{[/i]}" % self.event.comment)
-            if (self.bill.third.contact.id == high_contact.id) and (self.event.event_type == Event.EVENTTYPE_TRAINING) and (self.comment is not None) and (self.comment != ''):
-                bill_comment.append(self.comment)
-            self.bill.comment = "{[br/]}".join(bill_comment)
-            self.bill.save()
-            self.bill.detail_set.all().delete()
-            participant_list = list(self.bill.participant_set.all())
-            if self not in participant_list:
-                participant_list.append(self)
-            for participant in participant_list:
-                detail_comment = [participant.article.designation]
-                if participant.bill.third.contact.id != participant.contact.id:
-                    detail_comment.append(_("Participant: %s") % str(participant.contact))
-                    if (participant.event.event_type == 1) and (participant.comment is not None) and (participant.comment != ''):
-                        detail_comment.append(participant.comment)
-                Detail.create_for_bill(participant.bill, participant.article, reduce=participant.reduce, designation="{[br/]}".join(detail_comment))
-            self.save()
+        self.event.create_bills([self])
 
     def can_delete(self):
         if self.event.status != Event.STATUS_BUILDING:
@@ -551,14 +692,33 @@ class Participant(LucteriosModel):
             self.bill.delete()
         LucteriosModel.delete(self, using=using)
 
+    def set_default_values(self):
+        if (self.event.event_type == Event.EVENTTYPE_EXAMINATION) and ((self.comment is None) or (self.comment == '')):
+            self.comment = Params.getvalue("event-comment-text")
+        if self.get_is_subscripter():
+            if self.event.default_article_id is not None:
+                self.article_id = self.event.default_article_id
+        elif self.event.default_article_nomember_id is not None:
+            self.article_id = self.event.default_article_nomember_id
+
+    @classmethod
+    def add_contacts(cls, event, contact_ids):
+        existing_ids = set(event.participant_set.values_list('contact_id', flat=True))
+        new_participants = []
+        for contact_id in contact_ids:
+            if contact_id not in existing_ids:
+                existing_ids.add(contact_id)
+                new_participant = cls(event=event, contact_id=contact_id)
+                new_participant.set_default_values()
+                new_participants.append(new_participant)
+        if len(new_participants) > 0:
+            bulk_create_with_signals(cls, new_participants)
+        return new_participants
+
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
-        if (self.id is None) and (self.event.event_type == Event.EVENTTYPE_EXAMINATION) and ((self.comment is None) or (self.comment == '')):
-            self.comment = Params.getvalue("event-comment-text")
-        if (self.id is None) and self.is_subscripter and (self.event.default_article is not None):
-            self.article = self.event.default_article
-        if (self.id is None) and not self.is_subscripter and (self.event.default_article_nomember is not None):
-            self.article = self.event.default_article_nomember
+        if self.id is None:
+            self.set_default_values()
         return LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
 
     class Meta(object):
@@ -567,6 +727,12 @@ class Participant(LucteriosModel):
         default_permissions = []
 
 
+@Signal.decorate('convertdata')
+def event_convertdata():
+    if (HigherDegree.objects.all().count() == 0) and (Degree.objects.all().count() > 0):
+        HigherDegree.refresh(Degree.objects.all().values('adherent_id'))
+
+
 @Signal.decorate('checkparam')
 def event_checkparam():
     Parameter.check_and_create(name="event-degree-enable", typeparam=3, title=_("event-degree-enable"),
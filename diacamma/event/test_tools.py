@@ -23,13 +23,15 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import unicode_literals
+from random import Random
+from datetime import timedelta
 
 from lucterios.CORE.models import Parameter
 from lucterios.CORE.parameters import Params
 
 from diacamma.member.models import Activity, Adherent
 
-from diacamma.event.models import DegreeType, SubDegreeType, Degree
+from diacamma.event.models import DegreeType, SubDegreeType, Degree, Event, Participant, HigherDegree
 
 
 def default_event_params():
@@ -65,3 +67,30 @@ def add_default_degree():
     Degree.objects.create(adherent=Adherent.objects.get(id=6),
                           degree=DegreeType.objects.get(id=3),
                           subdegree=SubDegreeType.objects.get(id=5), date='2011-07-14')
+
+
+def generate_degrees(adherents, season, seed=0, nb_by_event=20):
+    random_gen = Random("%s-%d" % (seed, len(adherents)))
+    degreetypes = {}
+    for degreetype in DegreeType.objects.all().order_by('level'):
+        degreetypes.setdefault(degreetype.activity_id, []).append(degreetype)
+    subdegreetypes = list(SubDegreeType.objects.all().order_by('level'))
+    activity_ids = sorted(degreetypes.keys())
+    if len(activity_ids) == 0:
+        return
+    participants = []
+    degrees = []
+    for first_index in range(0, len(adherents), nb_by_event):
+        event_date = season.begin_date + timedelta(days=random_gen.randint(15, 300))
+        activity_id = random_gen.choice(activity_ids)
+        event = Event.objects.create(activity_id=activity_id, date=event_date, comment='exam %d' % first_index,
+                                     status=Event.STATUS_VALID, event_type=Event.EVENTTYPE_EXAMINATION)
+        for adherent in adherents[first_index:first_index + nb_by_event]:
+            degreetype = random_gen.choice(degreetypes[activity_id])
+            subdegreetype = random_gen.choice(subdegreetypes) if (len(subdegreetypes) > 0) and (random_gen.random() < 0.5) else None
+            participants.append(Participant(event=event, contact=adherent, degree_result=degreetype, subdegree_result=subdegreetype))
+            degrees.append(Degree(adherent=adherent, degree=degreetype, subdegree=subdegreetype, date=event_date, event=event))
+    Participant.objects.bulk_create(participants)
+    Degree.objects.bulk_create(degrees)
+    for first_index in range(0, len(adherents), 500):
+        HigherDegree.refresh([adherent.id for adherent in adherents[first_index:first_index + 500]])
@@ -34,11 +34,13 @@ from lucterios.CORE.parameters import Params
 from diacamma.member.test_tools import default_adherents, default_season, \
     default_params, set_parameters
 from diacamma.member.views import AdherentShow
+from diacamma.member.models import Adherent
 
 from diacamma.event.views_conf import EventConf, DegreeTypeAddModify, \
     DegreeTypeDel, SubDegreeTypeAddModify, SubDegreeTypeDel
 from diacamma.event.views_degree import DegreeAddModify, DegreeDel
 from diacamma.event.test_tools import default_event_params
+from diacamma.event.models import DegreeType, SubDegreeType, Degree, HigherDegree
 
 
 class ConfigurationTest(LucteriosTest):
@@ -259,3 +261,26 @@ class DegreeTest(LucteriosTest):
         self.assert_grid_equal('degrees', {'degree': 'Grade', 'date': 'date'}, 1)  # nb=2
         self.assert_json_equal('', 'degrees/@0/degree', "[activity1] level #1.3")
         self.assert_json_equal('', 'degrees/@0/date', "2014-10-12")
+
+    def test_higher_degree(self):
+        adherent = Adherent.objects.get(id=2)
+        Degree.objects.create(adherent=adherent, degree=DegreeType.objects.get(id=3), subdegree=SubDegreeType.objects.get(id=2), date='2014-10-12')
+        Degree.objects.create(adherent=adherent, degree=DegreeType.objects.get(id=2), subdegree=None, date='2015-03-20')
+        Degree.objects.create(adherent=adherent, degree=DegreeType.objects.get(id=5), subdegree=None, date='2016-06-01')
+        self.assertEqual(HigherDegree.objects.filter(adherent=adherent).count(), 2)
+        self.assertEqual(str(HigherDegree.get_higher_degrees([2], '2015-12-31')[(2, 1)]), "[activity1] level #1.3 - sublevel #2")
+        self.assertEqual(str(HigherDegree.get_higher_degrees([2])[(2, 1)]), "[activity1] level #1.5")
+        self.assertEqual(HigherDegree.get_higher_degrees([2], '2014-01-01'), {})
+        self.assertEqual(adherent.get_higher_degree_ex(), [Degree.objects.get(degree_id=5), None])
+        self.assertEqual(adherent.get_higher_degree_ex('2015-12-31'), [Degree.objects.get(degree_id=3), None])
+        self.assertEqual(adherent.get_higher_degree(), ["[activity1] level #1.5"])
+
+        Degree.objects.filter(degree_id=5).first().delete()
+        self.assertEqual(HigherDegree.objects.filter(adherent=adherent).count(), 1)
+        self.assertEqual(str(HigherDegree.get_higher_degrees([2])[(2, 1)]), "[activity1] level #1.3 - sublevel #2")
+
+        degree_type = DegreeType.objects.get(id=2)
+        degree_type.level = 8
+        degree_type.save()
+        self.assertEqual(HigherDegree.objects.filter(adherent=adherent).count(), 2)
+        self.assertEqual(str(HigherDegree.get_higher_degrees([2])[(2, 1)]), "[activity1] level #1.2")
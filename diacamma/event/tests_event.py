@@ -27,14 +27,20 @@ from shutil import rmtree
 
 from lucterios.framework.test import LucteriosTest
 from lucterios.framework.filetools import get_user_dir
+from lucterios.framework.models import LucteriosLogEntry
+from lucterios.framework.auditlog import LucteriosAuditlogModelRegistry
 from lucterios.CORE.models import Parameter
 from lucterios.CORE.parameters import Params
 from lucterios.contacts.models import LegalEntity
 
-from diacamma.member.test_tools import default_season, default_params, default_adherents, set_parameters, default_financial, default_subscription
+from diacamma.member.test_tools import default_season, default_params, default_adherents, set_parameters, default_financial, default_subscription, generate_club
+from diacamma.member.instrumentation import QueryRecorder
 from diacamma.member.views import AdherentShow, SubscriptionAddModify, AdherentFamilySelect
+from diacamma.accounting.tools import correct_accounting_code
+from diacamma.invoice.models import Bill
 from diacamma.invoice.views import BillList, BillShow
 
+from diacamma.event.models import Event, Participant, Degree, HigherDegree
 from diacamma.event.test_tools import default_event_params, add_default_degree
 from diacamma.event.views import EventListExamination, EventListOuting, EventAddModify, EventDel, EventShow, OrganizerAddModify, OrganizerSave, OrganizerResponsible, OrganizerDel, \
     ParticipantAdd, ParticipantSave, ParticipantDel, ParticipantOpen, EventTransition, ParticipantModify
@@ -748,3 +754,146 @@ class EventTest(LucteriosTest):
         self.assert_json_equal('', 'detail/@1/price', 64.10)
         self.assert_json_equal('', 'detail/@1/quantity', '1.00')
         self.assert_json_equal('', 'detail/@1/total', 54.10)
+
+    def test_bill_grouped(self):
+        Parameter.change_value('member-family-type', 3)
+        Params.clear()
+        myfamily = LegalEntity.objects.create(name="LES DALTONS", structure_type_id=3, address="Place des cocotiers", postal_code="97200",
+                                              city="FORT DE FRANCE", country="MARTINIQUE", email="dalton@worldcompany.com")
+        for adherent_id in (4, 5):
+            self.factory.xfer = AdherentFamilySelect()
+            self.calljson('/diacamma.member/adherentFamilySelect', {'adherent': adherent_id, 'legal_entity': myfamily.id}, False)
+            self.assert_observer('core.acknowledge', 'diacamma.member', 'adherentFamilySelect')
+
+        self.factory.xfer = EventAddModify()
+        self.calljson('/diacamma.event/eventAddModify', {"SAVE": "YES", "comment": "la fiesta", "date": "2014-10-12", "date_end": "2014-10-13",
+                                                         "activity": "1", "event_type": 1, 'default_article': 1, 'default_article_nomember': 2}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.event', 'eventAddModify')
+        self.factory.xfer = OrganizerSave()
+        self.calljson('/diacamma.event/organizerSave', {"event": 1, 'pkname': 'contact', 'contact': '6'}, False)
+        self.factory.xfer = OrganizerResponsible()
+        self.calljson('/diacamma.event/organizerResponsible', {"event": 1, 'organizer': '1'}, False)
+        self.factory.xfer = ParticipantSave()
+        self.calljson('/diacamma.event/participantSave', {"event": 1, 'pkname': 'contact', 'contact': '2;4;5'}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.event', 'participantSave')
+        self.factory.xfer = ParticipantModify()
+        self.calljson('/diacamma.event/participantModify', {"event": 1, "participant": 3, "SAVE": "YES", 'comment': 'bou!!!!', 'article': 5, 'reduce': 10.0}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.event', 'participantModify')
+
+        self.factory.xfer = EventTransition()
+        with QueryRecorder() as recorder:
+            self.calljson('/diacamma.event/eventTransition', {"event": 1, 'CONFIRME': 'YES', 'TRANSITION': 'validate'}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.event', 'eventTransition')
+        self.assertEqual(len([sql for sql, _duration in recorder.statements if 'FROM "contacts_responsability"' in sql]), 1, recorder.get_repeated())
+        self.assertEqual(len([sql for sql, _duration in recorder.statements if sql.startswith('INSERT INTO "accounting_third"')]), 2)
+        self.assertEqual(len([sql for sql, _duration in recorder.statements if sql.startswith('INSERT INTO "accounting_accountthird"')]), 2)
+
+        self.assertEqual(Bill.objects.all().count(), 2)
+        family_bill = Bill.objects.get(third__contact_id=myfamily.id)
+        self.assertEqual(list(family_bill.third.accountthird_set.values_list('code', flat=True)), [correct_accounting_code(Params.getvalue("invoice-account-third"))])
+        self.assertEqual(list(Participant.objects.filter(bill=family_bill).order_by('id').values_list('contact_id', flat=True)), [4, 5])
+        self.assertTrue(family_bill.comment.startswith("{[b]}"), family_bill.comment)
+        self.assertTrue(family_bill.comment.endswith("{[br/]}{[i]}la fiesta{[/i]}"), family_bill.comment)
+        details = list(family_bill.detail_set.all().order_by('id'))
+        self.assertEqual(len(details), 2)
+        self.assertEqual(details[0].article_id, 2)
+        self.assertTrue(details[0].designation.endswith(" Dalton Jack"), details[0].designation)
+        self.assertEqual(details[1].article_id, 5)
+        self.assertTrue(details[1].designation.endswith(" Dalton Joe{[br/]}bou!!!!"), details[1].designation)
+        self.assertAlmostEqual(float(details[1].reduce), 10.0)
+        avrel_bill = Bill.objects.get(third__contact_id=2)
+        self.assertEqual(avrel_bill.detail_set.all().count(), 1)
+        self.assertEqual(avrel_bill.detail_set.first().designation, "Article 02")
+
+    def test_validation_auditlog(self):
+        self.factory.xfer = EventAddModify()
+        self.calljson('/diacamma.event/eventAddModify',
+                      {"SAVE": "YES", "date": "2014-10-12", "activity": "1", "event_type": 0, "comment": "new examination", 'default_article': 0}, False)
+        self.factory.xfer = OrganizerSave()
+        self.calljson('/diacamma.event/organizerSave', {"event": 1, 'pkname': 'contact', 'contact': '6'}, False)
+        self.factory.xfer = OrganizerResponsible()
+        self.calljson('/diacamma.event/organizerResponsible', {"event": 1, 'organizer': '1'}, False)
+        self.factory.xfer = ParticipantSave()
+        self.calljson('/diacamma.event/participantSave', {"event": 1, 'adherent': '2;4;5'}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.event', 'participantSave')
+
+        Params.setvalue('CORE-AuditLog', 'event')
+        LucteriosAuditlogModelRegistry.main_enabled()
+        LucteriosAuditlogModelRegistry.set_state_packages(['event'])
+        try:
+            self.factory.xfer = EventTransition()
+            with QueryRecorder() as recorder:
+                self.calljson('/diacamma.event/eventTransition',
+                              {"event": 1, 'CONFIRME': 'YES', 'comment_1': 'trop nul!', 'degree_2': 5, 'comment_2': 'ça va...', 'TRANSITION': 'validate'}, False)
+            self.assert_observer('core.acknowledge', 'diacamma.event', 'eventTransition')
+        finally:
+            LucteriosAuditlogModelRegistry.main_disabled()
+            LucteriosAuditlogModelRegistry.set_state_packages([])
+        self.assertEqual(len([sql for sql, _duration in recorder.statements if sql.startswith('SELECT "event_participant"') and '"event_participant"."id" =' in sql]), 3, recorder.get_repeated())
+        self.assertEqual(len([sql for sql, _duration in recorder.statements if sql.startswith('INSERT INTO "event_higherdegree"')]), 1, recorder.get_repeated())
+        additional_data = "".join([log_entry.additional_data for log_entry in LucteriosLogEntry.objects.filter(modelname=Event.get_long_name(), object_id=1) if log_entry.additional_data is not None])
+        self.assertIn('trop nul!', additional_data)
+        self.assertIn('level #1.5', additional_data)
+        self.assertEqual(LucteriosLogEntry.objects.filter(modelname=Degree.get_long_name()).count(), 1)
+
+    def test_validation_batch(self):
+        adherents = generate_club(20)
+        self.factory.xfer = EventAddModify()
+        self.calljson('/diacamma.event/eventAddModify',
+                      {"SAVE": "YES", "date": "2014-10-12", "activity": "1", "event_type": 0, "comment": "big examination", 'default_article': 0}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.event', 'eventAddModify')
+        self.factory.xfer = OrganizerSave()
+        self.calljson('/diacamma.event/organizerSave', {"event": 1, 'pkname': 'contact', 'contact': '6'}, False)
+        self.factory.xfer = OrganizerResponsible()
+        self.calljson('/diacamma.event/organizerResponsible', {"event": 1, 'organizer': '1'}, False)
+        self.factory.xfer = ParticipantSave()
+        self.calljson('/diacamma.event/participantSave',
+                      {"event": 1, 'adherent': ';'.join(['2', '4', '5'] + [str(adh.id) for adh in adherents[:5]])}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.event', 'participantSave')
+
+        self.factory.xfer = EventTransition()
+        with QueryRecorder() as recorder:
+            self.calljson('/diacamma.event/eventTransition', {"event": 1, 'TRANSITION': 'validate'}, False)
+        self.assert_observer('core.custom', 'diacamma.event', 'eventTransition')
+        self.assert_count_equal('', 5 + 5 * 8)
+        self.assert_select_equal('degree_1', 9)
+        self.assert_select_equal('degree_2', 10)
+        self.assert_select_equal('subdegree_2', 6)
+        nb_queries = recorder.nb_queries
+
+        self.factory.xfer = ParticipantSave()
+        with QueryRecorder() as recorder:
+            self.calljson('/diacamma.event/participantSave',
+                          {"event": 1, 'adherent': ';'.join([str(adh.id) for adh in adherents[3:]])}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.event', 'participantSave')
+        self.assertEqual(len([sql for sql, _duration in recorder.statements if 'INSERT INTO "event_participant"' in sql]), 1)
+        self.assertEqual(len([sql for sql, _duration in recorder.statements if 'FROM "member_subscription"' in sql]), 1)
+        self.assertEqual(Participant.objects.filter(event_id=1).count(), 23)
+
+        self.factory.xfer = EventShow()
+        with QueryRecorder() as recorder:
+            self.calljson('/diacamma.event/eventShow', {"event": 1}, False)
+        self.assert_observer('core.custom', 'diacamma.event', 'eventShow')
+        self.assert_count_equal('participant', 23)
+        self.assert_json_equal('', 'participant/@0/is_subscripter', False)
+        self.assertEqual(len([sql for sql, _duration in recorder.statements if 'FROM "member_subscription"' in sql]), 1)
+        self.factory.xfer = EventTransition()
+        with QueryRecorder() as recorder:
+            self.calljson('/diacamma.event/eventTransition', {"event": 1, 'TRANSITION': 'validate'}, False)
+        self.assert_observer('core.custom', 'diacamma.event', 'eventTransition')
+        self.assert_count_equal('', 5 + 5 * 23)
+        self.assertLessEqual(recorder.nb_queries, nb_queries, recorder.get_repeated())
+
+        params = {"event": 1, 'CONFIRME': 'YES', 'TRANSITION': 'validate', 'subdegree_1': 2}
+        for participant in Participant.objects.filter(event_id=1).exclude(contact_id=2):
+            params['degree_%d' % participant.id] = 5
+            params['comment_%d' % participant.id] = 'ok %d' % participant.contact_id
+        self.factory.xfer = EventTransition()
+        with QueryRecorder() as recorder:
+            self.calljson('/diacamma.event/eventTransition', params, False)
+        self.assert_observer('core.acknowledge', 'diacamma.event', 'eventTransition')
+        self.assertLess(recorder.nb_queries, 30, recorder.get_repeated())
+        self.assertEqual(Degree.objects.filter(event_id=1).count(), 23)
+        self.assertEqual(Degree.objects.filter(event_id=1, adherent_id=2, degree_id=2, subdegree_id=2).count(), 1)
+        self.assertEqual(HigherDegree.objects.filter(adherent_id__in=[adh.id for adh in adherents], activity_id=1, degree_id=5).count(), 20)
+        self.assertEqual(Participant.objects.filter(event_id=1, degree_result_id=5, comment__startswith='ok ').count(), 22)
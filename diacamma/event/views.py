@@ -143,7 +143,9 @@ class EventTransition(XferTransition):
         lbl.set_location(0, 4, 7)
         dlg.add_component(lbl)
         row_id = 5
-        for participant in self.item.participant_set.all():
+        participants = list(self.item.participant_set.all().select_related('contact'))
+        Participant.prefetch_degree_context(self.item, participants)
+        for participant in participants:
             lbl = XferCompLabelForm('name_%d' % participant.id)
             lbl.set_value_as_name(str(participant))
             lbl.set_location(0, row_id)
@@ -253,10 +255,7 @@ class ParticipantSave(XferContainerAcknowledge):
     def fillresponse(self, event, adherent=[], pkname=''):
         contact_ids = self.getparam(pkname, '').split(';')
         contact_ids.extend(adherent)
-        for contact_id in contact_ids:
-            if contact_id != '':
-                Participant.objects.get_or_create(
-                    event_id=event, contact_id=contact_id)
+        Participant.add_contacts(Event.objects.get(id=event), [int(contact_id) for contact_id in contact_ids if contact_id != ''])
 
 
 @ActionsManage.affect_grid(TITLE_EDIT, short_icon='mdi:mdi-text-box-outline', unique=SELECT_SINGLE)
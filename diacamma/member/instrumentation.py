@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+'''
+Query instrumentation of member and event actions
+
+Opt-in by adding 'diacamma.member.instrumentation.QueryInstrumentationMiddleware'
+to the MIDDLEWARE setting; thresholds are read from DIACAMMA_QUERY_THRESHOLDS.
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2026 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+from collections import Counter
+from time import perf_counter
+import logging
+
+from django.conf import settings
+from django.db import connection
+
+DEFAULT_THRESHOLDS = {'queries': 100, 'duplicates': 20, 'sql_time': 1.0, 'time': 5.0}
+
+
+def get_thresholds():
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    thresholds.update(getattr(settings, 'DIACAMMA_QUERY_THRESHOLDS', {}))
+    return thresholds
+
+
+class QueryRecorder(object):
+
+    def __init__(self, name=''):
+        self.name = name
+        self.statements = []
+        self.time = 0.0
+        self._start = None
+        self._wrapper = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.statements.append((sql, perf_counter() - start))
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.time = perf_counter() - self._start
+        self._wrapper.__exit__(exc_type, exc_value, traceback)
+        self._wrapper = None
+
+    @property
+    def nb_queries(self):
+        return len(self.statements)
+
+    @property
+    def nb_duplicates(self):
+        return self.nb_queries - len(set([sql for sql, _duration in self.statements]))
+
+    @property
+    def sql_time(self):
+        return sum([duration for _sql, duration in self.statements])
+
+    def get_repeated(self, nb_top=5):
+        counter = Counter([sql for sql, _duration in self.statements])
+        return [(sql, nb) for sql, nb in counter.most_common(nb_top) if nb > 1]
+
+    def get_values(self):
+        return {'queries': self.nb_queries, 'duplicates': self.nb_duplicates, 'sql_time': self.sql_time, 'time': self.time}
+
+    def get_exceeded(self, thresholds):
+        values = self.get_values()
+        return [name for name, limit in thresholds.items() if (limit is not None) and (name in values) and (values[name] > limit)]
+
+    def log(self, thresholds=None):
+        if thresholds is None:
+            thresholds = get_thresholds()
+        logger = logging.getLogger('diacamma.member.queries')
+        exceeded = self.get_exceeded(thresholds)
+        message = "%s: %d queries, %d duplicates, sql %.3fs, total %.3fs" % (self.name, self.nb_queries, self.nb_duplicates, self.sql_time, self.time)
+        if len(exceeded) > 0:
+            repeated = ["%dx %s" % (nb, sql) for sql, nb in self.get_repeated()]
+            logger.warning("%s - over %s\n%s", message, ",".join(sorted(exceeded)), "\n".join(repeated))
+        else:
+            logger.debug(message)
+        return exceeded
+
+
+class QueryInstrumentationMiddleware(object):
+
+    PATH_PREFIXES = ('/diacamma.member/', '/diacamma.event/')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not request.path.startswith(self.PATH_PREFIXES):
+            return self.get_response(request)
+        with QueryRecorder(request.path) as recorder:
+            response = self.get_response(request)
+        recorder.log()
+        return response
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+'''
+diacamma.member.management.commands package
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2026 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from diacamma.member.models import MembershipSnapshot, Season
+
+
+class Command(BaseCommand):
+    help = 'Rebuild membership snapshots of subscriptions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--season', type=int, help='season id (all seasons by default)')
+
+    def handle(self, season, *args, **options):
+        season_item = Season.objects.get(id=season) if season is not None else None
+        nb_snapshot = MembershipSnapshot.rebuild(season_item)
+        self.stdout.write(self.style.SUCCESS('%d membership snapshot(s) rebuilt' % nb_snapshot))
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0010_morocco'),
+        ('member', '0017_activity_unactive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MembershipSnapshot',
+            fields=[
+                ('subscription', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='member.subscription', verbose_name='subscription')),
+                ('status', models.IntegerField(choices=[(0, 'waiting subscription'), (1, 'building subscription'), (2, 'valid subscription'), (3, 'cancel subscription'), (4, 'disbarred subscription')], default=1, verbose_name='status')),
+                ('begin_date', models.DateField(verbose_name='begin date')),
+                ('end_date', models.DateField(verbose_name='end date')),
+                ('duration', models.IntegerField(choices=[(0, 'annually'), (1, 'periodic'), (2, 'monthly'), (3, 'calendar')], default=0, verbose_name='duration')),
+                ('adherent', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='member.adherent', verbose_name='adherent')),
+                ('age_category', models.ForeignKey(db_index=False, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='member.age', verbose_name='age category')),
+                ('family', models.ForeignKey(db_index=False, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='contacts.legalentity', verbose_name='family')),
+                ('season', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='member.season', verbose_name='season')),
+            ],
+            options={
+                'verbose_name': 'membership snapshot',
+                'verbose_name_plural': 'membership snapshots',
+                'default_permissions': [],
+                'indexes': [models.Index(fields=['adherent', 'begin_date', 'end_date'], name='member_memb_adheren_0f5e11_idx'), models.Index(fields=['season', 'status'], name='member_memb_season__0f6ef4_idx'), models.Index(fields=['begin_date', 'end_date', 'status'], name='member_memb_begin_d_667516_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='MembershipInvolvement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('activity', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='member.activity', verbose_name='activity')),
+                ('team', models.ForeignKey(db_index=False, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='member.team', verbose_name='team')),
+                ('snapshot', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='involvements', to='member.membershipsnapshot', verbose_name='membership snapshot')),
+            ],
+            options={
+                'verbose_name': 'involvement',
+                'verbose_name_plural': 'involvements',
+                'default_permissions': [],
+                'indexes': [models.Index(fields=['snapshot', 'team', 'activity'], name='member_memb_snapsho_d5d9e8_idx'), models.Index(fields=['team', 'activity'], name='member_memb_team_id_775638_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CORE', '0007_shortcut'),
+        ('member', '0018_membershipsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MemberJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=50, verbose_name='kind')),
+                ('params', models.TextField(default='{}', verbose_name='parameters')),
+                ('items', models.TextField(default='[]', verbose_name='items')),
+                ('state', models.TextField(default='{}', verbose_name='state')),
+                ('status', models.IntegerField(choices=[(0, 'waiting'), (1, 'running'), (2, 'finished'), (3, 'failure')], db_index=True, default=0, verbose_name='status')),
+                ('total', models.IntegerField(default=0, verbose_name='total')),
+                ('done', models.IntegerField(default=0, verbose_name='done')),
+                ('creation_date', models.DateTimeField(auto_now_add=True, verbose_name='creation date')),
+                ('last_update', models.DateTimeField(auto_now=True, verbose_name='last update')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='CORE.lucteriosuser', verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'member job',
+                'verbose_name_plural': 'member jobs',
+                'ordering': ['-id'],
+                'default_permissions': [],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('member', '0019_memberjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MemberSequence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='name')),
+                ('value', models.IntegerField(default=0, verbose_name='value')),
+            ],
+            options={
+                'verbose_name': 'sequence',
+                'verbose_name_plural': 'sequences',
+                'default_permissions': [],
+            },
+        ),
+    ]
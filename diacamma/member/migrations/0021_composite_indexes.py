@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('member', '0020_membersequence'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='docadherent',
+            name='subscription',
+            field=models.ForeignKey(db_index=False, default=None, on_delete=django.db.models.deletion.CASCADE, to='member.subscription', verbose_name='subscription'),
+        ),
+        migrations.AlterField(
+            model_name='license',
+            name='subscription',
+            field=models.ForeignKey(db_index=False, default=None, on_delete=django.db.models.deletion.CASCADE, to='member.subscription', verbose_name='subscription'),
+        ),
+        migrations.AlterField(
+            model_name='subscription',
+            name='adherent',
+            field=models.ForeignKey(db_index=False, default=None, on_delete=django.db.models.deletion.CASCADE, to='member.adherent', verbose_name='adherent'),
+        ),
+        migrations.AlterField(
+            model_name='subscription',
+            name='season',
+            field=models.ForeignKey(db_index=False, default=None, on_delete=django.db.models.deletion.PROTECT, to='member.season', verbose_name='season'),
+        ),
+        migrations.AddIndex(
+            model_name='docadherent',
+            index=models.Index(fields=['subscription', 'document'], name='member_doca_subscri_0f8dc7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='license',
+            index=models.Index(fields=['subscription', 'team', 'activity'], name='member_lice_subscri_43d189_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['season', 'status'], name='member_subs_season__843c2c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['adherent', 'begin_date', 'end_date'], name='member_subs_adheren_3a35a9_idx'),
+        ),
+    ]
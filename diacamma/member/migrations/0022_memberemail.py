@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CORE', '0007_shortcut'),
+        ('invoice', '0033_categorybill_no_email_copy_alter_detail_vta_rate'),
+        ('member', '0021_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MemberEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient', models.TextField(verbose_name='recipient')),
+                ('subject', models.CharField(max_length=200, verbose_name='subject')),
+                ('body', models.TextField(verbose_name='message')),
+                ('print_model', models.IntegerField(default=None, null=True, verbose_name='print model')),
+                ('status', models.IntegerField(choices=[(0, 'waiting'), (1, 'sending'), (2, 'sent'), (3, 'failure')], db_index=True, default=0, verbose_name='status')),
+                ('nb_try', models.IntegerField(default=0, verbose_name='tries')),
+                ('last_error', models.TextField(default='', verbose_name='error')),
+                ('next_try', models.DateTimeField(default=None, null=True, verbose_name='next try')),
+                ('creation_date', models.DateTimeField(auto_now_add=True, verbose_name='creation date')),
+                ('last_update', models.DateTimeField(auto_now=True, verbose_name='last update')),
+                ('sent_date', models.DateTimeField(default=None, null=True, verbose_name='sent date')),
+                ('bill', models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='invoice.bill', verbose_name='bill')),
+                ('user', models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='CORE.lucteriosuser', verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'email',
+                'verbose_name_plural': 'emails',
+                'ordering': ['-id'],
+                'default_permissions': [],
+            },
+        ),
+    ]
@@ -24,20 +24,30 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import unicode_literals
 from datetime import date, datetime, timedelta
+from copy import deepcopy
 from os.path import isfile, join
 import logging
+import json
+import re
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
 from os import unlink
 from viewflow.fsm import TransitionNotAllowed
 
-from django.db import models
-from django.db.models.query import QuerySet
-from django.db.models.aggregates import Min, Max, Count
-from django.db.models.fields import BooleanField
-from django.db.models import Q
+from django.db import models, transaction, IntegrityError
+from django.db.models.query import QuerySet, ModelIterable
+from django.db.models.aggregates import Max, Count
+from django.db.models.fields import BooleanField, IntegerField
+from django.db.models import Q, Case, When, Value, Exists, OuterRef, Prefetch, Subquery
+from django.db.models.signals import post_save, post_delete
 from django.apps import apps
 from django.utils.translation import gettext_lazy as _
 from django.utils import formats, timezone
+from django.utils.crypto import get_random_string
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 
 from lucterios.framework.models import LucteriosModel
@@ -46,19 +56,95 @@ from lucterios.framework.model_fields import get_value_if_choices, LucteriosVirt
 from lucterios.framework.error import LucteriosException, IMPORTANT
 from lucterios.framework.tools import convert_date, same_day_months_after, toHtml, get_bool_textual
 from lucterios.framework.signal_and_lock import Signal
-from lucterios.framework.filetools import get_tmp_dir
+from lucterios.framework.filetools import get_tmp_dir, remove_accent
 from lucterios.framework.auditlog import auditlog
 
 from lucterios.CORE.models import Parameter, PrintModel, LucteriosUser, LucteriosGroup, Preference
 from lucterios.CORE.parameters import Params
 from lucterios.contacts.models import Individual, LegalEntity, Responsability, AbstractContact
-from lucterios.documents.models import FolderContainer
-from lucterios.mailing.email_functions import EmailException
+from lucterios.documents.models import FolderContainer, DocumentContainer
+from lucterios.mailing.email_functions import EmailException, will_mail_send, split_doubled_email
 
-from diacamma.invoice.models import Article, Bill, Detail, get_or_create_customer, invoice_addon_for_third, CategoryBill
+from diacamma.invoice.models import Article, Bill, Detail, get_or_create_customer, invoice_addon_for_third, CategoryBill, AutomaticReduce
 from diacamma.accounting.tools import get_amount_from_format_devise, format_with_devise, current_system_account
 from diacamma.accounting.models import Third, FiscalYear, EntryAccount, EntryLineAccount, ChartsAccount, Journal
 from diacamma.payoff.models import PaymentMethod, Supporting, Payoff, get_html_payment
+from diacamma.member.tools import bulk_create_with_signals
+
+
+class SeasonCacheInvalidation(object):
+
+    def __init__(self):
+        self.values = None
+
+    def __call__(self):
+        SeasonCache.clear()
+
+
+class SeasonCache(object):
+
+    CACHE_KEY = 'MEMBER_SEASONS'
+
+    @classmethod
+    def clear(cls):
+        cache.delete(cls.CACHE_KEY)
+
+    @classmethod
+    def invalidate(cls):
+        cls.clear()
+        transaction.on_commit(SeasonCacheInvalidation())
+
+    @classmethod
+    def _get_pending_invalidation(cls):
+        # callbacks of a rolled back savepoint are dropped with the values they kept
+        for _sids, callback, _robust in reversed(transaction.get_connection().run_on_commit):
+            if isinstance(callback, SeasonCacheInvalidation):
+                return callback
+        return None
+
+    @classmethod
+    def _load(cls):
+        seasons = {}
+        current_id = None
+        for season_id, designation, iscurrent in Season.objects.order_by('-designation').values_list('id', 'designation', 'iscurrent'):
+            seasons[season_id] = {'designation': designation, 'iscurrent': iscurrent, 'begin_date': None, 'end_date': None, 'periods': []}
+            if iscurrent:
+                current_id = season_id
+        for period_values in Period.objects.order_by('num').values('id', 'season_id', 'num', 'begin_date', 'end_date'):
+            season_values = seasons[period_values['season_id']]
+            season_values['periods'].append(period_values)
+            if (season_values['begin_date'] is None) or (period_values['begin_date'] < season_values['begin_date']):
+                season_values['begin_date'] = period_values['begin_date']
+            if (season_values['end_date'] is None) or (period_values['end_date'] > season_values['end_date']):
+                season_values['end_date'] = period_values['end_date']
+        return {'current': current_id, 'order': list(seasons.keys()), 'seasons': seasons}
+
+    @classmethod
+    def get_values(cls):
+        invalidation = cls._get_pending_invalidation()
+        if invalidation is not None:
+            # seasons changed by the current transaction are not shared before its commit
+            if invalidation.values is None:
+                invalidation.values = cls._load()
+            return invalidation.values
+        values = cache.get(cls.CACHE_KEY)
+        if values is None:
+            values = cls._load()
+            cache.set(cls.CACHE_KEY, values)
+        return values
+
+    @classmethod
+    def get_season_values(cls, season_id):
+        return cls.get_values()['seasons'].get(season_id)
+
+    @classmethod
+    def get_season(cls, season_id):
+        season_values = cls.get_season_values(season_id)
+        return Season.from_db('default', ['id', 'designation', 'iscurrent'], [season_id, season_values['designation'], season_values['iscurrent']])
+
+
+def clear_season_cache(sender, **kwargs):
+    SeasonCache.invalidate()
 
 
 class Season(LucteriosModel):
@@ -90,83 +176,70 @@ class Season(LucteriosModel):
             season_item.save()
         self.iscurrent = True
         self.save()
+        SeasonCache.invalidate()
         if not no_notif:
             Signal.call_signal("season_change")
 
     @classmethod
     def current_season(cls):
-        try:
-            return Season.objects.get(iscurrent=True)
-        except ObjectDoesNotExist:
+        current_id = SeasonCache.get_values()['current']
+        if current_id is None:
             raise LucteriosException(
                 IMPORTANT, _('No default season define!'))
+        return SeasonCache.get_season(current_id)
 
     @classmethod
     def get_from_date(cls, dateref):
-        seasons = Season.objects.filter(
-            period__begin_date__lte=dateref, period__end_date__gte=dateref)
-        if len(seasons) > 0:
-            return seasons[0]
-        else:
-            raise LucteriosException(IMPORTANT, _('No season find!'))
+        season_cache = SeasonCache.get_values()
+        for season_id in season_cache['order']:
+            for period_values in season_cache['seasons'][season_id]['periods']:
+                if (period_values['begin_date'] <= dateref) and (period_values['end_date'] >= dateref):
+                    return SeasonCache.get_season(season_id)
+        raise LucteriosException(IMPORTANT, _('No season find!'))
 
     def get_period_from_date(self, dateref):
-        periods = self.period_set.filter(
-            begin_date__lte=dateref, end_date__gte=dateref)
-        if len(periods) > 0:
-            return periods[0]
-        else:
-            raise LucteriosException(IMPORTANT, _('No period find!'))
-
-    def stats_by_criteria(self, duration_id, only_valid, field, name, with_total):
-        age_statistic = Params.getvalue("member-age-statistic")
-        val_by_criteria = {}
-        query = Q(subscription__status=Subscription.STATUS_VALID) if only_valid else Q(subscription__status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID))
-        query &= Q(subscription__begin_date__lte=self.date_ref) & Q(subscription__end_date__gte=self.date_ref)
-        query &= Q(subscription__subscriptiontype__duration=duration_id)
-        birthday = date(self.date_ref.year - age_statistic, self.date_ref.month, self.date_ref.day)
-        total = 0
-        for age in range(2):
-            if age == 0:
-                new_query = query & Q(birthday__gte=birthday)
-            else:
-                new_query = query & Q(birthday__lt=birthday)
-            values = Adherent.objects.filter(new_query).values(field, 'genre').annotate(genre_sum=Count('genre'))
-            for value in values:
-                if value[field] not in val_by_criteria.keys():
-                    val_by_criteria[value[field]] = [0, 0, 0, 0]
-                if (value['genre'] == 1) and (age == 1):  # MajM
-                    val_by_criteria[value[field]][0] += value['genre_sum']
-                elif (value['genre'] != 1) and (age == 1):  # MajW
-                    val_by_criteria[value[field]][1] += value['genre_sum']
-                elif (value['genre'] == 1) and (age == 0):  # MinM
-                    val_by_criteria[value[field]][2] += value['genre_sum']
-                elif (value['genre'] != 1) and (age == 0):  # MinW
-                    val_by_criteria[value[field]][3] += value['genre_sum']
-                total += value['genre_sum']
+        season_values = SeasonCache.get_season_values(self.id)
+        if season_values is not None:
+            for period_values in season_values['periods']:
+                if (period_values['begin_date'] <= dateref) and (period_values['end_date'] >= dateref):
+                    return Period.from_db('default', ['id', 'season_id', 'num', 'begin_date', 'end_date'],
+                                          [period_values['id'], self.id, period_values['num'], period_values['begin_date'], period_values['end_date']])
+        raise LucteriosException(IMPORTANT, _('No period find!'))
+
+    def get_statistic_values(self, only_valid):
+        query = Q(status=Subscription.STATUS_VALID) if only_valid else Q(status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID))
+        query &= Q(begin_date__lte=self.date_ref) & Q(end_date__gte=self.date_ref)
+        return MembershipSnapshot.objects.filter(query).order_by().values_list('subscription_id', 'duration', 'subscription__subscriptiontype_id',
+                                                                                'adherent__genre', 'adherent__birthday', 'adherent__city')
+
+    def get_statistic_involvements(self, only_valid):
+        query = Q(snapshot__status=Subscription.STATUS_VALID) if only_valid else Q(snapshot__status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID))
+        query &= Q(snapshot__begin_date__lte=self.date_ref) & Q(snapshot__end_date__gte=self.date_ref)
+        involvements = {}
+        for snapshot_id, team_id, activity_id in MembershipInvolvement.objects.filter(query).order_by('id').values_list('snapshot_id', 'team_id', 'activity_id'):
+            involvements.setdefault(snapshot_id, []).append((team_id, activity_id))
+        return involvements
+
+    def _format_stats_by_criteria(self, val_by_criteria, name, with_total, labels=None):
+        total = sum([sum(values) for values in val_by_criteria.values()])
         total_by_criteria = [0, 0, 0, 0]
         values_by_criteria = []
-        for criteria in val_by_criteria.keys():
-            criteria_sum = val_by_criteria[criteria][0] + val_by_criteria[criteria][1] + val_by_criteria[criteria][2] + val_by_criteria[criteria][3]
-            criteria_name = criteria
-            try:
-                if (name == 'type'):
-                    criteria_name = str(SubscriptionType.objects.get(id=criteria))
-                elif (name == 'team'):
-                    criteria_name = str(Team.objects.get(id=criteria))
-                elif (name == 'activity'):
-                    criteria_name = str(Activity.objects.get(id=criteria))
-            except Exception:
-                criteria_name = '---'
+        for criteria in sorted(val_by_criteria.keys(), key=lambda crit: ((val_by_criteria[crit][2] + val_by_criteria[crit][3]) == 0, crit is not None, crit)):
+            values = val_by_criteria[criteria]
+            criteria_sum = values[0] + values[1] + values[2] + values[3]
+            if labels is None:
+                criteria_name = criteria
+            else:
+                criteria_name = labels.get(criteria, '---')
             values_by_criteria.append({name: criteria_name,
-                                       "MajM": val_by_criteria[criteria][0],
-                                       "MajW": val_by_criteria[criteria][1],
-                                       "MinM": val_by_criteria[criteria][2],
-                                       "MinW": val_by_criteria[criteria][3],
+                                       "MajM": values[0],
+                                       "MajW": values[1],
+                                       "MinM": values[2],
+                                       "MinW": values[3],
                                        "sum": criteria_sum,
                                        "ratio": "%d (%.1f%%)" % (criteria_sum, 100 * criteria_sum / total) if with_total else "%d" % criteria_sum})
             for idx in range(4):
-                total_by_criteria[idx] += val_by_criteria[criteria][idx]
+                total_by_criteria[idx] += values[idx]
         values_by_criteria.sort(key=lambda val: -1 * val['sum'])
         if with_total and (len(values_by_criteria) > 0):
             values_by_criteria.append({name: "{[b]}%s{[/b]}" % _('total'),
@@ -177,26 +250,49 @@ class Season(LucteriosModel):
                                        "ratio": "{[b]}%d{[/b]}" % total})
         return values_by_criteria
 
-    def stats_by_seniority(self, only_valid):
+    def stats_by_criteria(self, only_valid):
         age_statistic = Params.getvalue("member-age-statistic")
-        val_by_seniority = {}
-        query = Q(subscription__status=Subscription.STATUS_VALID) if only_valid else Q(subscription__status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID))
-        query &= Q(subscription__begin_date__lte=self.date_ref) & Q(subscription__end_date__gte=self.date_ref)
-        query &= Q(subscription__subscriptiontype__duration=0)
         birthday = date(self.date_ref.year - age_statistic, self.date_ref.month, self.date_ref.day)
-        total = 0
-        for adh in Adherent.objects.filter(query).distinct():
-            nb_sub = adh.subscription_set.filter(Q(subscriptiontype__duration=0) & Q(begin_date__lte=self.date_ref)).count()
-            if not isinstance(adh.birthday, date) or adh.birthday >= birthday:
+        val_by_duration = {}
+        involvements = self.get_statistic_involvements(only_valid)
+        for sub_id, duration_id, type_id, genre, adh_birthday, city in self.get_statistic_values(only_valid):
+            if adh_birthday is None:
+                continue
+            idx = (0 if genre == 1 else 1) + (0 if adh_birthday < birthday else 2)
+            if duration_id not in val_by_duration:
+                val_by_duration[duration_id] = {'city': {}, 'type': {}, 'team': {}, 'activity': {}}
+            val_by_criteria = val_by_duration[duration_id]
+            criteria_values = [('city', city), ('type', type_id)]
+            for team_id, activity_id in involvements.get(sub_id, [(None, None)]):
+                criteria_values.extend([('team', team_id), ('activity', activity_id)])
+            for name, criteria in criteria_values:
+                if criteria not in val_by_criteria[name]:
+                    val_by_criteria[name][criteria] = [0, 0, 0, 0]
+                val_by_criteria[name][criteria][idx] += 1
+        return val_by_duration
+
+    def seniority_histogram(self, only_valid):
+        age_statistic = Params.getvalue("member-age-statistic")
+        query = Q(status=Subscription.STATUS_VALID) if only_valid else Q(status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID))
+        query &= Q(begin_date__lte=self.date_ref) & Q(end_date__gte=self.date_ref) & Q(duration=SubscriptionType.DURATION_ANNUALLY)
+        birthday = date(self.date_ref.year - age_statistic, self.date_ref.month, self.date_ref.day)
+        val_by_seniority = {}
+        sub_query = Q(duration=SubscriptionType.DURATION_ANNUALLY) & Q(begin_date__lte=self.date_ref) & Q(adherent_id__in=MembershipSnapshot.objects.filter(query).values('adherent_id'))
+        for adh_values in MembershipSnapshot.objects.filter(sub_query).order_by().values('adherent_id', 'adherent__genre', 'adherent__birthday').annotate(nb_sub=Count('subscription_id')):
+            if not isinstance(adh_values['adherent__birthday'], date) or adh_values['adherent__birthday'] >= birthday:
                 offset = +1
             else:
                 offset = -1
-            if nb_sub not in val_by_seniority.keys():
-                val_by_seniority[nb_sub] = [0, 0, 0, 0]
-            val_by_seniority[nb_sub][adh.genre + offset] += 1
-            total += 1
+            if adh_values['nb_sub'] not in val_by_seniority.keys():
+                val_by_seniority[adh_values['nb_sub']] = [0, 0, 0, 0]
+            val_by_seniority[adh_values['nb_sub']][adh_values['adherent__genre'] + offset] += 1
+        return val_by_seniority
+
+    def stats_by_seniority(self, only_valid):
+        val_by_seniority = self.seniority_histogram(only_valid)
+        total = sum([sum(values) for values in val_by_seniority.values()])
         values_by_seniority = []
-        for seniority in val_by_seniority.keys():
+        for seniority in sorted(val_by_seniority.keys()):
             seniority_sum = val_by_seniority[seniority][0] + val_by_seniority[seniority][1] + val_by_seniority[seniority][2] + val_by_seniority[seniority][3]
             values_by_seniority.append({'seniority': seniority,
                                         "MajM": val_by_seniority[seniority][0],
@@ -209,17 +305,22 @@ class Season(LucteriosModel):
 
     def get_statistic(self, only_valid):
         stat_res = []
+        val_by_duration = self.stats_by_criteria(only_valid)
+        type_labels = {type_id: str(sub_type) for type_id, sub_type in SubscriptionType.objects.in_bulk().items()}
+        team_labels = {team_id: str(team) for team_id, team in Team.objects.in_bulk().items()}
+        activity_labels = {activity_id: str(activity) for activity_id, activity in Activity.objects.in_bulk().items()}
         for duration_id, duration_title in SubscriptionType().get_field_by_name('duration').choices:
-            res_city = self.stats_by_criteria(duration_id, only_valid, 'city', 'city', True)
-            res_type = self.stats_by_criteria(duration_id, only_valid, 'subscription__subscriptiontype', 'type', True)
+            val_by_criteria = val_by_duration.get(duration_id, {'city': {}, 'type': {}, 'team': {}, 'activity': {}})
+            res_city = self._format_stats_by_criteria(val_by_criteria['city'], 'city', True)
+            res_type = self._format_stats_by_criteria(val_by_criteria['type'], 'type', True, type_labels)
             if duration_id == 0:
                 res_older = self.stats_by_seniority(only_valid)
                 if (Params.getvalue("member-team-enable") != 0):
-                    res_team = self.stats_by_criteria(duration_id, only_valid, 'subscription__license__team', 'team', False)
+                    res_team = self._format_stats_by_criteria(val_by_criteria['team'], 'team', False, team_labels)
                 else:
                     res_team = None
                 if Params.getvalue("member-activite-enable"):
-                    res_activity = self.stats_by_criteria(duration_id, only_valid, 'subscription__license__activity', 'activity', False)
+                    res_activity = self._format_stats_by_criteria(val_by_criteria['activity'], 'activity', False, activity_labels)
                 else:
                     res_activity = None
             else:
@@ -258,31 +359,76 @@ class Season(LucteriosModel):
                 adherent.user.generate_password()
             return (act_ret >= 0)
 
+    def _get_connection_query(self):
+        return MembershipSnapshot.get_adherent_exists(Q(season=self) & Q(status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID)))
+
     def disabled_old_connection(self):
         nb_del = 0
         if Params.getvalue("contacts-createaccount") == 0:
-            for adherent in Adherent.objects.filter(Q(user__is_active=True)).exclude(Q(responsability__legal_entity_id=1)):
-                if len(adherent.subscription_set.filter(Q(season=self) & Q(status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID)))) == 0:
-                    adherent.user.is_active = False
-                    adherent.user.save()
-                    nb_del += 1
+            old_adherents = Adherent.objects.filter(Q(user__isnull=False) & ~self._get_connection_query()).exclude(Q(responsability__legal_entity_id=1))
+            nb_del = LucteriosUser.objects.filter(is_active=True, id__in=old_adherents.values('user_id')).update(is_active=False)
         return nb_del
 
+    def get_connection_adherents(self):
+        return Adherent.objects.filter(self._get_connection_query())
+
+    def _create_adherent_users(self, adherents):
+        # homonyms of a same round get the same username from create_username: they wait for the next round
+        new_adherents = []
+        while len(adherents) > 0:
+            round_adherents = {}
+            next_adherents = []
+            for adherent in adherents:
+                username = adherent.create_username()
+                if username in round_adherents:
+                    next_adherents.append(adherent)
+                else:
+                    round_adherents[username] = adherent
+            new_users = [LucteriosUser(username=username, first_name=adherent.firstname, last_name=adherent.lastname, email=adherent.email) for username, adherent in round_adherents.items()]
+            bulk_create_with_signals(LucteriosUser, new_users)
+            for adherent, new_user in zip(round_adherents.values(), new_users):
+                adherent.user = new_user
+                new_adherents.append(adherent)
+            adherents = next_adherents
+        Adherent.objects.bulk_update(new_adherents, ['user'])
+        return new_adherents
+
+    def check_adherents_connection(self, adherents, result):
+        active_emails = set()
+        if settings.ASK_LOGIN_EMAIL:
+            active_emails = set(LucteriosUser.objects.filter(email__in=set(adherent.email for adherent in adherents), is_active=True).values_list('email', flat=True))
+        new_adherents = []
+        updated_adherents = []
+        for adherent in adherents:
+            if adherent.user_id is None:
+                if (adherent.email == '') or (adherent.email in active_emails):
+                    continue
+                new_adherents.append(adherent)
+            elif not adherent.user.is_active:
+                adherent.user.email = adherent.email
+                if settings.ASK_LOGIN_EMAIL and ((adherent.email in active_emails) or adherent.user.is_email_already_exists):
+                    continue
+                adherent.user.is_active = True
+                updated_adherents.append(adherent)
+            else:
+                continue
+            if settings.ASK_LOGIN_EMAIL:
+                active_emails.add(adherent.email)
+        if len(new_adherents) > 0:
+            new_adherents = self._create_adherent_users(new_adherents)
+        if len(updated_adherents) > 0:
+            LucteriosUser.objects.bulk_update([adherent.user for adherent in updated_adherents], ['email', 'is_active'])
+        defaultgroup = Params.getobject("contacts-defaultgroup")
+        if (defaultgroup is not None) and ((len(new_adherents) + len(updated_adherents)) > 0):
+            defaultgroup.user_set.add(*[adherent.user for adherent in new_adherents + updated_adherents])
+        MemberEmail.enqueue_connections(sorted([adherent.user for adherent in new_adherents + updated_adherents], key=lambda user: user.id))
+        result['nb_add'] += len(new_adherents)
+        result['nb_update'] += len(updated_adherents)
+
     def check_connection(self):
-        nb_del = self.disabled_old_connection()
-        nb_add = 0
-        nb_update = 0
-        error_sending = []
-        for adherent in Adherent.objects.filter(Q(subscription__status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID)) & Q(subscription__season=self)).distinct():
-            try:
-                act_ret = adherent.activate_adherent()
-                if act_ret == 1:
-                    nb_add += 1
-                elif act_ret == 2:
-                    nb_update += 1
-            except EmailException as email_err:
-                error_sending.append((str(adherent), str(email_err)))
-        return nb_del, nb_add, nb_update, error_sending
+        result = {'nb_del': self.disabled_old_connection(), 'nb_add': 0, 'nb_update': 0}
+        self.check_adherents_connection(list(self.get_connection_adherents().select_related('user').order_by('id')), result)
+        return result['nb_del'], result['nb_add'], result['nb_update']
 
     @property
     def reference_year(self):
@@ -298,15 +444,15 @@ class Season(LucteriosModel):
         return value
 
     def get_begin_date(self):
-        val = self.period_set.all().aggregate(Min('begin_date')) if self.id is not None else {}
-        if 'begin_date__min' in val.keys():
-            return val['begin_date__min']
+        season_values = SeasonCache.get_season_values(self.id) if self.id is not None else None
+        if season_values is not None:
+            return season_values['begin_date']
         else:
             return None
 
     def get_months(self):
         months = []
-        begin = self.begin_date
+        begin = self.get_begin_date()
         for month_num in range(12):
             year = begin.year
             month = begin.month + month_num
@@ -318,9 +464,9 @@ class Season(LucteriosModel):
         return months
 
     def get_end_date(self):
-        val = self.period_set.all().aggregate(Max('end_date')) if self.id is not None else {}
-        if 'end_date__max' in val.keys():
-            return val['end_date__max']
+        season_values = SeasonCache.get_season_values(self.id) if self.id is not None else None
+        if season_values is not None:
+            return season_values['end_date']
         else:
             return None
 
@@ -433,6 +579,12 @@ class Period(LucteriosModel):
         default_permissions = []
 
 
+post_save.connect(clear_season_cache, sender=Season)
+post_delete.connect(clear_season_cache, sender=Season)
+post_save.connect(clear_season_cache, sender=Period)
+post_delete.connect(clear_season_cache, sender=Period)
+
+
 class SubscriptionType(LucteriosModel):
     DURATION_ANNUALLY = 0
     DURATION_PERIODIC = 1
@@ -498,7 +650,8 @@ class SubscriptionType(LucteriosModel):
                 self.order_key = 1
             else:
                 self.order_key = val['order_key__max'] + 1
-        return LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        MembershipSnapshot.objects.filter(subscription__subscriptiontype_id=self.id).exclude(duration=self.duration).update(duration=self.duration)
 
     class Meta(object):
         verbose_name = _('subscription type')
@@ -621,6 +774,25 @@ class Age(LucteriosModel):
             return None
         return Season.current_season().reference_year - self.minimum
 
+    @classmethod
+    def get_birthday_query(cls, dateref, minimum, maximum):
+        return Q(birthday__gte=date(max(1, dateref.year - maximum), 1, 1)) & Q(birthday__lte=date(max(1, dateref.year - minimum), 12, 31))
+
+    @classmethod
+    def get_ranges(cls):
+        ranges = cache.get('MEMBER_AGES')
+        if ranges is None:
+            ranges = list(cls.objects.values_list('id', 'minimum', 'maximum'))
+            cache.set('MEMBER_AGES', ranges)
+        return ranges
+
+    @classmethod
+    def get_category_case(cls, dateref):
+        whens = [When(cls.get_birthday_query(dateref, minimum, maximum), then=Value(age_id)) for age_id, minimum, maximum in cls.get_ranges()]
+        if len(whens) == 0:
+            return Value(None, output_field=IntegerField())
+        return Case(*whens, default=None, output_field=IntegerField())
+
     class Meta(object):
         verbose_name = _('age')
         verbose_name_plural = _('ages')
@@ -628,6 +800,15 @@ class Age(LucteriosModel):
         default_permissions = []
 
 
+def clear_age_cache(sender, **kwargs):
+    cache.delete('MEMBER_AGES')
+    transaction.on_commit(lambda: cache.delete('MEMBER_AGES'))
+
+
+post_save.connect(clear_age_cache, sender=Age)
+post_delete.connect(clear_age_cache, sender=Age)
+
+
 def _validate_bill(bill):
     try:
         bill.valid()
@@ -635,11 +816,94 @@ def _validate_bill(bill):
         raise LucteriosException(IMPORTANT, _("Problem to validate %s:{[br/]} - %s") % (bill, "{[br/]} - ".join(bill.get_info_state())))
 
 
+class AdherentQuerySet(QuerySet):
+
+    VIRTUAL_FIELDS = ('dateref', 'family', 'age_category', 'current_subscription', 'last_subscription',
+                      'license', 'documents', 'higher_degree', 'lastdate_degree')
+    UNDATED_FIELDS = ('family', 'last_subscription')
+    CHUNK_SIZE = 500
+
+    def __init__(self, model=None, query=None, using=None, hints=None):
+        QuerySet.__init__(self, model=model, query=query, using=using, hints=hints)
+        self.virtual_fields = None
+        self.virtual_date_ref = None
+        self.age_date_ref = None
+
+    def _clone(self):
+        clone = QuerySet._clone(self)
+        clone.virtual_fields = self.virtual_fields
+        clone.virtual_date_ref = self.virtual_date_ref
+        clone.age_date_ref = self.age_date_ref
+        return clone
+
+    def with_virtual_fields(self, fieldnames=None, date_ref=None):
+        clone = self._chain()
+        if fieldnames is None:
+            clone.virtual_fields = list(self.VIRTUAL_FIELDS)
+        else:
+            names = [fieldname[1] if isinstance(fieldname, tuple) else fieldname for fieldname in fieldnames]
+            clone.virtual_fields = [fieldname for fieldname in self.VIRTUAL_FIELDS if fieldname in names]
+        if (date_ref is None) and any(fieldname not in self.UNDATED_FIELDS for fieldname in clone.virtual_fields):
+            date_ref = Season.current_season().date_ref
+        clone.virtual_date_ref = date_ref
+        if 'age_category' in clone.virtual_fields:
+            clone = clone.with_age_category(date_ref)
+        return clone
+
+    def with_age_category(self, date_ref=None):
+        if date_ref is None:
+            date_ref = Season.current_season().date_ref
+        clone = self.annotate(age_category_id=Age.get_category_case(date_ref))
+        clone.age_date_ref = date_ref
+        return clone
+
+    def _resolve_virtual_fields(self, adherents):
+        with_age = 'age_category_id' in self.query.annotations
+        if self.virtual_fields is not None:
+            fieldnames = [fieldname for fieldname in self.virtual_fields if not with_age or (fieldname != 'age_category')]
+            for idx in range(0, len(adherents), self.CHUNK_SIZE):
+                Adherent.prefetch_virtual_fields(adherents[idx:idx + self.CHUNK_SIZE], fieldnames, self.virtual_date_ref)
+        if with_age:
+            ages = Age.objects.in_bulk()
+            for adherent in adherents:
+                virtual_cache = getattr(adherent, '_virtual_cache', None)
+                if (virtual_cache is None) or (virtual_cache['date_ref'] != self.age_date_ref):
+                    adherent._virtual_cache = {'date_ref': self.age_date_ref, 'values': {}}
+                adherent._virtual_cache['values']['age_category'] = ages.get(adherent.age_category_id)
+
+    def _must_resolve(self):
+        return issubclass(self._iterable_class, ModelIterable) and ((self.virtual_fields is not None) or ('age_category_id' in self.query.annotations))
+
+    def _fetch_all(self):
+        must_resolve = (self._result_cache is None) and self._must_resolve()
+        QuerySet._fetch_all(self)
+        if must_resolve:
+            self._resolve_virtual_fields(self._result_cache)
+
+    def iterator(self, chunk_size=None):
+        if not self._must_resolve():
+            return QuerySet.iterator(self, chunk_size=chunk_size)
+        return self._iterator_by_chunk(chunk_size if chunk_size is not None else self.CHUNK_SIZE)
+
+    def _iterator_by_chunk(self, chunk_size):
+        chunk = []
+        for adherent in QuerySet.iterator(self, chunk_size=chunk_size):
+            chunk.append(adherent)
+            if len(chunk) == chunk_size:
+                self._resolve_virtual_fields(chunk)
+                yield from chunk
+                chunk = []
+        self._resolve_virtual_fields(chunk)
+        yield from chunk
+
+
 class Adherent(Individual):
     CONNECTION_NO = 0
     CONNECTION_BYADHERENT = 1
     CONNECTION_BYASKING = 2
 
+    _import_local = threading.local()
+
     num = models.IntegerField(verbose_name=_('numeros'), null=False, default=0,)
     birthday = models.DateField(verbose_name=_('birthday'), default=date.today, null=True)
     birthplace = models.CharField(_('birthplace'), max_length=50, blank=True)
@@ -657,6 +921,8 @@ class Adherent(Individual):
     higher_degree = LucteriosVirtualField(verbose_name=_("higher degree"), compute_from='get_higher_degree')
     lastdate_degree = LucteriosVirtualField(verbose_name=_("last date degree"), compute_from='get_lastdate_degree')
 
+    objects = models.Manager.from_queryset(AdherentQuerySet)()
+
     def __init__(self, *args, **kwargs):
         Individual.__init__(self, *args, **kwargs)
         self.date_ref = None
@@ -850,100 +1116,60 @@ class Adherent(Individual):
             fields.append(('value', _('license #')))
         return fields
 
-    def _import_family(self, new_family):
-        family_type = Params.getobject("member-family-type")
-        if family_type is None:
-            raise LucteriosException(IMPORTANT, _('No family type!'))
-        try:
-            family = LegalEntity.objects.get(name__iexact=new_family, structure_type=family_type)
-        except LegalEntity.DoesNotExist:
-            family = LegalEntity()
-            for fieldname, fieldvalue in self.get_default_family_value(False).items():
-                setattr(family, fieldname, fieldvalue)
-            family.name = new_family
-            family.structure_type = family_type
-            family.save()
-        if self.family != family:
-            Responsability.objects.create(individual=self, legal_entity=family)
+    @classmethod
+    def get_import_batch(cls):
+        return getattr(Adherent._import_local, 'batch', None)
 
-    def _import_subscription(self, type_name, dateformat, is_building):
-        working_subscription = None
-        current_season = Season.current_season()
-        type_option = 0
-        if '#' in type_name:
-            type_name, type_option = type_name.split('#')
-        try:
-            type_obj = SubscriptionType.objects.filter(name__iexact=type_name)
-            if len(type_obj) > 0:
-                type_obj = type_obj[0]
-                if type_obj.duration == 1:
-                    type_option = int(type_option) - 1
-                    period_list = current_season.period_set.all()
-                    begin_date = period_list[type_option].begin_date
-                    end_date = period_list[type_option].end_date
-                elif type_obj.duration == 2:
-                    type_option = int(type_option) - 1
-                    mounths = current_season.get_months()
-                    begin_date = convert_date(mounths[type_option][0] + '-01')
-                    end_date = same_day_months_after(
-                        begin_date, 1) - timedelta(days=1)
-                elif type_obj.duration == 3:
-                    try:
-                        begin_date = datetime.strptime(
-                            type_option, dateformat).date()
-                    except (TypeError, ValueError):
-                        begin_date = date.today()
-                    end_date = same_day_months_after(
-                        begin_date, 12) - timedelta(days=1)
-                else:
-                    begin_date = current_season.begin_date
-                    end_date = current_season.end_date
-                try:
-                    working_subscription = Subscription.objects.get(adherent=self,
-                                                                    season=current_season, subscriptiontype=type_obj,
-                                                                    begin_date=begin_date, end_date=end_date)
-                except ObjectDoesNotExist:
-                    working_subscription = Subscription()
-                    working_subscription.status = Subscription.STATUS_BUILDING if is_building else Subscription.STATUS_VALID
-                    working_subscription.adherent = self
-                    working_subscription.season = current_season
-                    working_subscription.subscriptiontype = type_obj
-                    working_subscription.begin_date = begin_date
-                    working_subscription.end_date = end_date
-                    working_subscription.save(with_bill=False)
-                if isinstance(working_subscription, tuple):
-                    working_subscription = working_subscription[0]
-            else:
-                self._import_logs.append(_("subscription type '%s' unknown !") % type_name)
-        except Exception as import_error:
-            self._import_logs.append(str(import_error))
-            logging.getLogger('diacamma.member').exception("import_data")
-        return working_subscription
+    @classmethod
+    def _set_import_batch(cls, import_batch):
+        old_batch = cls.get_import_batch()
+        if old_batch is not None:
+            old_batch.release_nums()
+        Adherent._import_local.batch = import_batch
+
+    @classmethod
+    def _get_from_data(cls, rowdata):
+        new_item = super(Adherent, cls)._get_from_data(rowdata)
+        new_item._import_batch = cls.get_import_batch()
+        return new_item
+
+    @classmethod
+    def initialize_import(cls):
+        super(Adherent, cls).initialize_import()
+        cls._set_import_batch(AdherentImportBatch())
 
     @classmethod
     def import_data(cls, rowdata, dateformat):
+        import_batch = cls.get_import_batch()
+        if import_batch is None:
+            import_batch = AdherentImportBatch()
+            try:
+                cls._set_import_batch(import_batch)
+                new_item = cls.import_data(rowdata, dateformat)
+                cls.import_logs.extend(import_batch.write())
+                return new_item
+            finally:
+                cls._set_import_batch(None)
         try:
             new_item = super(Adherent, cls).import_data(rowdata, dateformat)
             if new_item is not None:
-                new_item._import_logs = []
-                if ('family' in rowdata.keys()) and (rowdata['family'].strip() != ''):
-                    new_item._import_family(rowdata['family'].strip())
-                working_subscription = None
-                if ('subscriptiontype' in rowdata.keys()) and (rowdata['subscriptiontype'].strip() != ''):
-                    working_subscription = new_item._import_subscription(rowdata['subscriptiontype'].strip(), dateformat, is_building='prestations' in rowdata)
-                if working_subscription is None:
-                    working_subscription = new_item.last_subscription
-                cls.import_logs.extend(new_item._import_logs)
-                if working_subscription is not None:
-                    cls.import_logs.extend(working_subscription.import_licence(rowdata))
-                    working_subscription.save(with_bill=True)
-                del new_item._import_logs
+                cls.import_logs.extend(import_batch.add_row(new_item, rowdata, dateformat))
             return new_item
         except Exception as import_error:
             cls.import_logs.append(str(import_error))
             logging.getLogger('diacamma.member').exception("import_data")
             return None
 
+    @classmethod
+    def finalize_import(cls):
+        import_batch = cls.get_import_batch()
+        try:
+            if import_batch is not None:
+                cls.import_logs.extend(import_batch.write())
+        finally:
+            cls._set_import_batch(None)
+        return super(Adherent, cls).finalize_import()
+
     def activate_adherent(self, email=None, usernamebase=None):
         defaultgroup = Params.getobject("contacts-defaultgroup")
         if self.user_id is None:
@@ -980,6 +1206,93 @@ class Adherent(Individual):
         DegreeType = apps.get_model('event', "DegreeType")
         return (DegreeType is not None) and (DegreeType.objects.count() > 0)
 
+    def _get_virtual_cache(self, fieldname):
+        virtual_cache = getattr(self, '_virtual_cache', None)
+        if (virtual_cache is None) or (fieldname not in virtual_cache['values']):
+            return False, None
+        if (fieldname not in AdherentQuerySet.UNDATED_FIELDS) and (virtual_cache['date_ref'] != self.dateref):
+            return False, None
+        return True, virtual_cache['values'][fieldname]
+
+    @classmethod
+    def _prefetch_degrees(cls, adherent_ids, fieldnames, date_ref, values):
+        try:
+            Degree = apps.get_model('event', "Degree")
+            HigherDegree = apps.get_model('event', "HigherDegree")
+        except LookupError:
+            return
+        if 'higher_degree' in fieldnames:
+            higher_degrees = HigherDegree.get_higher_degrees(adherent_ids, date_ref)
+            activities = list(Activity.get_all())
+            for adherent_id in adherent_ids:
+                higher_degree = [str(higher_degrees[(adherent_id, activity.id)]) for activity in activities if (adherent_id, activity.id) in higher_degrees]
+                values[adherent_id]['higher_degree'] = higher_degree if len(higher_degree) > 0 else None
+        if 'lastdate_degree' in fieldnames:
+            query = Q(adherent_id__in=adherent_ids)
+            if date_ref is not None:
+                query &= Q(date__lte=date_ref)
+            lastdate_degrees = {}
+            for degree in Degree.objects.filter(query).select_related('degree', 'degree__activity', 'subdegree').order_by('-date'):
+                if degree.adherent_id not in lastdate_degrees:
+                    lastdate_degrees[degree.adherent_id] = degree
+            for adherent_id in adherent_ids:
+                values[adherent_id]['lastdate_degree'] = lastdate_degrees.get(adherent_id)
+
+    @classmethod
+    def prefetch_virtual_fields(cls, adherents, fieldnames, date_ref=None):
+        adherents = [adherent for adherent in adherents if adherent.id is not None]
+        if len(adherents) == 0:
+            return
+        adherent_ids = [adherent.id for adherent in adherents]
+        values = {adherent_id: {} for adherent_id in adherent_ids}
+        with_subscription = ('current_subscription' in fieldnames) or ('license' in fieldnames) or ('documents' in fieldnames)
+        if (date_ref is None) and any(fieldname not in AdherentQuerySet.UNDATED_FIELDS for fieldname in fieldnames):
+            date_ref = Season.current_season().date_ref
+        if 'family' in fieldnames:
+            families = {}
+            family_type = Params.getobject("member-family-type")
+            if family_type is not None:
+                for resp in Responsability.objects.filter(individual_id__in=adherent_ids, legal_entity__structure_type=family_type).select_related('legal_entity').order_by('id'):
+                    families[resp.individual_id] = resp.legal_entity
+            for adherent_id in adherent_ids:
+                values[adherent_id]['family'] = families.get(adherent_id)
+        if 'age_category' in fieldnames:
+            ages = list(Age.objects.all())
+            for adherent in adherents:
+                values[adherent.id]['age_category'] = None
+                if isinstance(adherent.birthday, date):
+                    age_val = int(date_ref.year - adherent.birthday.year)
+                    for age in ages:
+                        if (age.minimum <= age_val) and (age.maximum >= age_val):
+                            values[adherent.id]['age_category'] = age
+                            break
+        if with_subscription:
+            current_subscriptions = {}
+            subscriptions = Subscription.objects.filter(adherent_id__in=adherent_ids, begin_date__lte=date_ref, end_date__gte=date_ref).order_by('-begin_date')
+            if 'license' in fieldnames:
+                subscriptions = subscriptions.prefetch_related('prestations__team_prestation__team', 'prestations__team_prestation__activity', 'prestations__article',
+                                                               'license_set__team', 'license_set__activity')
+            if 'documents' in fieldnames:
+                subscriptions = subscriptions.prefetch_related('docadherent_set__document')
+            for subscription in subscriptions:
+                if subscription.adherent_id not in current_subscriptions:
+                    current_subscriptions[subscription.adherent_id] = subscription
+            for adherent_id in adherent_ids:
+                values[adherent_id]['current_subscription'] = current_subscriptions.get(adherent_id)
+        if 'last_subscription' in fieldnames:
+            last_subscriptions = {}
+            for subscription in Subscription.objects.filter(adherent_id__in=adherent_ids).order_by('-end_date'):
+                if subscription.adherent_id not in last_subscriptions:
+                    last_subscriptions[subscription.adherent_id] = subscription
+            for adherent_id in adherent_ids:
+                values[adherent_id]['last_subscription'] = last_subscriptions.get(adherent_id)
+        if ('higher_degree' in fieldnames) or ('lastdate_degree' in fieldnames):
+            cls._prefetch_degrees(adherent_ids, fieldnames, date_ref, values)
+        for adherent in adherents:
+            if adherent.date_ref is None:
+                adherent.date_ref = date_ref
+            adherent._virtual_cache = {'date_ref': date_ref, 'values': values[adherent.id]}
+
     def get_higher_degree_ex(self, date_before=None):
         if self.has_degree:
             if (date_before is None) and (self.date_ref is not None):
@@ -991,13 +1304,22 @@ class Adherent(Individual):
                     for activity in Activity.get_all()]
 
     def get_higher_degree(self):
+        found, value = self._get_virtual_cache('higher_degree')
+        if found:
+            return value
         if self.has_degree:
-            higher_degree = [str(degree) for degree in self.get_higher_degree_ex() if degree is not None]
+            HigherDegree = apps.get_model('event', "HigherDegree")
+            higher_degrees = HigherDegree.get_higher_degrees([self.id], self.date_ref)
+            higher_degree = [str(higher_degrees[(self.id, activity.id)]) for activity in Activity.get_all() if (self.id, activity.id) in higher_degrees]
             if len(higher_degree) > 0:
                 return higher_degree
         return None
 
     def get_lastdate_degree(self, date_before=None):
+        if date_before is None:
+            found, value = self._get_virtual_cache('lastdate_degree')
+            if found:
+                return value
         if self.has_degree:
             if (date_before is None) and (self.date_ref is not None):
                 date_before = self.date_ref
@@ -1023,6 +1345,9 @@ class Adherent(Individual):
     def get_age_category(self):
         if self.id is None:
             return None
+        found, value = self._get_virtual_cache('age_category')
+        if found:
+            return value
         try:
             age_val = int(self.dateref.year - self.birthday.year)
             ages = Age.objects.filter(minimum__lte=age_val, maximum__gte=age_val)
@@ -1054,45 +1379,17 @@ class Adherent(Individual):
         return self.date_ref
 
     def renew(self, dateref):
-        last_subscription = self.last_subscription
-        if last_subscription is not None:
-            if last_subscription.subscriptiontype.state != SubscriptionType.STATE_UNACTIVATE:
-                new_subscriptiontype = last_subscription.subscriptiontype
-            else:
-                subtypes = SubscriptionType.objects.filter(duration=last_subscription.subscriptiontype.duration).exclude(state=SubscriptionType.STATE_UNACTIVATE)
-                if subtypes.count() == 0:
-                    raise LucteriosException(IMPORTANT, _('No subscription type active !'))
-                new_subscriptiontype = subtypes.first()
-            new_subscription = Subscription(adherent=self, subscriptiontype=new_subscriptiontype, status=Subscription.STATUS_BUILDING)
-            begin_date = max(dateref, last_subscription.end_date + timedelta(days=1))
-            if new_subscriptiontype.duration == SubscriptionType.DURATION_CALENDAR:
-                new_begin_date = last_subscription.end_date + timedelta(days=1)
-                if (dateref - new_begin_date).days < Params.getvalue('member-subscription-delaytorenew'):
-                    begin_date = new_begin_date
-            new_subscription.set_periode(begin_date)
-            if Params.getvalue("member-team-enable") == 2:
-                prestation_list = []
-                for license_item in last_subscription.license_set.all():
-                    pesta = Prestation.objects.filter(team_prestation__team_id=license_item.team_id,
-                                                      team_prestation__activity_id=license_item.activity_id).order_by('-article__price')
-                    if pesta.count() > 0:
-                        prestation_list.append(pesta[0])
-                new_subscription.save(with_bill=False)
-                new_subscription.prestations.set(prestation_list)
-                new_subscription.save(with_bill=True)
-            else:
-                new_subscription.save()
-                for license_item in last_subscription.license_set.all():
-                    license_item.id = None
-                    license_item.subscription = new_subscription
-                    license_item.save()
-            if new_subscription.bill is not None:
-                _validate_bill(new_subscription.bill)
-            return True
-        else:
-            return False
+        renewal = SubscriptionBatch(dateref)
+        renewal.add_renewals([self])
+        renewal.run()
+        if self.id in renewal.errors:
+            raise LucteriosException(IMPORTANT, renewal.errors[self.id])
+        return len(renewal.subscriptions) > 0
 
     def get_last_subscription(self):
+        found, value = self._get_virtual_cache('last_subscription')
+        if found:
+            return value
         subscriptions = self.subscription_set.all().order_by('-end_date') if self.id is not None else []
         if len(subscriptions) > 0:
             return subscriptions[0]
@@ -1100,6 +1397,9 @@ class Adherent(Individual):
             return None
 
     def get_current_subscription(self):
+        found, value = self._get_virtual_cache('current_subscription')
+        if found:
+            return value
         sub = self.subscription_set.filter(
             begin_date__lte=self.dateref, end_date__gte=self.dateref)
         if len(sub) > 0:
@@ -1121,6 +1421,9 @@ class Adherent(Individual):
     def get_family(self):
         if self.id is None:
             return None
+        found, value = self._get_virtual_cache('family')
+        if found:
+            return value
         current_family = None
         current_type = Params.getobject("member-family-type")
         if current_type is not None:
@@ -1144,19 +1447,67 @@ class Adherent(Individual):
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None, new_num=True):
         if (self.id is None) and new_num:
-            val = Adherent.objects.all().aggregate(Max('num'))
-            if val['num__max'] is None:
-                self.num = 1
+            import_batch = getattr(self, '_import_batch', None)
+            if import_batch is not None:
+                self.num = import_batch.allocate_num()
             else:
-                self.num = val['num__max'] + 1
+                self.num = MemberSequence.allocate('adherent')
+        is_new = self.id is None
         Individual.save(self, force_insert=force_insert,
                         force_update=force_update, using=using, update_fields=update_fields)
+        if not is_new:
+            MembershipSnapshot.refresh(self.subscription_set.values_list('id', flat=True))
 
     class Meta(object):
         verbose_name = _('adherent')
         verbose_name_plural = _('adherents')
 
 
+class FamilyDirectory(object):
+
+    def __init__(self, season_id):
+        self.season_id = season_id
+        self.emails = {}
+        self.adherents = {}
+        family_type = Params.getobject("member-family-type")
+        self.family_type_id = family_type.id if family_type is not None else None
+        season_subscription = Subscription.objects.filter(adherent_id=OuterRef('individual_id'), season_id=season_id)
+        responsabilities = Responsability.objects.filter(Exists(season_subscription)).order_by('id')
+        families = {}
+        for legal_entity_id, structure_type_id, individual_id, lastname, firstname, email in responsabilities.values_list('legal_entity_id', 'legal_entity__structure_type_id', 'individual_id',
+                                                                                                                      'individual__lastname', 'individual__firstname', 'individual__email'):
+            self.emails.setdefault(legal_entity_id, set()).update(email.replace(',', ';').split(';'))
+            if (self.family_type_id is not None) and (structure_type_id == self.family_type_id):
+                families[individual_id] = (legal_entity_id, '%s %s' % (lastname, firstname))
+        for legal_entity_id, adherent_name in families.values():
+            self.adherents.setdefault(legal_entity_id, set()).add(adherent_name)
+
+    @classmethod
+    def get_ref_contact_ids(cls, individual_ids):
+        # same reference contact as Adherent.get_ref_contact, for all those individuals
+        family_type = Params.getobject("member-family-type")
+        individuals = Individual.objects.filter(id__in=individual_ids).annotate(is_adherent=Exists(Adherent.objects.filter(individual_ptr_id=OuterRef('id'))))
+        if family_type is not None:
+            individuals = individuals.prefetch_related(Prefetch('responsability_set', to_attr='family_responsabilities',
+                                                                queryset=Responsability.objects.filter(legal_entity__structure_type=family_type).order_by('-id')))
+        ref_contact_ids = {}
+        for individual in individuals:
+            ref_contact_ids[individual.id] = individual.id
+            if individual.is_adherent and (len(getattr(individual, 'family_responsabilities', [])) > 0):
+                ref_contact_ids[individual.id] = individual.family_responsabilities[0].legal_entity_id
+        return ref_contact_ids
+
+    def get_emails(self, contact):
+        emails = set(contact.email.replace(',', ';').split(';'))
+        emails.update(self.emails.get(contact.id, set()))
+        return list(emails)
+
+    def get_adherents(self, contact):
+        if self.family_type_id is None:
+            raise LucteriosException(IMPORTANT, _('No family type!'))
+        return sorted(self.adherents.get(contact.id, set()))
+
+
 class ContactAdherent(AbstractContact):
 
     ident = LucteriosVirtualField(verbose_name=_('contact'), compute_from='__str__')
@@ -1178,29 +1529,27 @@ class ContactAdherent(AbstractContact):
         if (self.season_id == 0):
             dateref = convert_date(xfer.getparam("dateref", ""), Season.current_season().date_ref)
             self.season_id = Season.get_from_date(dateref).id
+        directory = getattr(xfer, 'family_directory', None)
+        if (directory is None) or (directory.season_id != self.season_id):
+            directory = FamilyDirectory(self.season_id)
+            xfer.family_directory = directory
+        self.family_directory = directory
+
+    def get_family_directory(self):
+        if getattr(self, 'family_directory', None) is None:
+            self.family_directory = FamilyDirectory(self.season_id)
+        return self.family_directory
 
     def get_emails(self):
-        emails = self.email.replace(',', ';').split(';')
         if hasattr(self, 'legalentity'):
-            contact = getattr(self, 'legalentity')
-            for resp in contact.responsability_set.filter(individual__adherent__subscription__season_id=self.season_id).distinct():
-                emails.extend(resp.individual.email.replace(',', ';').split(';'))
-        return list(set(emails))
+            return self.get_family_directory().get_emails(self)
+        return list(set(self.email.replace(',', ';').split(';')))
 
     def get_adherents(self):
         if hasattr(self, 'individual'):
             return [str(self)]
         elif hasattr(self, 'legalentity'):
-            contact = getattr(self, 'legalentity')
-            family_type = Params.getobject("member-family-type")
-            if family_type is None:
-                raise LucteriosException(IMPORTANT, _('No family type!'))
-            adhs = []
-            for resp in contact.responsability_set.filter(individual__adherent__subscription__season_id=self.season_id).distinct():
-                adh = resp.individual.get_final_child()
-                if adh.family == contact:
-                    adhs.append(str(adh))
-            return sorted(set(adhs))
+            return self.get_family_directory().get_adherents(self)
         return
 
     class Meta(object):
@@ -1276,9 +1625,8 @@ class TeamPrestation(LucteriosModel):
 
     @property
     def adherent_set(self):
-        return Adherent.objects.filter(subscription__season__iscurrent=True,
-                                       subscription__status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID),
-                                       subscription__license__team=self.team, subscription__license__activity=self.activity).distinct()
+        snapshot_query = Q(season__iscurrent=True) & Q(status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID))
+        return Adherent.objects.filter(MembershipSnapshot.get_adherent_exists(snapshot_query & MembershipSnapshot.get_involvement_query([self.team_id], [self.activity_id])))
 
     def get_nb_adherent(self):
         return self.adherent_set.count()
@@ -1370,6 +1718,22 @@ class Prestation(LucteriosModel):
         default_permissions = []
 
 
+class SubscriptionQuerySet(QuerySet):
+
+    SNAPSHOT_FIELDS = ('adherent', 'adherent_id', 'season', 'season_id', 'subscriptiontype', 'subscriptiontype_id', 'begin_date', 'end_date', 'status')
+
+    def update(self, **kwargs):
+        if any(field_name in kwargs for field_name in self.SNAPSHOT_FIELDS):
+            subscription_ids = list(self.values_list('id', flat=True))
+            nb_updated = QuerySet.update(self, **kwargs)
+            MembershipSnapshot.refresh(subscription_ids)
+        else:
+            nb_updated = QuerySet.update(self, **kwargs)
+        return nb_updated
+
+    update.alters_data = True
+
+
 class Subscription(LucteriosModel):
     MODE_NOHIMSELF = 0
     MODE_WITHMODERATE = 1
@@ -1385,8 +1749,8 @@ class Subscription(LucteriosModel):
     LIST_STATUS = ((STATUS_WAITING, _('waiting subscription')), (STATUS_BUILDING, _('building subscription')), (STATUS_VALID, _('valid subscription')), (STATUS_CANCEL, _('cancel subscription')), (STATUS_DISBARRED, _('disbarred subscription')))
     SELECT_STATUS = ((STATUS_WAITING_BUILDING, '%s & %s' % (_('building subscription'), _('valid subscription'))), (STATUS_BUILDING, _('building')), (STATUS_VALID, _('valid')))
 
-    adherent = models.ForeignKey(Adherent, verbose_name=_('adherent'), null=False, default=None, db_index=True, on_delete=models.CASCADE)
-    season = models.ForeignKey(Season, verbose_name=_('season'), null=False, default=None, db_index=True, on_delete=models.PROTECT)
+    adherent = models.ForeignKey(Adherent, verbose_name=_('adherent'), null=False, default=None, db_index=False, on_delete=models.CASCADE)
+    season = models.ForeignKey(Season, verbose_name=_('season'), null=False, default=None, db_index=False, on_delete=models.PROTECT)
     subscriptiontype = models.ForeignKey(SubscriptionType, verbose_name=_('subscription type'), null=False, default=None, db_index=True, on_delete=models.PROTECT)
     bill = models.ForeignKey(Bill, verbose_name=_('bill'), null=True, default=None, db_index=True, on_delete=models.SET_NULL)
     begin_date = models.DateField(verbose_name=_('begin date'), null=False)
@@ -1396,6 +1760,8 @@ class Subscription(LucteriosModel):
 
     involvement = LucteriosVirtualField(verbose_name=_('involvement'), compute_from='get_involvement')
 
+    objects = models.Manager.from_queryset(SubscriptionQuerySet)()
+
     def __str__(self):
         if not isinstance(self.begin_date, str) and not isinstance(self.end_date, str):
             ret = "%s:%s->%s" % (SubscriptionType.get_cache_text(self.subscriptiontype_id), formats.date_format(self.begin_date, "SHORT_DATE_FORMAT"), formats.date_format(self.end_date, "SHORT_DATE_FORMAT"))
@@ -1485,19 +1851,21 @@ class Subscription(LucteriosModel):
         cmt.append(_("From the period %(begin_date)s -> %(end_date)s") % {"begin_date": self.begin_date.strftime('%d/%m/%Y'), "end_date": self.end_date.strftime('%d/%m/%Y')})
         return cmt
 
-    def _add_detail_bill(self):
+    def _get_detail_bill(self):
+        lines = []
         cmt = self._append_subscription_detail()
         for art in self.subscriptiontype.articles.all():
             new_cmt = [art.designation]
             new_cmt.extend(cmt)
-            Detail.create_for_bill(self.bill, art, designation="{[br/]}".join(new_cmt))
+            lines.append((art, "{[br/]}".join(new_cmt)))
         for presta in self.prestations.all():
             new_cmt = [presta.team_prestation.team.description]
             new_cmt.extend(cmt)
-            Detail.create_for_bill(self.bill, presta.article, designation="{[br/]}".join(new_cmt))
+            lines.append((presta.article, "{[br/]}".join(new_cmt)))
+        return lines
 
-    def _search_or_create_bill(self, bill_types, parentbill=None):
-        new_third = get_or_create_customer(self.adherent.get_ref_contact().id)
+    def _search_or_create_bill(self, bill_types, parentbill=None, third=None):
+        new_third = third if third is not None else get_or_create_customer(self.adherent.get_ref_contact().id)
         bill_list = Bill.objects.filter(third=new_third, bill_type__in=bill_types, status=Bill.STATUS_BUILDING).annotate(subscription_count=Count('subscription')).filter(subscription_count__gte=1).order_by('-date')
         if Bill.BILLTYPE_QUOTATION in bill_types:
             date_ref = timezone.now()
@@ -1514,7 +1882,7 @@ class Subscription(LucteriosModel):
                 categoryBill = CategoryBill.objects.filter(is_default=True).first()
             self.bill = Bill.objects.create(bill_type=bill_types[0], date=date_ref, third=new_third, parentbill=parentbill, categoryBill=categoryBill)
 
-    def _regenerate_bill(self, bill_type):
+    def _regenerate_bill(self, bill_type, subscription_list=None):
         self.bill.bill_type = bill_type
         if bill_type == Bill.BILLTYPE_BILL:
             if hasattr(self, 'xfer'):
@@ -1536,14 +1904,15 @@ class Subscription(LucteriosModel):
             cmt.append(_("Subscription of '%s'") % str(self.adherent))
         self.bill.comment = "{[br/]}".join(cmt)
         self.bill.save()
-        self.bill.detail_set.all().delete()
-        subscription_list = list(self.bill.subscription_set.all())
+        if subscription_list is None:
+            subscription_list = list(self.bill.subscription_set.all())
         if self not in subscription_list:
             subscription_list.append(self)
-        for subscription in subscription_list:
-            subscription._add_detail_bill()
+        synchronizer = BillSynchronizer(self.bill, subscription_list)
+        synchronizer.apply()
         if hasattr(self, 'send_email_param'):
             self.sendemail(self.send_email_param)
+        return synchronizer.details
 
     def _save_presta_in_bill(self, bill_type, prestation_id):
         if self.status == self.STATUS_VALID:
@@ -1632,46 +2001,6 @@ class Subscription(LucteriosModel):
                     modify = True
         return modify
 
-    def import_licence(self, rowdata):
-        import_logs = []
-        if ('prestations' in rowdata) and (rowdata['prestations'].strip() != ''):
-            prestation_list = []
-            for prestation_name in rowdata['prestations'].replace(',', ';').split(';'):
-                try:
-                    if '|' in prestation_name:
-                        prestation_name, price_name = prestation_name.split('|')
-                        new_prestation = Prestation.objects.filter(team_prestation__team__name__iexact=prestation_name.strip(), name__iexact=price_name.strip()).first()
-                    else:
-                        new_prestation = Prestation.objects.filter(team_prestation__team__name__iexact=prestation_name.strip()).first()
-                    if new_prestation is None:
-                        raise Prestation.DoesNotExist()
-                    prestation_list.append(new_prestation)
-                except Prestation.DoesNotExist:
-                    if prestation_name.strip() != '':
-                        import_logs.append(_("Prestation '%s' unknown !") % prestation_name.strip())
-                    pass
-            self.prestations.set(prestation_list)
-        elif self.prestations.count() == 0:
-            try:
-                team = Team.objects.get(name__iexact=rowdata['team'])
-            except Exception:
-                team = None
-                if 'team' in rowdata and (rowdata['team'].strip() != ''):
-                    import_logs.append(_("%(name)s '%(value)s' unknown !") % {'name': Params.getvalue("member-team-text"), 'value': rowdata['team'].strip()})
-            try:
-                activity = Activity.objects.get(name__iexact=rowdata['activity'])
-            except Exception:
-                activity = Activity.get_all().first()
-                if 'activity' in rowdata and (rowdata['activity'].strip() != ''):
-                    import_logs.append(_("%(name)s '%(value)s' unknown !") % {'name': Params.getvalue("member-activite-text"), 'value': rowdata['activity'].strip()})
-            try:
-                value = rowdata['value']
-            except Exception:
-                value = ''
-            if ('subscriptiontype' in rowdata.keys()) or (team is not None) or (value != ''):
-                License.objects.create(subscription=self, team=team, activity=activity, value=value)
-        return import_logs
-
     def _licenses_must_be_deleted(self):
         must_delete = True
         if self.status == self.STATUS_VALID:
@@ -1685,31 +2014,59 @@ class Subscription(LucteriosModel):
                         must_delete = False
         return must_delete
 
+    def get_prestation_licenses(self, prestations):
+        return [License(subscription=self, activity_id=presta.team_prestation.activity_id, team_id=presta.team_prestation.team_id) for presta in prestations]
+
     def convert_prestations(self):
         if (Params.getvalue("member-team-enable") == 2):
             if (self.status in (self.STATUS_WAITING, self.STATUS_BUILDING)) or (self.prestations.all().count() > 0):
                 if self._licenses_must_be_deleted():
                     self.license_set.all().delete()
-                for presta in self.prestations.all():
-                    License.objects.create(subscription=self, activity_id=presta.team_prestation.activity_id, team_id=presta.team_prestation.team_id)
+                for new_license in self.get_prestation_licenses(self.prestations.all()):
+                    new_license.save()
             if self.status in (self.STATUS_VALID, self.STATUS_CANCEL, self.STATUS_DISBARRED):
                 self.prestations.set([])
 
+    def get_new_documents(self, documents=None):
+        if documents is None:
+            documents = self.season.document_set.all()
+        return [DocAdherent(subscription=self, document=doc, value=False) for doc in documents]
+
+    @classmethod
+    def get_used_dates(cls, adherent_ids):
+        used_dates = {}
+        for adherent_id, subscription_id, season_id, duration, begin_date, end_date in cls.objects.filter(adherent_id__in=adherent_ids).order_by().values_list('adherent_id', 'id', 'season_id', 'subscriptiontype__duration', 'begin_date', 'end_date'):
+            used_dates.setdefault(adherent_id, []).append((subscription_id, season_id, duration, begin_date, end_date))
+        return used_dates
+
+    def check_used_dates(self, used_dates):
+        if self.id is None:
+            new_begin_date = convert_date(self.begin_date)
+            new_end_date = convert_date(self.end_date)
+            for _subscription_id, season_id, duration, begin_date, end_date in used_dates:
+                if duration == SubscriptionType.DURATION_ANNUALLY:
+                    dates_used = (season_id == self.season_id)
+                else:
+                    dates_used = ((begin_date <= new_end_date) and (end_date >= new_end_date)) or ((begin_date <= new_begin_date) and (end_date >= new_begin_date))
+                if dates_used:
+                    raise LucteriosException(IMPORTANT, _("dates always used!"))
+        if self.subscriptiontype.duration not in (SubscriptionType.DURATION_MONTLY, SubscriptionType.DURATION_PERIODIC):
+            for subscription_id, season_id, _duration, _begin_date, _end_date in used_dates:
+                if (subscription_id != self.id) and (season_id == self.season_id):
+                    raise LucteriosException(IMPORTANT, _("season always used!"))
+
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None, with_bill=True):
         is_new = self.id is None
-        query_dates = (Q(begin_date__lte=self.end_date) & Q(end_date__gte=self.end_date)) | (Q(begin_date__lte=self.begin_date) & Q(end_date__gte=self.begin_date))
-        if is_new and (len(self.adherent.subscription_set.filter((Q(subscriptiontype__duration=SubscriptionType.DURATION_ANNUALLY) & Q(season=self.season)) | (~Q(subscriptiontype__duration=SubscriptionType.DURATION_ANNUALLY) & query_dates))) > 0):
-            raise LucteriosException(IMPORTANT, _("dates always used!"))
-        if (self.subscriptiontype.duration not in (SubscriptionType.DURATION_MONTLY, SubscriptionType.DURATION_PERIODIC)) and self.adherent.subscription_set.filter(season=self.season).exclude(id=self.id).count() > 0:
-            raise LucteriosException(IMPORTANT, _("season always used!"))
+        self.check_used_dates(Subscription.get_used_dates([self.adherent_id]).get(self.adherent_id, []))
         self.status = int(self.status)
         LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
         if not force_insert and with_bill and self.change_bill():
             LucteriosModel.save(self)
         if is_new:
-            for doc in self.season.document_set.all():
-                DocAdherent.objects.create(subscription=self, document=doc, value=False)
+            for new_doc in self.get_new_documents():
+                new_doc.save()
         self.convert_prestations()
+        MembershipSnapshot.refresh([self.id])
 
     transitionname__moderate = _("Moderate")
 
@@ -1790,18 +2147,24 @@ class Subscription(LucteriosModel):
                 subscription_message = toHtml(Params.getvalue("member-subscription-message").replace('\n', '<br/>'))
                 if self.bill.payoff_have_payment():
                     subscription_message += get_html_payment(sendemail[0], sendemail[1], self.bill)
-                self.bill.send_email(_('New subscription'), "<html>%s</html>" % subscription_message, PrintModel.get_print_default(2, Bill))
-                return True
+                if will_mail_send():
+                    MemberEmail.enqueue_bill(self.bill, _('New subscription'), "<html>%s</html>" % subscription_message, PrintModel.get_print_default(2, Bill))
+                    MemberEmail.launch()
+                    return True
         return False
 
     class Meta(object):
         verbose_name = _('subscription')
         verbose_name_plural = _('subscription')
         ordering = ['-begin_date']
+        indexes = [
+            models.Index(fields=['season', 'status']),
+            models.Index(fields=['adherent', 'begin_date', 'end_date']),
+        ]
 
 
 class DocAdherent(LucteriosModel):
-    subscription = models.ForeignKey(Subscription, verbose_name=_('subscription'), null=False, default=None, db_index=True, on_delete=models.CASCADE)
+    subscription = models.ForeignKey(Subscription, verbose_name=_('subscription'), null=False, default=None, db_index=False, on_delete=models.CASCADE)
     document = models.ForeignKey(Document, verbose_name=_('document'), null=False, default=None, db_index=True, on_delete=models.CASCADE)
     value = models.BooleanField(verbose_name=_('value'), default=False)
 
@@ -1827,10 +2190,13 @@ class DocAdherent(LucteriosModel):
         verbose_name = _('document')
         verbose_name_plural = _('documents')
         default_permissions = []
+        indexes = [
+            models.Index(fields=['subscription', 'document']),
+        ]
 
 
 class License(LucteriosModel):
-    subscription = models.ForeignKey(Subscription, verbose_name=_('subscription'), null=False, default=None, db_index=True, on_delete=models.CASCADE)
+    subscription = models.ForeignKey(Subscription, verbose_name=_('subscription'), null=False, default=None, db_index=False, on_delete=models.CASCADE)
     value = models.CharField(_('license #'), max_length=50, null=True)
     team = models.ForeignKey(Team, verbose_name=_('team'), null=True, default=None, db_index=True, on_delete=models.PROTECT)
     activity = models.ForeignKey(Activity, verbose_name=_('activity'), null=False, default=None, db_index=True, on_delete=models.PROTECT)
@@ -1891,6 +2257,246 @@ class License(LucteriosModel):
         verbose_name_plural = _('involvements')
         ordering = ['team__name', 'activity__name']
         default_permissions = []
+        indexes = [
+            models.Index(fields=['subscription', 'team', 'activity']),
+        ]
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        MembershipSnapshot.refresh([self.subscription_id])
+
+    def delete(self, using=None):
+        subscription_id = self.subscription_id
+        LucteriosModel.delete(self, using=using)
+        MembershipSnapshot.refresh([subscription_id])
+
+
+class MembershipSnapshot(LucteriosModel):
+    subscription = models.OneToOneField(Subscription, verbose_name=_('subscription'), null=False, primary_key=True, on_delete=models.CASCADE, related_name='snapshot')
+    adherent = models.ForeignKey(Adherent, verbose_name=_('adherent'), null=False, db_index=False, on_delete=models.CASCADE)
+    season = models.ForeignKey(Season, verbose_name=_('season'), null=False, db_index=False, on_delete=models.CASCADE)
+    status = models.IntegerField(verbose_name=_('status'), choices=Subscription.LIST_STATUS, null=False, default=Subscription.STATUS_BUILDING)
+    begin_date = models.DateField(verbose_name=_('begin date'), null=False)
+    end_date = models.DateField(verbose_name=_('end date'), null=False)
+    duration = models.IntegerField(verbose_name=_('duration'), choices=SubscriptionType.LIST_DURATIONS, null=False, default=SubscriptionType.DURATION_ANNUALLY)
+    age_category = models.ForeignKey(Age, verbose_name=_("age category"), null=True, default=None, db_index=False, on_delete=models.SET_NULL)
+    family = models.ForeignKey(LegalEntity, verbose_name=_('family'), null=True, default=None, db_index=False, on_delete=models.SET_NULL)
+
+    def __str__(self):
+        return "%s: %s" % (self.adherent, self.subscription)
+
+    @classmethod
+    def get_involvement_query(cls, teams=None, activities=None):
+        if not teams and not activities:
+            return Q()
+        involvement_query = Q(snapshot_id=OuterRef('pk'))
+        if teams:
+            involvement_query &= Q(team_id__in=teams)
+        if activities:
+            involvement_query &= Q(activity_id__in=activities)
+        return Q(Exists(MembershipInvolvement.objects.filter(involvement_query)))
+
+    @classmethod
+    def get_adherent_exists(cls, query):
+        return Q(Exists(cls.objects.filter(Q(adherent_id=OuterRef('pk')) & query)))
+
+    @classmethod
+    def get_age_category_id(cls, reference_year, birthday):
+        # same ranges as Age.get_birthday_query, relative to the reference year of the season
+        if isinstance(birthday, date):
+            for age_id, minimum, maximum in Age.get_ranges():
+                if minimum <= (reference_year - birthday.year) <= maximum:
+                    return age_id
+        return None
+
+    @classmethod
+    def get_family_ids(cls, adherent_ids):
+        # same family as Adherent.get_family: the last responsability of the family type
+        family_ids = {}
+        family_type = Params.getobject("member-family-type")
+        if family_type is not None:
+            resp_query = Q(individual_id__in=adherent_ids) & Q(legal_entity__structure_type=family_type)
+            for individual_id, legal_entity_id in Responsability.objects.filter(resp_query).order_by('id').values_list('individual_id', 'legal_entity_id'):
+                family_ids[individual_id] = legal_entity_id
+        return family_ids
+
+    @classmethod
+    def refresh(cls, subscription_ids):
+        subscription_ids = list(subscription_ids)
+        subscription_values = list(Subscription.objects.filter(id__in=subscription_ids).order_by().values_list('id', 'adherent_id', 'season_id', 'season__designation', 'status', 'begin_date', 'end_date',
+                                                                                                             'subscriptiontype__duration', 'adherent__birthday'))
+        family_ids = cls.get_family_ids(set([values[1] for values in subscription_values]))
+        snapshots = []
+        for subscription_id, adherent_id, season_id, designation, status, begin_date, end_date, duration, birthday in subscription_values:
+            snapshots.append(cls(subscription_id=subscription_id, adherent_id=adherent_id, season_id=season_id, status=status, begin_date=begin_date, end_date=end_date,
+                                 duration=duration, age_category_id=cls.get_age_category_id(int(designation[:4]), birthday), family_id=family_ids.get(adherent_id)))
+        involvements = []
+        for subscription_id, team_id, activity_id in License.objects.filter(subscription_id__in=subscription_ids).order_by('id').values_list('subscription_id', 'team_id', 'activity_id'):
+            involvements.append(MembershipInvolvement(snapshot_id=subscription_id, team_id=team_id, activity_id=activity_id))
+        cls.objects.filter(subscription_id__in=subscription_ids).delete()
+        cls.objects.bulk_create(snapshots)
+        MembershipInvolvement.objects.bulk_create(involvements)
+        return len(snapshots)
+
+    @classmethod
+    def refresh_age_categories(cls):
+        for season_id, designation in Season.objects.filter(id__in=cls.objects.values('season_id')).values_list('id', 'designation'):
+            age_category = Adherent.objects.filter(id=OuterRef('adherent_id')).annotate(age_category_id=Age.get_category_case(date(int(designation[:4]), 1, 1))).values('age_category_id')[:1]
+            cls.objects.filter(season_id=season_id).update(age_category_id=Subquery(age_category))
+
+    @classmethod
+    def rebuild(cls, season=None):
+        if season is None:
+            cls.objects.all().delete()
+            season_ids = Season.objects.values_list('id', flat=True)
+        else:
+            season_ids = [season.id]
+        nb_snapshot = 0
+        for season_id in season_ids:
+            nb_snapshot += cls.refresh(Subscription.objects.filter(season_id=season_id).values_list('id', flat=True))
+        return nb_snapshot
+
+    class Meta(object):
+        verbose_name = _('membership snapshot')
+        verbose_name_plural = _('membership snapshots')
+        default_permissions = []
+        indexes = [
+            models.Index(fields=['adherent', 'begin_date', 'end_date']),
+            models.Index(fields=['season', 'status']),
+            models.Index(fields=['begin_date', 'end_date', 'status']),
+        ]
+
+
+class MembershipInvolvement(LucteriosModel):
+    snapshot = models.ForeignKey(MembershipSnapshot, verbose_name=_('membership snapshot'), null=False, db_index=False, on_delete=models.CASCADE, related_name='involvements')
+    team = models.ForeignKey(Team, verbose_name=_('team'), null=True, default=None, db_index=False, on_delete=models.CASCADE)
+    activity = models.ForeignKey(Activity, verbose_name=_('activity'), null=False, db_index=False, on_delete=models.CASCADE)
+
+    def __str__(self):
+        return "%s: %s %s" % (self.snapshot_id, self.team_id, self.activity_id)
+
+    class Meta(object):
+        verbose_name = _('involvement')
+        verbose_name_plural = _('involvements')
+        default_permissions = []
+        indexes = [
+            models.Index(fields=['snapshot', 'team', 'activity']),
+            models.Index(fields=['team', 'activity']),
+        ]
+
+
+def refresh_snapshot_family(sender, instance, **kwargs):
+    MembershipSnapshot.refresh(Subscription.objects.filter(adherent_id=instance.individual_id).values_list('id', flat=True))
+
+
+def refresh_snapshot_age_category(sender, **kwargs):
+    MembershipSnapshot.refresh_age_categories()
+
+
+post_save.connect(refresh_snapshot_family, sender=Responsability)
+post_delete.connect(refresh_snapshot_family, sender=Responsability)
+post_save.connect(refresh_snapshot_age_category, sender=Age)
+post_delete.connect(refresh_snapshot_age_category, sender=Age)
+
+
+class TaxReceiptLinkGraph(object):
+
+    def __init__(self):
+        self.entries = {}
+        self.entry_lines = {}
+        self.link_entries = {}
+        self.payoffs = {}
+        self.last_other_entries = {}
+        self.nextyear_lines = {}
+        self.cash_mask = re.compile(current_system_account().get_cash_mask())
+        self.third_mask = re.compile(current_system_account().get_third_mask())
+
+    def _load_lines(self, entry_ids):
+        new_links = set()
+        for entry_id in entry_ids:
+            self.entry_lines[entry_id] = []
+        for entryline in EntryLineAccount.objects.filter(entry_id__in=entry_ids).select_related('entry', 'account').order_by('id'):
+            self.entries[entryline.entry_id] = entryline.entry
+            self.entry_lines[entryline.entry_id].append(entryline)
+            if (entryline.link_id is not None) and (entryline.link_id not in self.link_entries):
+                new_links.add(entryline.link_id)
+        for payoff in Payoff.objects.filter(entry_id__in=entry_ids).order_by('id'):
+            self.payoffs.setdefault(payoff.entry_id, payoff)
+        return new_links
+
+    def _load_last_other_entry(self, year_id):
+        if year_id not in self.last_other_entries:
+            last_entry = EntryAccount.objects.filter(year_id=year_id, journal_id=Journal.DEFAULT_OTHER).order_by('num').last()
+            self.last_other_entries[year_id] = last_entry.id if last_entry is not None else None
+        return self.last_other_entries[year_id]
+
+    def _load_nextyear_lines(self, year_id):
+        if year_id not in self.nextyear_lines:
+            self.nextyear_lines[year_id] = {}
+            for entryline in EntryLineAccount.objects.filter(entry__year__last_fiscalyear_id=year_id, entry__journal_id=Journal.DEFAULT_LASTYEAR).select_related('account'):
+                self.nextyear_lines[year_id].setdefault((entryline.third_id, entryline.amount, entryline.account.code), entryline)
+        return self.nextyear_lines[year_id]
+
+    def load(self, entry_ids):
+        pending = set([entry_id for entry_id in entry_ids if entry_id not in self.entry_lines])
+        while len(pending) > 0:
+            new_links = self._load_lines(list(pending))
+            new_entries = set()
+            for entry_id in pending:
+                if (entry_id in self.entries) and (len(self.get_payoff_lines(entry_id)) == 0) and self.is_last_other_entry(entry_id):
+                    for entryline in self.entry_lines[entry_id]:
+                        nextyear_entryline = self.get_nextyear_line(entryline)
+                        if (nextyear_entryline is not None) and (nextyear_entryline.entry_id not in self.entry_lines):
+                            new_entries.add(nextyear_entryline.entry_id)
+            if len(new_links) > 0:
+                for link_id in new_links:
+                    self.link_entries[link_id] = []
+                for link_id, entry_id in EntryLineAccount.objects.filter(link_id__in=new_links).order_by().values_list('link_id', 'entry_id').distinct():
+                    self.link_entries[link_id].append(entry_id)
+                    if entry_id not in self.entry_lines:
+                        new_entries.add(entry_id)
+            pending = new_entries
+
+    def get_entry(self, entry_id):
+        return self.entries[entry_id]
+
+    def get_links(self, entry_ids):
+        links = []
+        for entry_id in entry_ids:
+            for entryline in self.entry_lines.get(entry_id, []):
+                if (entryline.link_id is not None) and (entryline.link_id not in links):
+                    links.append(entryline.link_id)
+        return links
+
+    def get_link_entries(self, link_id, exclude_ids):
+        entries = [self.entries[entry_id] for entry_id in self.link_entries.get(link_id, []) if (entry_id not in exclude_ids) and (entry_id in self.entries)]
+        return sorted(entries, key=lambda entry: (entry.date_value, entry.id))
+
+    def get_third_lines(self, entry_id):
+        return [entryline for entryline in self.entry_lines.get(entry_id, []) if self.third_mask.search(entryline.account.code) is not None]
+
+    def get_payoff_lines(self, entry_id):
+        payoff_lines = []
+        for entryline in self.entry_lines.get(entry_id, []):
+            if (self.cash_mask.search(entryline.account.code) is not None) or (entryline.account.type_of_account in (ChartsAccount.TYPE_EXPENSE, ChartsAccount.TYPE_REVENUE)):
+                payoff_lines.append(entryline)
+        return payoff_lines
+
+    def get_payoff(self, entry_id):
+        return self.payoffs.get(entry_id)
+
+    def is_last_other_entry(self, entry_id):
+        return self._load_last_other_entry(self.entries[entry_id].year_id) == entry_id
+
+    def get_link_line(self, entry_id, link_id):
+        for entryline in self.entry_lines.get(entry_id, []):
+            if entryline.link_id == link_id:
+                return entryline
+        return None
+
+    def get_nextyear_line(self, entryline):
+        nextyear_lines = self._load_nextyear_lines(self.entries[entryline.entry_id].year_id)
+        return nextyear_lines.get((entryline.third_id, -1 * entryline.amount, entryline.account.code))
 
 
 class TaxReceiptPayoffSet(QuerySet):
@@ -1904,12 +2510,13 @@ class TaxReceiptPayoffSet(QuerySet):
         self.taxreceipt = self._hints['taxreceipt'] if 'taxreceipt' in self._hints else None
         self.entry = self._hints['entry'] if 'entry' in self._hints else None
         self.current_third = self._hints['third'] if 'third' in self._hints else None
+        self.graph = self._hints['graph'] if 'graph' in self._hints else None
         self.exclude_bank_account_ids = Params.getvalue('member-tax-exclude-payoff')
 
     def _add_payoff(self, entryline):
         new_payoff = Payoff(date=entryline.entry.date_value, amount=entryline.amount, mode=Params.getvalue("member-tax-receipt-payoff"), payer=str(self.current_third))
         new_payoff.id = -10 * (len(self._result_cache) + 1)
-        old_payoff = entryline.entry.payoff_set.all().first()
+        old_payoff = self.graph.get_payoff(entryline.entry_id)
         if old_payoff is not None and old_payoff.bank_account_id in self.exclude_bank_account_ids:
             return 0
         if entryline.account.type_of_account == ChartsAccount.TYPE_EXPENSE:
@@ -1927,30 +2534,22 @@ class TaxReceiptPayoffSet(QuerySet):
         self._result_cache.append(new_payoff)
         return 1
 
-    def _fill_from_links(self, links, origin_entries):
-        origin_entries_id = [entry.id for entry in origin_entries]
+    def _fill_from_links(self, links, origin_entries_id):
         nb_line = 0
-        for link in links:
-            for entry_letter in EntryAccount.objects.filter(Q(entrylineaccount__link=link)).exclude(id__in=origin_entries_id).distinct():
+        for link_id in links:
+            for entry_letter in self.graph.get_link_entries(link_id, origin_entries_id):
                 if entry_letter.close is False:
                     self._result_cache = []
                     return False
-                entryline_query = Q(account__code__regex=current_system_account().get_cash_mask())
-                entryline_query |= Q(account__type_of_account=ChartsAccount.TYPE_EXPENSE)
-                entryline_query |= (Q(account__type_of_account=ChartsAccount.TYPE_REVENUE))
-                entryline_letter_list = entry_letter.entrylineaccount_set.filter(entryline_query)
+                entryline_letter_list = self.graph.get_payoff_lines(entry_letter.id)
                 if len(entryline_letter_list) > 0:
                     for entryline_letter in entryline_letter_list:
                         nb_line += self._add_payoff(entryline_letter)
-                elif entry_letter == entry_letter.year.entryaccount_set.filter(journal__id=Journal.DEFAULT_OTHER).order_by('num').last():
-                    entryline = entry_letter.entrylineaccount_set.filter(Q(link=link)).first()
-                    entryline_query = Q(entry__year__last_fiscalyear=entry_letter.year) & Q(entry__journal_id=Journal.DEFAULT_LASTYEAR)
-                    entryline_query &= Q(third=entryline.third)
-                    entryline_query &= Q(amount=-1 * entryline.amount)
-                    entryline_query &= Q(account__code=entryline.account.code)
-                    nextyear_entryline = EntryLineAccount.objects.filter(entryline_query).first()
-                    if (nextyear_entryline is not None) and (nextyear_entryline.link is not None):
-                        if self._fill_from_links([nextyear_entryline.link], origin_entries + [nextyear_entryline.entry]):
+                elif self.graph.is_last_other_entry(entry_letter.id):
+                    entryline = self.graph.get_link_line(entry_letter.id, link_id)
+                    nextyear_entryline = self.graph.get_nextyear_line(entryline)
+                    if (nextyear_entryline is not None) and (nextyear_entryline.link_id is not None):
+                        if self._fill_from_links([nextyear_entryline.link_id], origin_entries_id + [nextyear_entryline.entry_id]):
                             nb_line += 1
         if nb_line == 0:
             self._result_cache = []
@@ -1960,19 +2559,17 @@ class TaxReceiptPayoffSet(QuerySet):
     def _fetch_all(self):
         if self._result_cache is None:
             self._result_cache = []
-            links = []
-            entries = []
+            entries_id = []
             if self.taxreceipt is not None:
                 if self.current_third is None:
                     self.current_third = self.taxreceipt.third
-                entries = list(self.taxreceipt.entries.all())
+                entries_id = [entry.id for entry in self.taxreceipt.entries.all()]
             if self.entry is not None:
-                entries.append(self.entry)
-            for entry in entries:
-                for entryline in entry.entrylineaccount_set.all():
-                    if (entryline.link is not None) and (entryline.link not in links):
-                        links.append(entryline.link)
-            self._fill_from_links(links, entries)
+                entries_id.append(self.entry.id)
+            if self.graph is None:
+                self.graph = TaxReceiptLinkGraph()
+            self.graph.load(entries_id)
+            self._fill_from_links(self.graph.get_links(entries_id), entries_id)
 
     @property
     def last_date_payoff(self):
@@ -1984,6 +2581,8 @@ class TaxReceiptPayoffSet(QuerySet):
 
 
 class TaxReceipt(Supporting):
+    _render_local = threading.local()
+
     num = models.IntegerField(verbose_name=_('numeros'), null=True, default=None)
     fiscal_year = models.ForeignKey(FiscalYear, verbose_name=_('fiscal year'), null=False, db_index=True, on_delete=models.CASCADE)
     year = models.IntegerField(verbose_name=_('year'), null=False, unique_for_year=True)
@@ -2095,13 +2694,21 @@ class TaxReceipt(Supporting):
     def _extract_third_entries(cls, tax_receipt, year, current_third=None):
         third_entries = {}
         extract_query = Q(close=True) & Q(entrylineaccount__account__code__in=tax_receipt) & Q(taxreceipt=None)
-        for entry in EntryAccount.objects.filter(extract_query):
-            thirds = [third_line.third for third_line in entry.get_thirds() if third_line.link is not None]
+        entry_query = EntryAccount.objects.filter(extract_query)
+        if current_third is not None:
+            entry_query = entry_query.filter(entrylineaccount__third=current_third)
+        entry_ids = list(entry_query.order_by('date_value', 'id').values_list('id', flat=True).distinct())
+        graph = TaxReceiptLinkGraph()
+        graph.load(entry_ids)
+        thirds_cache = Third.objects.in_bulk(set([third_line.third_id for entry_id in entry_ids for third_line in graph.get_third_lines(entry_id) if third_line.third_id is not None]))
+        for entry_id in entry_ids:
+            entry = graph.get_entry(entry_id)
+            thirds = [thirds_cache.get(third_line.third_id) for third_line in graph.get_third_lines(entry_id) if third_line.link_id is not None]
             if (len(thirds) == 1) and (thirds[0] is not None):
                 third = thirds[0]
                 if (current_third is not None) and (current_third.id != third.id):
                     continue
-                date_payoff = TaxReceiptPayoffSet(hints={'entry': entry, 'third': third}).last_date_payoff
+                date_payoff = TaxReceiptPayoffSet(hints={'entry': entry, 'third': third, 'graph': graph}).last_date_payoff
                 if (date_payoff is not None) and (date_payoff.year == year):
                     if third.id not in third_entries:
                         third_entries[third.id] = {'third': third, 'entries': [], 'date': date_payoff}
@@ -2110,26 +2717,135 @@ class TaxReceipt(Supporting):
                     third_entries[third.id]['entries'].append(entry)
         return third_entries
 
+    @classmethod
+    def get_receipts_to_create(cls, year):
+        tax_receipt = Params.getvalue("member-tax-receipt")
+        if len(tax_receipt) == 0:
+            return []
+        third_entries = cls._extract_third_entries(tax_receipt, year)
+        return sorted(third_entries.values(), key=lambda item: str(item['third']))
+
+    @classmethod
+    def create_from_entries(cls, year, third, entries, date_payoff):
+        new_tax_receipt = cls.objects.create(year=year, third=third, date=timezone.now().date(),
+                                             fiscal_year=FiscalYear.get_current(date_payoff), num=None)
+        new_tax_receipt.entries.set(entries)
+        new_tax_receipt.save()
+        return new_tax_receipt
+
     @classmethod
     def create_all(cls, year):
         tax_receipt = Params.getvalue("member-tax-receipt")
         if len(tax_receipt) > 0:
             for taxitem in cls.objects.filter(Q(year=year), num__isnull=True):
                 taxitem.regenerate()
-            third_entries = cls._extract_third_entries(tax_receipt, year)
-            for receipt_info in sorted(third_entries.values(), key=lambda item: str(item['third'])):
-                new_tax_receipt = cls.objects.create(year=year, third=receipt_info['third'], date=timezone.now().date(),
-                                                     fiscal_year=FiscalYear.get_current(receipt_info['date']), num=None)
-                new_tax_receipt.entries.set(receipt_info['entries'])
-                new_tax_receipt.save()
+            for receipt_info in cls.get_receipts_to_create(year):
+                cls.create_from_entries(year, receipt_info['third'], receipt_info['entries'], receipt_info['date'])
+
+    def assign_num(self):
+        self.num = MemberSequence.allocate('taxreceipt-%d' % self.year)
+        self.save()
+        self.get_saved_pdfreport(False)
 
     @classmethod
-    def valid_all(cls, year):
-        for taxitem in cls.objects.filter(Q(year=year), num__isnull=True):
-            num_val = cls.objects.filter(Q(year=year)).aggregate(Max('num'))
-            taxitem.num = num_val['num__max'] + 1 if num_val['num__max'] is not None else 1
-            taxitem.save()
-            taxitem.get_saved_pdfreport(False)
+    def number_all(cls, year):
+        taxitem_ids = []
+        with transaction.atomic():
+            taxitems = list(cls.objects.filter(Q(year=year), num__isnull=True))
+            if len(taxitems) == 0:
+                return taxitem_ids
+            next_num = MemberSequence.allocate('taxreceipt-%d' % year, len(taxitems))
+            for taxitem in taxitems:
+                taxitem.num = next_num
+                taxitem.save()
+                taxitem_ids.append(taxitem.id)
+                next_num += 1
+        return taxitem_ids
+
+    def add_pdf_document(self, title, user, metadata, pdf_content):
+        if getattr(self, 'render_only', False):
+            return pdf_content
+        return Supporting.add_pdf_document(self, title, user, metadata, pdf_content)
+
+    def get_pdfreport_content(self):
+        self.render_only = True
+        try:
+            return self.generate_pdfreport()
+        finally:
+            self.render_only = False
+
+    @classmethod
+    def _log_render_failure(cls, failed_ids):
+        if len(failed_ids) > 0:
+            logging.getLogger('diacamma.member').error("Failure to render tax receipts %s", failed_ids)
+
+    @classmethod
+    def get_render_workers(cls):
+        return getattr(settings, 'DIACAMMA_MEMBER_PDF_WORKERS', 1)
+
+    @classmethod
+    @contextmanager
+    def render_pool(cls):
+        # each render worker is a spawned process running django.setup(): the pool is opened once for
+        # a whole job and only if DIACAMMA_MEMBER_PDF_WORKERS is raised
+        nb_workers = cls.get_render_workers()
+        if (nb_workers <= 1) or (getattr(cls._render_local, 'executor', None) is not None):
+            yield
+            return
+        from diacamma.member.workers import setup_worker
+        with ProcessPoolExecutor(max_workers=nb_workers, mp_context=multiprocessing.get_context('spawn'), initializer=setup_worker) as executor:
+            cls._render_local.executor = executor
+            try:
+                yield
+            finally:
+                cls._render_local.executor = None
+
+    @classmethod
+    def _render_in_pool(cls, taxitems):
+        from diacamma.member.workers import render_taxreceipt
+        pdf_contents = {}
+        try:
+            pdf_futures = {taxitem.id: cls._render_local.executor.submit(render_taxreceipt, taxitem.id) for taxitem in taxitems}
+            for taxitem_id, pdf_future in pdf_futures.items():
+                try:
+                    pdf_contents[taxitem_id] = pdf_future.result()
+                except Exception:
+                    logging.getLogger('diacamma.member').exception("Failure to render tax receipt #%d in worker" % taxitem_id)
+        except Exception:
+            logging.getLogger('diacamma.member').exception("Failure of tax receipt render workers")
+        return pdf_contents
+
+    @classmethod
+    def render_pdfreports(cls, taxitem_ids, user=None):
+        metadata_list = ['%s-%d' % (cls.__name__, taxitem_id) for taxitem_id in taxitem_ids]
+        existing_metadata = set(DocumentContainer.objects.filter(metadata__in=metadata_list).values_list('metadata', flat=True))
+        taxitems = [taxitem for taxitem in cls.objects.filter(id__in=taxitem_ids, num__isnull=False).order_by('id') if '%s-%d' % (cls.__name__, taxitem.id) not in existing_metadata]
+        pdf_contents = {}
+        if (len(taxitems) > 0) and (getattr(cls._render_local, 'executor', None) is not None):
+            # workers have their own connection and only see committed receipts: the others are rendered here
+            pdf_contents = cls._render_in_pool(taxitems)
+        failed_ids = []
+        for taxitem in taxitems:
+            taxitem.last_user = user
+            pdf_content = pdf_contents.get(taxitem.id)
+            if pdf_content is None:
+                document = taxitem.generate_pdfreport()
+            else:
+                try:
+                    document = taxitem.add_pdf_document(taxitem.get_document_filename(), user, '%s-%d' % (cls.__name__, taxitem.id), pdf_content)
+                except Exception:
+                    logging.getLogger('diacamma.member').exception("Failure to create '%s' report" % taxitem.get_document_filename())
+                    document = None
+            if document is None:
+                failed_ids.append(taxitem.id)
+        cls._log_render_failure(failed_ids)
+        return failed_ids
+
+    @classmethod
+    def valid_all(cls, year, user=None):
+        taxitem_ids = cls.number_all(year)
+        with cls.render_pool() if not transaction.get_connection().in_atomic_block else nullcontext():
+            return cls.render_pdfreports(taxitem_ids, user)
 
     def regenerate(self):
         tax_receipt = Params.getvalue("member-tax-receipt")
@@ -2156,12 +2872,589 @@ class TaxReceipt(Supporting):
         default_permissions = ['change']
 
 
+def get_or_create_customers(contact_ids):
+    # existing thirds read together, missing ones created by get_or_create_customer
+    thirds = dict([(third.contact_id, third) for third in Third.objects.filter(contact_id__in=contact_ids)])
+    for contact_id in contact_ids:
+        if (contact_id not in thirds) or (contact_id == 1):
+            thirds[contact_id] = get_or_create_customer(contact_id)
+    return thirds
+
+
+class BillSynchronizer(object):
+
+    def __init__(self, bill, subscription_list):
+        self.bill = bill
+        self.subscription_list = subscription_list
+        self.to_insert = []
+        self.to_update = []
+        self.to_delete = []
+        self.details = {}
+        self._computed = False
+
+    def compute(self):
+        existing = {}
+        for detail in self.bill.detail_set.all().order_by('id'):
+            existing.setdefault((detail.article_id, detail.designation), []).append(detail)
+        # automatic reduces depend on the lines recorded before: rebuild every line as before
+        keep_details = not AutomaticReduce.objects.exists()
+        for subscription in self.subscription_list:
+            subscription.bill = self.bill
+            self.details[subscription.id] = []
+            for article, designation in subscription._get_detail_bill():
+                same_details = existing.get((article.id, designation), [])
+                if keep_details and (len(same_details) > 0):
+                    detail = same_details.pop(0)
+                    changes = self._get_detail_changes(detail, article)
+                    if len(changes) > 0:
+                        self.to_update.append((detail, changes))
+                    self.details[subscription.id].append(detail)
+                else:
+                    self.to_insert.append((subscription.id, len(self.details[subscription.id]), article, designation))
+                    self.details[subscription.id].append(None)
+        for same_details in existing.values():
+            self.to_delete.extend(same_details)
+        self._computed = True
+
+    def _get_detail_changes(self, detail, article):
+        # values that Detail.create_for_bill gives to a new detail of this article
+        expected = Detail(bill=self.bill, article=article, price=article.price, unit=article.unit, quantity=1, reduce=0.0)
+        expected.editor.before_save(None)
+        changes = {}
+        for fieldname in ('price', 'quantity', 'vta_rate', 'reduce'):
+            if abs(float(getattr(detail, fieldname)) - float(getattr(expected, fieldname))) > 0.0001:
+                changes[fieldname] = getattr(expected, fieldname)
+        if detail.unit != expected.unit:
+            changes['unit'] = expected.unit
+        return changes
+
+    def get_changes(self):
+        if not self._computed:
+            self.compute()
+        return {'insert': len(self.to_insert), 'update': len(self.to_update), 'delete': len(self.to_delete)}
+
+    def apply(self):
+        if not self._computed:
+            self.compute()
+        if len(self.to_delete) > 0:
+            Detail.objects.filter(id__in=[detail.id for detail in self.to_delete]).delete()
+        for detail, changes in self.to_update:
+            for fieldname, value in changes.items():
+                setattr(detail, fieldname, value)
+            detail.save()
+        for subscription_id, detail_index, article, designation in self.to_insert:
+            self.details[subscription_id][detail_index] = Detail.create_for_bill(self.bill, article, designation=designation)
+
+
+class SubscriptionBatch(object):
+
+    def __init__(self, dateref, validate_bill=True):
+        self.dateref = dateref
+        self.validate_bill = validate_bill
+        self.commands = []
+        self.subscriptions = []
+        self.bills = []
+        self.errors = {}
+        self.adherents = {}
+        self._active_types = None
+        self._prestations = None
+        self._documents = {}
+
+    def get_active_type(self, subscriptiontype):
+        if subscriptiontype.state != SubscriptionType.STATE_UNACTIVATE:
+            return subscriptiontype
+        if self._active_types is None:
+            self._active_types = {}
+            for subtype in SubscriptionType.objects.exclude(state=SubscriptionType.STATE_UNACTIVATE).prefetch_related('articles'):
+                if subtype.duration not in self._active_types:
+                    self._active_types[subtype.duration] = subtype
+        if subscriptiontype.duration not in self._active_types:
+            raise LucteriosException(IMPORTANT, _('No subscription type active !'))
+        return self._active_types[subscriptiontype.duration]
+
+    def get_prestation(self, team_id, activity_id):
+        if self._prestations is None:
+            self._prestations = {}
+            for presta in Prestation.objects.select_related('team_prestation').order_by('-article__price'):
+                if presta.team_prestation is not None:
+                    presta_key = (presta.team_prestation.team_id, presta.team_prestation.activity_id)
+                    if presta_key not in self._prestations:
+                        self._prestations[presta_key] = presta
+        return self._prestations.get((team_id, activity_id))
+
+    def _load_adherents(self, adherent_ids, fieldnames):
+        for adherent in Adherent.objects.filter(id__in=adherent_ids).with_virtual_fields(fieldnames):
+            self.adherents[adherent.id] = adherent
+
+    def add(self, adherent, subscriptiontype, begin_date, prestations=None, licenses=None, reduce=0.0):
+        self.adherents[adherent.id] = adherent
+        self.commands.append({'adherent': adherent, 'type': subscriptiontype, 'begin_date': begin_date,
+                              'prestations': prestations if prestations is not None else [],
+                              'licenses': licenses if licenses is not None else [], 'reduce': reduce})
+
+    def add_renewals(self, adherents):
+        adherent_ids = [adherent.id for adherent in adherents]
+        self._load_adherents(adherent_ids, ['family', 'last_subscription'])
+        last_subscriptions = {}
+        for adherent_id in adherent_ids:
+            if self.adherents[adherent_id].last_subscription is not None:
+                last_subscriptions[self.adherents[adherent_id].last_subscription.id] = self.adherents[adherent_id].last_subscription
+        subtypes = SubscriptionType.objects.prefetch_related('articles').in_bulk([last_subscription.subscriptiontype_id for last_subscription in last_subscriptions.values()])
+        last_licenses = {}
+        for license_item in License.objects.filter(subscription_id__in=list(last_subscriptions.keys())):
+            last_licenses.setdefault(license_item.subscription_id, []).append(license_item)
+        team_enable = Params.getvalue("member-team-enable")
+        delaytorenew = Params.getvalue('member-subscription-delaytorenew')
+        for adherent_id in adherent_ids:
+            adherent = self.adherents[adherent_id]
+            last_subscription = adherent.last_subscription
+            if last_subscription is None:
+                continue
+            try:
+                new_subscriptiontype = self.get_active_type(subtypes[last_subscription.subscriptiontype_id])
+            except LucteriosException as lct_error:
+                self.errors[adherent_id] = str(lct_error)
+                continue
+            begin_date = max(self.dateref, last_subscription.end_date + timedelta(days=1))
+            if new_subscriptiontype.duration == SubscriptionType.DURATION_CALENDAR:
+                new_begin_date = last_subscription.end_date + timedelta(days=1)
+                if (self.dateref - new_begin_date).days < delaytorenew:
+                    begin_date = new_begin_date
+            prestations = []
+            licenses = []
+            for license_item in last_licenses.get(last_subscription.id, []):
+                if team_enable == 2:
+                    presta = self.get_prestation(license_item.team_id, license_item.activity_id)
+                    if presta is not None:
+                        prestations.append(presta)
+                else:
+                    licenses.append((license_item.team_id, license_item.activity_id, license_item.value))
+            self.add(adherent, new_subscriptiontype, begin_date, prestations, licenses)
+
+    def add_commands(self, commands):
+        self._load_adherents([content_item["adherent"] for content_item in commands], ['family'])
+        subtypes = SubscriptionType.objects.prefetch_related('articles').in_bulk([content_item["type"] for content_item in commands])
+        prestation_ids = []
+        for content_item in commands:
+            prestation_ids.extend(content_item["prestations"])
+        prestations = Prestation.objects.select_related('team_prestation').in_bulk(prestation_ids)
+        for content_item in commands:
+            teams = content_item["team"]
+            activities = content_item["activity"]
+            licences = content_item["licence"]
+            licenses = []
+            for license_id in range(max(len(teams), len(activities), len(licences))):
+                licenses.append((teams[license_id] if license_id < len(teams) else None,
+                                 activities[license_id] if license_id < len(activities) else 0,
+                                 licences[license_id] if license_id < len(licences) else ''))
+            self.add(self.adherents[int(content_item["adherent"])], subtypes[int(content_item["type"])], self.dateref,
+                     [prestations[int(presta_id)] for presta_id in content_item["prestations"] if int(presta_id) in prestations], licenses, content_item["reduce"])
+
+    def get_errors(self):
+        errors = []
+        for adherent_id, error in self.errors.items():
+            if (len(self.adherents) > 1) and (adherent_id in self.adherents):
+                errors.append("%s: %s" % (self.adherents[adherent_id], error))
+            else:
+                errors.append(error)
+        return errors
+
+    def get_errors_text(self):
+        return "{[br/]}".join(self.get_errors())
+
+    def _get_documents(self, season):
+        if season.id not in self._documents:
+            self._documents[season.id] = list(season.document_set.all())
+        return self._documents[season.id]
+
+    def _create_subscriptions(self):
+        used_dates = Subscription.get_used_dates([command['adherent'].id for command in self.commands])
+        team_enable = Params.getvalue("member-team-enable")
+        docs = []
+        licenses = []
+        prestations = []
+        new_subscriptions = []
+        for command in self.commands:
+            adherent = command['adherent']
+            new_subscription = Subscription(adherent=adherent, subscriptiontype=command['type'], status=Subscription.STATUS_BUILDING)
+            try:
+                new_subscription.set_periode(command['begin_date'])
+                new_subscription.check_used_dates(used_dates.setdefault(adherent.id, []))
+            except LucteriosException as lct_error:
+                self.errors[adherent.id] = str(lct_error)
+                continue
+            # Subscription.save is skipped, its side effects are done here for the whole batch:
+            # used dates checked above, documents, prestations with their licences and snapshots below,
+            # bill built per customer by _generate_bill
+            LucteriosModel.save(new_subscription)
+            used_dates[adherent.id].append((new_subscription.id, new_subscription.season_id, new_subscription.subscriptiontype.duration, new_subscription.begin_date, new_subscription.end_date))
+            docs.extend(new_subscription.get_new_documents(self._get_documents(new_subscription.season)))
+            if team_enable == 2:
+                for presta in command['prestations']:
+                    prestations.append(Subscription.prestations.through(subscription_id=new_subscription.id, prestation_id=presta.id))
+                licenses.extend(new_subscription.get_prestation_licenses(command['prestations']))
+            else:
+                for team_id, activity_id, value in command['licenses']:
+                    licenses.append(License(subscription=new_subscription, team_id=team_id, activity_id=activity_id, value=value))
+            new_subscriptions.append((new_subscription, command))
+        bulk_create_with_signals(DocAdherent, docs)
+        bulk_create_with_signals(License, licenses)
+        Subscription.prestations.through.objects.bulk_create(prestations)
+        MembershipSnapshot.refresh([new_subscription.id for new_subscription, _command in new_subscriptions])
+        return new_subscriptions
+
+    def _generate_bill(self, third, group):
+        last_subscription = group[-1][0]
+        last_subscription._search_or_create_bill([Bill.BILLTYPE_QUOTATION, Bill.BILLTYPE_ORDER], third=third)
+        new_bill = last_subscription.bill
+        new_ids = [new_subscription.id for new_subscription, _command in group]
+        Subscription.objects.filter(id__in=new_ids).update(bill=new_bill)
+        subscription_list = list(new_bill.subscription_set.exclude(id__in=new_ids))
+        for new_subscription, _command in group:
+            new_subscription.bill = new_bill
+            subscription_list.append(new_subscription)
+        details = last_subscription._regenerate_bill(Bill.BILLTYPE_QUOTATION, subscription_list)
+        for new_subscription, command in group:
+            if (float(command['reduce']) != 0.0) and (len(details[new_subscription.id]) > 0):
+                details[new_subscription.id][-1].reduce = command['reduce']
+                details[new_subscription.id][-1].save()
+        if self.validate_bill:
+            _validate_bill(new_bill)
+        return new_bill
+
+    def run(self):
+        with transaction.atomic():
+            billed = []
+            for new_subscription, command in self._create_subscriptions():
+                self.subscriptions.append(new_subscription)
+                if (len(new_subscription.subscriptiontype.articles.all()) > 0) or (len(command['prestations']) > 0):
+                    billed.append((new_subscription, command))
+            ref_contact_ids = FamilyDirectory.get_ref_contact_ids([new_subscription.adherent_id for new_subscription, _command in billed])
+            customers = get_or_create_customers(list(set(ref_contact_ids.values())))
+            groups = {}
+            for new_subscription, command in billed:
+                groups.setdefault(ref_contact_ids[new_subscription.adherent_id], []).append((new_subscription, command))
+            for ref_contact_id, group in groups.items():
+                try:
+                    with transaction.atomic():
+                        self.bills.append(self._generate_bill(customers[ref_contact_id], group))
+                except LucteriosException as lct_error:
+                    Subscription.objects.filter(id__in=[new_subscription.id for new_subscription, _command in group]).delete()
+                    for new_subscription, _command in group:
+                        self.subscriptions.remove(new_subscription)
+                        self.errors[new_subscription.adherent_id] = str(lct_error)
+
+
+class AdherentImportBatch(object):
+
+    NUM_BLOCK = getattr(settings, 'DIACAMMA_MEMBER_IMPORT_NUM_BLOCK', 50)
+
+    def __init__(self):
+        self.rows = []
+        self.subscription_ids = []
+        self._next_num = None
+        self._last_num = None
+        self._families = None
+        self._subscriptiontypes = None
+        self._current_season = None
+        self._periods = None
+        self._teams = None
+        self._activities = None
+        self._default_activity = None
+        self._prestations = None
+
+    @classmethod
+    def _get_key(cls, name):
+        return name.strip().lower() if name is not None else ''
+
+    def get_family(self, family_name, adherent):
+        family_type = Params.getobject("member-family-type")
+        if family_type is None:
+            raise LucteriosException(IMPORTANT, _('No family type!'))
+        if self._families is None:
+            self._families = {}
+            for legal_entity in LegalEntity.objects.filter(structure_type=family_type).order_by('id'):
+                self._families.setdefault(self._get_key(legal_entity.name), legal_entity)
+        family_key = self._get_key(family_name)
+        if family_key not in self._families:
+            family = LegalEntity()
+            for fieldname, fieldvalue in adherent.get_default_family_value(False).items():
+                setattr(family, fieldname, fieldvalue)
+            family.name = family_name
+            family.structure_type = family_type
+            self._families[family_key] = family
+        return self._families[family_key]
+
+    def get_subscriptiontype(self, type_name):
+        if self._subscriptiontypes is None:
+            self._subscriptiontypes = {}
+            for subtype in SubscriptionType.objects.all().prefetch_related('articles'):
+                self._subscriptiontypes.setdefault(self._get_key(subtype.name), subtype)
+        return self._subscriptiontypes.get(self._get_key(type_name))
+
+    def get_current_season(self):
+        if self._current_season is None:
+            self._current_season = Season.current_season()
+        return self._current_season
+
+    def get_periods(self):
+        if self._periods is None:
+            self._periods = list(self.get_current_season().period_set.all())
+        return self._periods
+
+    def get_team(self, team_name):
+        if self._teams is None:
+            self._teams = {}
+            for team in Team.objects.all():
+                self._teams.setdefault(self._get_key(team.name), []).append(team)
+        teams = self._teams.get(self._get_key(team_name), [])
+        return teams[0] if len(teams) == 1 else None
+
+    def get_activity(self, activity_name):
+        if self._activities is None:
+            self._activities = {}
+            for activity in Activity.objects.all():
+                self._activities.setdefault(self._get_key(activity.name), []).append(activity)
+        activities = self._activities.get(self._get_key(activity_name), [])
+        return activities[0] if len(activities) == 1 else None
+
+    def get_default_activity(self):
+        if self._default_activity is None:
+            self._default_activity = Activity.get_all().first()
+        return self._default_activity
+
+    def get_prestation(self, team_name, price_name=None):
+        if self._prestations is None:
+            self._prestations = {}
+            for presta in Prestation.objects.filter(team_prestation__isnull=False).select_related('team_prestation__team', 'article'):
+                team_key = self._get_key(presta.team_prestation.team.name)
+                self._prestations.setdefault((team_key, None), presta)
+                self._prestations.setdefault((team_key, self._get_key(presta.name)), presta)
+        return self._prestations.get((self._get_key(team_name), self._get_key(price_name) if price_name is not None else None))
+
+    def allocate_num(self):
+        if (self._next_num is None) or (self._next_num > self._last_num):
+            self._next_num = MemberSequence.allocate('adherent', self.NUM_BLOCK)
+            self._last_num = self._next_num + self.NUM_BLOCK - 1
+        new_num = self._next_num
+        self._next_num += 1
+        return new_num
+
+    def release_nums(self):
+        if (self._next_num is not None) and (self._next_num <= self._last_num):
+            MemberSequence.release('adherent', self._next_num, self._last_num)
+        self._next_num = None
+        self._last_num = None
+
+    def add_subscription(self, subscription):
+        if subscription.id not in self.subscription_ids:
+            self.subscription_ids.append(subscription.id)
+
+    def _check_subscription(self, type_name, dateformat, is_building, import_logs):
+        current_season = self.get_current_season()
+        type_option = 0
+        if '#' in type_name:
+            type_name, type_option = type_name.split('#')
+        try:
+            type_obj = self.get_subscriptiontype(type_name)
+            if type_obj is None:
+                import_logs.append(_("subscription type '%s' unknown !") % type_name)
+                return None
+            if type_obj.duration == SubscriptionType.DURATION_PERIODIC:
+                period = self.get_periods()[int(type_option) - 1]
+                begin_date = period.begin_date
+                end_date = period.end_date
+            elif type_obj.duration == SubscriptionType.DURATION_MONTLY:
+                mounths = current_season.get_months()
+                begin_date = convert_date(mounths[int(type_option) - 1][0] + '-01')
+                end_date = same_day_months_after(begin_date, 1) - timedelta(days=1)
+            elif type_obj.duration == SubscriptionType.DURATION_CALENDAR:
+                try:
+                    begin_date = datetime.strptime(type_option, dateformat).date()
+                except (TypeError, ValueError):
+                    begin_date = date.today()
+                end_date = same_day_months_after(begin_date, 12) - timedelta(days=1)
+            else:
+                begin_date = current_season.begin_date
+                end_date = current_season.end_date
+        except Exception as import_error:
+            import_logs.append(str(import_error))
+            logging.getLogger('diacamma.member').exception("import_data")
+            return None
+        return {'type': type_obj, 'begin_date': begin_date, 'end_date': end_date,
+                'status': Subscription.STATUS_BUILDING if is_building else Subscription.STATUS_VALID}
+
+    def _check_licence(self, row, rowdata, import_logs):
+        if ('prestations' in rowdata) and (rowdata['prestations'].strip() != ''):
+            row['prestations'] = []
+            for prestation_name in rowdata['prestations'].replace(',', ';').split(';'):
+                if '|' in prestation_name:
+                    prestation_name, price_name = prestation_name.split('|')
+                    new_prestation = self.get_prestation(prestation_name, price_name)
+                else:
+                    new_prestation = self.get_prestation(prestation_name)
+                if new_prestation is not None:
+                    row['prestations'].append(new_prestation)
+                elif prestation_name.strip() != '':
+                    import_logs.append(_("Prestation '%s' unknown !") % prestation_name.strip())
+        else:
+            row['team'] = self.get_team(rowdata.get('team'))
+            if (row['team'] is None) and ('team' in rowdata) and (rowdata['team'].strip() != ''):
+                import_logs.append(_("%(name)s '%(value)s' unknown !") % {'name': Params.getvalue("member-team-text"), 'value': rowdata['team'].strip()})
+            row['activity'] = self.get_activity(rowdata.get('activity'))
+            if row['activity'] is None:
+                row['activity'] = self.get_default_activity()
+                if ('activity' in rowdata) and (rowdata['activity'].strip() != ''):
+                    import_logs.append(_("%(name)s '%(value)s' unknown !") % {'name': Params.getvalue("member-activite-text"), 'value': rowdata['activity'].strip()})
+            row['value'] = rowdata.get('value', '')
+
+    def add_row(self, adherent, rowdata, dateformat):
+        import_logs = []
+        row = {'adherent': adherent, 'family': None, 'subscription': None, 'with_type': 'subscriptiontype' in rowdata.keys(),
+               'prestations': None, 'team': None, 'activity': None, 'value': ''}
+        if ('family' in rowdata.keys()) and (rowdata['family'].strip() != ''):
+            row['family'] = self.get_family(rowdata['family'].strip(), adherent)
+        if ('subscriptiontype' in rowdata.keys()) and (rowdata['subscriptiontype'].strip() != ''):
+            row['subscription'] = self._check_subscription(rowdata['subscriptiontype'].strip(), dateformat, 'prestations' in rowdata, import_logs)
+        self._check_licence(row, rowdata, import_logs)
+        self.rows.append(row)
+        return import_logs
+
+    def _write_families(self, adherents):
+        families = {adherent_id: adherent.family for adherent_id, adherent in adherents.items()}
+        responsabilities = []
+        for row in self.rows:
+            family = row['family']
+            if (family is None) or (families[row['adherent'].id] == family):
+                continue
+            if family.id is None:
+                family.save()
+            responsabilities.append(Responsability(individual_id=row['adherent'].id, legal_entity=family))
+            families[row['adherent'].id] = family
+        bulk_create_with_signals(Responsability, responsabilities)
+
+    def _write_subscriptions(self, adherents, import_logs):
+        current_season = self.get_current_season()
+        subscriptions = {}
+        for subscription in Subscription.objects.filter(adherent_id__in=list(adherents.keys()), season=current_season):
+            subscriptions[(subscription.adherent_id, subscription.subscriptiontype_id, subscription.begin_date, subscription.end_date)] = subscription
+        used_dates = Subscription.get_used_dates(list(adherents.keys()))
+        documents = list(current_season.document_set.all())
+        docs = []
+        new_ids = set()
+        for row in self.rows:
+            adherent = adherents[row['adherent'].id]
+            values = row['subscription']
+            row['working_subscription'] = adherent.last_subscription if values is None else None
+            if values is None:
+                continue
+            subscription_key = (adherent.id, values['type'].id, values['begin_date'], values['end_date'])
+            if subscription_key not in subscriptions:
+                new_subscription = Subscription(adherent=adherent, season=current_season, subscriptiontype=values['type'],
+                                                begin_date=values['begin_date'], end_date=values['end_date'], status=values['status'])
+                try:
+                    new_subscription.check_used_dates(used_dates.setdefault(adherent.id, []))
+                except LucteriosException as lct_error:
+                    import_logs.append(str(lct_error))
+                    continue
+                # Subscription.save is skipped, its side effects are done for the whole import:
+                # used dates checked above, documents here, licences and prestations in _write_licenses,
+                # snapshots in write and bills by generate_bills
+                LucteriosModel.save(new_subscription)
+                used_dates[adherent.id].append((new_subscription.id, current_season.id, values['type'].duration, new_subscription.begin_date, new_subscription.end_date))
+                docs.extend(new_subscription.get_new_documents(documents))
+                new_ids.add(new_subscription.id)
+                subscriptions[subscription_key] = new_subscription
+            row['working_subscription'] = subscriptions[subscription_key]
+        bulk_create_with_signals(DocAdherent, docs)
+        return new_ids
+
+    def _write_licenses(self, new_ids):
+        team_enable = Params.getvalue("member-team-enable")
+        rows = [row for row in self.rows if row['working_subscription'] is not None]
+        old_ids = [row['working_subscription'].id for row in rows if row['working_subscription'].id not in new_ids]
+        with_prestations = set(Subscription.prestations.through.objects.filter(subscription_id__in=old_ids).values_list('subscription_id', flat=True))
+        prestations = {}
+        licenses = []
+        for row in rows:
+            subscription = row['working_subscription']
+            # what convert_prestations does to a new subscription: licences of a building one come from its prestations
+            from_prestations = (team_enable == 2) and (subscription.id in new_ids) and (subscription.status == Subscription.STATUS_BUILDING)
+            if row['prestations'] is not None:
+                for presta in row['prestations']:
+                    prestations[(subscription.id, presta.id)] = Subscription.prestations.through(subscription_id=subscription.id, prestation_id=presta.id)
+                if from_prestations:
+                    licenses.extend(subscription.get_prestation_licenses(row['prestations']))
+            elif not from_prestations and (subscription.id not in with_prestations) and (row['with_type'] or (row['team'] is not None) or (row['value'] != '')):
+                licenses.append(License(subscription=subscription, team=row['team'], activity=row['activity'], value=row['value']))
+        Subscription.prestations.through.objects.filter(subscription_id__in=[row['working_subscription'].id for row in rows if row['prestations'] is not None]).delete()
+        Subscription.prestations.through.objects.bulk_create(list(prestations.values()))
+        bulk_create_with_signals(License, licenses)
+        if team_enable == 2:
+            for subscription in Subscription.objects.filter(id__in=old_ids):
+                subscription.convert_prestations()
+
+    def write(self):
+        import_logs = []
+        with transaction.atomic():
+            adherents = {}
+            for adherent in Adherent.objects.filter(id__in=[row['adherent'].id for row in self.rows]).with_virtual_fields(['family', 'last_subscription']):
+                adherents[adherent.id] = adherent
+            self._write_families(adherents)
+            new_ids = self._write_subscriptions(adherents, import_logs)
+            self._write_licenses(new_ids)
+            for row in self.rows:
+                if row['working_subscription'] is not None:
+                    self.add_subscription(row['working_subscription'])
+            MembershipSnapshot.refresh(self.subscription_ids)
+        self.rows = []
+        import_logs.extend(self.generate_bills())
+        return import_logs
+
+    def _generate_bill(self, group, bill_types):
+        last_subscription = group[-1]
+        last_subscription._search_or_create_bill(bill_types)
+        new_bill = last_subscription.bill
+        new_ids = [subscription.id for subscription in group]
+        Subscription.objects.filter(id__in=new_ids).update(bill=new_bill)
+        subscription_list = list(new_bill.subscription_set.exclude(id__in=new_ids))
+        for subscription in group:
+            subscription.bill = new_bill
+            subscription_list.append(subscription)
+        last_subscription._regenerate_bill(bill_types[0], subscription_list)
+
+    def generate_bills(self):
+        import_logs = []
+        subscriptions = Subscription.objects.select_related('adherent', 'season', 'subscriptiontype').prefetch_related('subscriptiontype__articles', 'prestations').in_bulk(self.subscription_ids)
+        groups = {}
+        for subscription_id in self.subscription_ids:
+            subscription = subscriptions[subscription_id]
+            try:
+                if (subscription.bill_id is None) and (subscription.status in (Subscription.STATUS_BUILDING, Subscription.STATUS_VALID)):
+                    if (len(subscription.subscriptiontype.articles.all()) > 0) or (len(subscription.prestations.all()) > 0):
+                        bill_types = (Bill.BILLTYPE_QUOTATION, Bill.BILLTYPE_ORDER) if subscription.status == Subscription.STATUS_BUILDING else (Bill.BILLTYPE_BILL,)
+                        groups.setdefault((subscription.adherent.get_ref_contact().id, bill_types), []).append(subscription)
+                else:
+                    with transaction.atomic():
+                        subscription.save(with_bill=True)
+            except LucteriosException as lct_error:
+                import_logs.append(str(lct_error))
+        for (_contact_id, bill_types), group in groups.items():
+            try:
+                with transaction.atomic():
+                    self._generate_bill(group, list(bill_types))
+            except LucteriosException as lct_error:
+                import_logs.append(str(lct_error))
+        return import_logs
+
+
 class CommandManager(object):
 
     def __init__(self, user, file_name, items):
         self.username = user.username if (user.username != '') else 'anonymous'
         self.file_name = file_name
         self.commands = []
+        self.errors = ''
         self.items = items
         self.read()
 
@@ -2184,21 +3477,15 @@ class CommandManager(object):
         return fields
 
     def read(self):
-        import json
         if (self.file_name != '') and isfile(self.file_name):
             with open(self.file_name) as data_file:
                 self.commands = json.load(data_file)
         elif self.items is not None:
+            renewal = SubscriptionBatch(None)
             for item in self.items:
                 cmd_value = {}
                 cmd_value["adherent"] = item.id
-                if item.last_subscription.subscriptiontype.state != SubscriptionType.STATE_UNACTIVATE:
-                    cmd_value["type"] = item.last_subscription.subscriptiontype.id
-                else:
-                    subtypes = SubscriptionType.objects.filter(duration=item.last_subscription.subscriptiontype.duration).exclude(state=SubscriptionType.STATE_UNACTIVATE)
-                    if subtypes.count() == 0:
-                        raise LucteriosException(IMPORTANT, _('No subscription type active !'))
-                    cmd_value["type"] = subtypes.first().id
+                cmd_value["type"] = renewal.get_active_type(item.last_subscription.subscriptiontype).id
                 team = []
                 activity = []
                 licence = []
@@ -2207,10 +3494,9 @@ class CommandManager(object):
                     if (Params.getvalue("member-team-enable") == 2):
                         if lic.team.unactive:
                             continue
-                        pesta = Prestation.objects.filter(team_prestation__team_id=lic.team_id,
-                                                          team_prestation__activity_id=lic.activity_id).order_by('-article__price')
-                        if pesta.count() > 0:
-                            prestations.append(pesta[0].id)
+                        pesta = renewal.get_prestation(lic.team_id, lic.activity_id)
+                        if pesta is not None:
+                            prestations.append(pesta.id)
                     else:
                         team.append(lic.team.id)
                         activity.append(lic.activity.id)
@@ -2224,7 +3510,6 @@ class CommandManager(object):
             self.write()
 
     def write(self):
-        import json
         self.file_name = join(get_tmp_dir(), 'list-%s.cmd' % self.username)
         if isfile(self.file_name):
             unlink(self.file_name)
@@ -2282,55 +3567,669 @@ class CommandManager(object):
             self.commands.remove(cmd_to_del)
             self.write()
 
-    def create_subscription(self, dateref, sendemail=None):
-        nb_sub = 0
+    @classmethod
+    def run_commands(cls, commands, dateref, sendemail=None):
         nb_bill = 0
-        bill_list = []
-        for content_item in self.commands:
-            new_subscription = Subscription(adherent_id=content_item["adherent"], subscriptiontype_id=content_item["type"], status=Subscription.STATUS_BUILDING)
-            new_subscription.set_periode(dateref)
-            if (Params.getvalue("member-team-enable") == 2):
-                new_subscription.save(with_bill=False)
-                new_subscription.prestations.set(Prestation.objects.filter(id__in=content_item["prestations"]))
-                new_subscription.save(with_bill=True)
-            else:
-                new_subscription.save()
-                teams = content_item["team"]
-                activities = content_item["activity"]
-                licences = content_item["licence"]
-                for license_id in range(max(len(teams), len(activities), len(licences))):
-                    license_item = License()
-                    license_item.subscription = new_subscription
-                    try:
-                        license_item.value = licences[license_id]
-                    except Exception:
-                        license_item.value = ''
-                    try:
-                        license_item.team_id = teams[license_id]
-                    except Exception:
-                        license_item.team_id = None
-                    try:
-                        license_item.activity_id = activities[license_id]
-                    except Exception:
-                        license_item.activity_id = 0
-                    license_item.save()
-            nb_sub += 1
-            if new_subscription.bill is not None:
-                details = new_subscription.bill.detail_set.all().order_by('-id')
-                if len(details) > 0:
-                    details[0].reduce = content_item["reduce"]
-                    details[0].save()
-                    bill_list.append(new_subscription.bill)
+        renewal = SubscriptionBatch(dateref, validate_bill=(sendemail is not None))
+        renewal.add_commands(commands)
+        renewal.run()
         if sendemail is not None:
-            for subscription_bill in set(bill_list):
-                _validate_bill(subscription_bill)
-                if subscription_bill.third.contact.email != '':
+            mail_send = will_mail_send()
+            for subscription_bill in renewal.bills:
+                if mail_send and (subscription_bill.third.contact.email != ''):
                     subscription_message = toHtml(Params.getvalue("member-subscription-message").replace('\n', '<br/>'))
                     if subscription_bill.payoff_have_payment() and (len(PaymentMethod.objects.all()) > 0):
                         subscription_message += get_html_payment(sendemail[0], sendemail[1], subscription_bill)
-                    subscription_bill.send_email(_('New subscription'), "<html>%s</html>" % subscription_message, PrintModel.get_print_default(2, subscription_bill))
+                    MemberEmail.enqueue_bill(subscription_bill, _('New subscription'), "<html>%s</html>" % subscription_message, PrintModel.get_print_default(2, subscription_bill))
                 nb_bill += 1
-        return (nb_sub, nb_bill)
+            if mail_send:
+                MemberEmail.launch()
+        return renewal, nb_bill
+
+    def create_subscription(self, dateref, sendemail=None):
+        renewal, nb_bill = self.run_commands(self.commands, dateref, sendemail)
+        if (len(renewal.subscriptions) == 0) and (len(renewal.errors) > 0):
+            raise LucteriosException(IMPORTANT, renewal.get_errors_text())
+        self.errors = renewal.get_errors_text()
+        return (len(renewal.subscriptions), nb_bill)
+
+
+class MemberSequence(LucteriosModel):
+    name = models.CharField(_('name'), max_length=50, unique=True)
+    value = models.IntegerField(_('value'), null=False, default=0)
+
+    def __str__(self):
+        return "%s=%d" % (self.name, self.value)
+
+    @classmethod
+    def get_current_max(cls, name):
+        if name == 'adherent':
+            num_query = Adherent.objects.all()
+        elif name.startswith('taxreceipt-'):
+            num_query = TaxReceipt.objects.filter(year=int(name[len('taxreceipt-'):]))
+        else:
+            return 0
+        num_val = num_query.aggregate(Max('num'))
+        return num_val['num__max'] if num_val['num__max'] is not None else 0
+
+    @classmethod
+    def allocate(cls, name, count=1):
+        with transaction.atomic():
+            sequence = cls.objects.select_for_update().filter(name=name).first()
+            if sequence is None:
+                try:
+                    with transaction.atomic():
+                        sequence = cls.objects.create(name=name, value=cls.get_current_max(name))
+                except IntegrityError:
+                    sequence = cls.objects.select_for_update().get(name=name)
+            first_value = sequence.value + 1
+            cls.objects.filter(id=sequence.id).update(value=sequence.value + count)
+        return first_value
+
+    @classmethod
+    def release(cls, name, first_value, last_value):
+        return cls.objects.filter(name=name, value=last_value).update(value=first_value - 1) > 0
+
+    @classmethod
+    def repair(cls):
+        names = set(['adherent'])
+        names.update(['taxreceipt-%d' % year for year in TaxReceipt.objects.values_list('year', flat=True).distinct()])
+        names.update(cls.objects.values_list('name', flat=True))
+        for name in names:
+            cls.objects.update_or_create(name=name, defaults={'value': cls.get_current_max(name)})
+        return sorted(names)
+
+    class Meta(object):
+        verbose_name = _('sequence')
+        verbose_name_plural = _('sequences')
+        default_permissions = []
+
+
+class MemberJob(LucteriosModel):
+    STATUS_WAITING = 0
+    STATUS_RUNNING = 1
+    STATUS_FINISHED = 2
+    STATUS_FAILURE = 3
+    LIST_STATUS = ((STATUS_WAITING, _('waiting')), (STATUS_RUNNING, _('running')), (STATUS_FINISHED, _('finished')), (STATUS_FAILURE, _('failure')))
+
+    CHUNK_SIZE = 50
+    SYNC_LIMIT = getattr(settings, 'DIACAMMA_MEMBER_JOB_SYNC_LIMIT', 100)
+    STALE_DELAY = 15
+
+    KINDS = {}
+
+    kind = models.CharField(_('kind'), max_length=50)
+    params = models.TextField(_('parameters'), default='{}')
+    items = models.TextField(_('items'), default='[]')
+    state = models.TextField(_('state'), default='{}')
+    status = models.IntegerField(verbose_name=_('status'), choices=LIST_STATUS, null=False, default=STATUS_WAITING, db_index=True)
+    total = models.IntegerField(verbose_name=_('total'), default=0)
+    done = models.IntegerField(verbose_name=_('done'), default=0)
+    user = models.ForeignKey(LucteriosUser, verbose_name=_('user'), null=True, on_delete=models.SET_NULL)
+    creation_date = models.DateTimeField(verbose_name=_('creation date'), auto_now_add=True)
+    last_update = models.DateTimeField(verbose_name=_('last update'), auto_now=True)
+
+    def __str__(self):
+        return "%s #%d" % (self.kind, self.id)
+
+    @classmethod
+    def register(cls, kind_class):
+        cls.KINDS[kind_class.kind] = kind_class
+        return kind_class
+
+    @classmethod
+    def submit(cls, kind, params, user=None):
+        kind_class = cls.KINDS[kind]
+        items = kind_class.get_items(params)
+        return cls.objects.create(kind=kind, params=json.dumps(params), items=json.dumps(items), state=json.dumps(kind_class.get_initial_state(params)),
+                                  total=len(items), user_id=user.id if (user is not None) and user.is_authenticated else None)
+
+    def get_params(self):
+        return json.loads(self.params)
+
+    def get_items(self):
+        return json.loads(self.items)
+
+    def get_state(self):
+        return json.loads(self.state)
+
+    @property
+    def is_ended(self):
+        return self.status in (self.STATUS_FINISHED, self.STATUS_FAILURE)
+
+    @property
+    def progress(self):
+        if self.total == 0:
+            return 100
+        return int(100 * self.done / self.total)
+
+    def get_result(self):
+        return self.KINDS[self.kind].get_result(self.get_params(), self.get_state())
+
+    @classmethod
+    def _claimable_query(cls):
+        return Q(status=cls.STATUS_WAITING) | (Q(status=cls.STATUS_RUNNING) & Q(last_update__lt=timezone.now() - timedelta(minutes=cls.STALE_DELAY)))
+
+    def claim(self):
+        nb_claimed = MemberJob.objects.filter(Q(id=self.id) & self._claimable_query()).update(status=self.STATUS_RUNNING, last_update=timezone.now())
+        if nb_claimed == 1:
+            self.refresh_from_db()
+        return nb_claimed == 1
+
+    def execute(self, raise_error=False):
+        kind_class = self.KINDS[self.kind]
+        params = self.get_params()
+        items = self.get_items()
+        state = self.get_state()
+        try:
+            if not state.get('prepared', False):
+                prepared_state = deepcopy(state)
+                with transaction.atomic():
+                    kind_class.prepare(params, prepared_state)
+                    prepared_state['prepared'] = True
+                    MemberJob.objects.filter(id=self.id).update(state=json.dumps(prepared_state), last_update=timezone.now())
+                state = prepared_state
+            with kind_class.get_context(params):
+                while self.done < len(items):
+                    chunk = items[self.done:self.done + self.CHUNK_SIZE]
+                    chunk_state = deepcopy(state)
+                    with transaction.atomic():
+                        chunk_items = items + kind_class.run_chunk(params, chunk, chunk_state)
+                        chunk_done = self.done + len(chunk)
+                        MemberJob.objects.filter(id=self.id).update(items=json.dumps(chunk_items), state=json.dumps(chunk_state), total=len(chunk_items), done=chunk_done, last_update=timezone.now())
+                    items, state, self.done = chunk_items, chunk_state, chunk_done
+            self.status = self.STATUS_FINISHED
+        except LucteriosException as job_error:
+            logging.getLogger('diacamma.member').exception("member job %s", self)
+            state.setdefault('errors', []).append(str(job_error))
+            self.status = self.STATUS_FAILURE
+            if raise_error:
+                MemberJob.objects.filter(id=self.id).update(status=self.status, state=json.dumps(state), last_update=timezone.now())
+                raise
+        MemberJob.objects.filter(id=self.id).update(status=self.status, state=json.dumps(state), last_update=timezone.now())
+        self.refresh_from_db()
+
+    def launch(self):
+        if self.total <= self.SYNC_LIMIT:
+            if self.claim():
+                self.execute(raise_error=True)
+            return True
+        else:
+            transaction.on_commit(self.schedule)
+            return False
+
+    @classmethod
+    def schedule(cls):
+        from lucterios.framework.model_fields import LucteriosScheduler
+        LucteriosScheduler.add_date(run_member_jobs, datetime.now() + timedelta(seconds=1))
+
+    @classmethod
+    def check_pending(cls):
+        if cls.objects.filter(cls._claimable_query()).exists():
+            cls.schedule()
+
+    @classmethod
+    def run_pending(cls):
+        nb_run = 0
+        for job in cls.objects.filter(cls._claimable_query()).order_by('id'):
+            if job.claim():
+                job.execute()
+                nb_run += 1
+        return nb_run
+
+    class Meta(object):
+        verbose_name = _('member job')
+        verbose_name_plural = _('member jobs')
+        default_permissions = []
+        ordering = ['-id']
+
+
+def run_member_jobs():
+    """Run waiting member jobs"""
+    from django.db import connections
+    try:
+        MemberJob.run_pending()
+    finally:
+        connections.close_all()
+
+
+class MemberJobKind(object):
+    kind = ''
+
+    @classmethod
+    def get_items(cls, params):
+        return []
+
+    @classmethod
+    def get_initial_state(cls, params):
+        return {'errors': []}
+
+    @classmethod
+    def prepare(cls, params, state):
+        pass
+
+    @classmethod
+    def get_context(cls, params):
+        return nullcontext()
+
+    @classmethod
+    def run_chunk(cls, params, items, state):
+        new_items = []
+        for item in items:
+            new_items.extend(cls.run_item(params, item, state))
+        return new_items
+
+    @classmethod
+    def run_item(cls, params, item, state):
+        return []
+
+    @classmethod
+    def get_result(cls, params, state):
+        return ''
+
+
+@MemberJob.register
+class RegenerateBillJob(MemberJobKind):
+    kind = 'regenerate_bill'
+
+    @classmethod
+    def get_items(cls, params):
+        return list(Subscription.objects.filter(season_id=params['season'], status=Subscription.STATUS_BUILDING).order_by('id').values_list('id', flat=True))
+
+    @classmethod
+    def get_initial_state(cls, params):
+        return {'errors': [], 'nb_subscriptions': 0, 'bills': [], 'insert': 0, 'update': 0, 'delete': 0}
+
+    @classmethod
+    def run_item(cls, params, item, state):
+        subscription = Subscription.objects.select_related('bill').get(id=item)
+        state['nb_subscriptions'] += 1
+        bill_is_building = (subscription.bill is not None) and (subscription.bill.status == Bill.STATUS_BUILDING)
+        if bill_is_building and (subscription.bill_id in state['bills']):
+            return []
+        if params.get('dryrun', False):
+            if bill_is_building:
+                changes = BillSynchronizer(subscription.bill, list(subscription.bill.subscription_set.all())).get_changes()
+                for change_name, change_value in changes.items():
+                    state[change_name] += change_value
+        else:
+            subscription.change_bill()
+        if bill_is_building:
+            state['bills'].append(subscription.bill_id)
+        return []
+
+    @classmethod
+    def get_result(cls, params, state):
+        if params.get('dryrun', False):
+            return _('%(nbsub)s subscriptions checked: %(insert)d line(s) to add, %(update)d line(s) to modify and %(delete)d line(s) to delete.') % {'nbsub': state['nb_subscriptions'], 'insert': state['insert'], 'update': state['update'], 'delete': state['delete']}
+        return _('%s subscriptions were regenerated.') % state['nb_subscriptions']
+
+
+@MemberJob.register
+class CheckConnectionJob(MemberJobKind):
+    kind = 'check_connection'
+
+    @classmethod
+    def get_items(cls, params):
+        season = Season.objects.get(id=params['season'])
+        return list(season.get_connection_adherents().order_by('id').values_list('id', flat=True))
+
+    @classmethod
+    def get_initial_state(cls, params):
+        return {'errors': [], 'nb_del': 0, 'nb_add': 0, 'nb_update': 0}
+
+    @classmethod
+    def prepare(cls, params, state):
+        state['nb_del'] = Season.objects.get(id=params['season']).disabled_old_connection()
+
+    @classmethod
+    def run_chunk(cls, params, items, state):
+        season = Season.objects.get(id=params['season'])
+        season.check_adherents_connection(list(Adherent.objects.filter(id__in=items).select_related('user').order_by('id')), state)
+        return []
+
+    @classmethod
+    def get_result(cls, params, state):
+        return _("{[center]}{[b]}Result{[/b]}{[/center]}{[br/]}%(nb_del)s removed connection(s).{[br/]}%(nb_add)s added connection(s).{[br/]}%(nb_update)s updated connection(s).") % state
+
+
+@MemberJob.register
+class TaxReceiptCheckJob(MemberJobKind):
+    kind = 'taxreceipt_check'
+
+    @classmethod
+    def get_items(cls, params):
+        if len(Params.getvalue("member-tax-receipt")) == 0:
+            return []
+        items = [['regenerate', taxitem_id] for taxitem_id in TaxReceipt.objects.filter(Q(year=params['year']), num__isnull=True).order_by('id').values_list('id', flat=True)]
+        items.append(['extract'])
+        return items
+
+    @classmethod
+    def run_item(cls, params, item, state):
+        new_items = []
+        if item[0] == 'regenerate':
+            TaxReceipt.objects.get(id=item[1]).regenerate()
+        elif item[0] == 'extract':
+            for receipt_info in TaxReceipt.get_receipts_to_create(params['year']):
+                new_items.append(['create', receipt_info['third'].id, [entry.id for entry in receipt_info['entries']], receipt_info['date'].isoformat()])
+        elif item[0] == 'create':
+            TaxReceipt.create_from_entries(params['year'], Third.objects.get(id=item[1]), item[2], convert_date(item[3]))
+        return new_items
+
+
+@MemberJob.register
+class TaxReceiptValidJob(MemberJobKind):
+    kind = 'taxreceipt_valid'
+
+    @classmethod
+    def get_items(cls, params):
+        return list(TaxReceipt.objects.filter(Q(year=params['year']), num__isnull=True).order_by('id').values_list('id', flat=True))
+
+    @classmethod
+    def prepare(cls, params, state):
+        TaxReceipt.number_all(params['year'])
+
+    @classmethod
+    def get_context(cls, params):
+        return TaxReceipt.render_pool()
+
+    @classmethod
+    def run_chunk(cls, params, items, state):
+        failed_ids = TaxReceipt.render_pdfreports(items, LucteriosUser.objects.filter(id=params.get('user')).first())
+        state['errors'].extend([str(_("Failure to create tax receipt report #%d") % failed_id) for failed_id in failed_ids])
+        return []
+
+
+@MemberJob.register
+class RenewJob(MemberJobKind):
+    kind = 'renew'
+
+    @classmethod
+    def get_items(cls, params):
+        families = {}
+        adherents = {adherent.id: adherent for adherent in Adherent.objects.filter(id__in=params['adherents']).with_virtual_fields(['family'])}
+        for adherent_id in params['adherents']:
+            if adherent_id in adherents:
+                adherent = adherents[adherent_id]
+                families.setdefault(adherent.family.id if adherent.family is not None else adherent.id, []).append(adherent.id)
+        return list(families.values())
+
+    @classmethod
+    def get_initial_state(cls, params):
+        return {'errors': [], 'adherents': [], 'bills': []}
+
+    @classmethod
+    def run_chunk(cls, params, items, state):
+        adherent_ids = []
+        for family_ids in items:
+            adherent_ids.extend(family_ids)
+        renewal = SubscriptionBatch(convert_date(params['dateref']))
+        adherents = Adherent.objects.in_bulk(adherent_ids)
+        renewal.add_renewals([adherents[adherent_id] for adherent_id in adherent_ids if adherent_id in adherents])
+        renewal.run()
+        state['adherents'].extend([subscription.adherent_id for subscription in renewal.subscriptions])
+        state['bills'].extend([bill.id for bill in renewal.bills])
+        state['errors'].extend(renewal.get_errors())
+        return []
+
+    @classmethod
+    def get_result(cls, params, state):
+        return _("%(nbsuccess)d adherent(s) renewed, %(nbfailure)d failure(s):{[br/]}%(errors)s") % {'nbsuccess': len(state['adherents']), 'nbfailure': len(state['errors']), 'errors': "{[br/]}".join(state['errors'])}
+
+
+@MemberJob.register
+class CommandJob(MemberJobKind):
+    kind = 'command'
+
+    @classmethod
+    def _split_deleted(cls, commands):
+        adherent_ids = set(Adherent.objects.filter(id__in=[int(command["adherent"]) for command in commands]).values_list('id', flat=True))
+        existing_commands = [command for command in commands if int(command["adherent"]) in adherent_ids]
+        errors = [str(_("Adherent #%s no longer exists!") % command["adherent"]) for command in commands if int(command["adherent"]) not in adherent_ids]
+        return existing_commands, errors
+
+    @classmethod
+    def get_items(cls, params):
+        families = {}
+        adherents = {adherent.id: adherent for adherent in Adherent.objects.filter(id__in=[int(command["adherent"]) for command in params['commands']]).with_virtual_fields(['family'])}
+        for command in params['commands']:
+            adherent = adherents.get(int(command["adherent"]))
+            if adherent is not None:
+                families.setdefault(adherent.family.id if adherent.family is not None else adherent.id, []).append(command)
+        return list(families.values())
+
+    @classmethod
+    def get_initial_state(cls, params):
+        return {'errors': cls._split_deleted(params['commands'])[1], 'nb_sub': 0, 'nb_bill': 0}
+
+    @classmethod
+    def run_chunk(cls, params, items, state):
+        commands = []
+        for family_commands in items:
+            commands.extend(family_commands)
+        commands, deleted_errors = cls._split_deleted(commands)
+        state['errors'].extend(deleted_errors)
+        renewal, nb_bill = CommandManager.run_commands(commands, convert_date(params['dateref']), params['sendemail'])
+        state['nb_sub'] += len(renewal.subscriptions)
+        state['nb_bill'] += nb_bill
+        state['errors'].extend(renewal.get_errors())
+        return []
+
+    @classmethod
+    def get_result(cls, params, state):
+        if params['sendemail'] is not None:
+            msg = _('%(nbsub)d new subscription and %(nbbill)d quotation have been sent.') % {'nbsub': state['nb_sub'], 'nbbill': state['nb_bill']}
+        else:
+            msg = _('%d new subscription have been prepared.') % state['nb_sub']
+        if len(state['errors']) > 0:
+            msg += "{[br/]}" + "{[br/]}".join(state['errors'])
+        return msg
+
+
+class MemberEmail(LucteriosModel):
+    STATUS_WAITING = 0
+    STATUS_SENDING = 1
+    STATUS_SENT = 2
+    STATUS_FAILURE = 3
+    LIST_STATUS = ((STATUS_WAITING, _('waiting')), (STATUS_SENDING, _('sending')), (STATUS_SENT, _('sent')), (STATUS_FAILURE, _('failure')))
+
+    BATCH_SIZE = 20
+    MAX_TRY = 5
+    STALE_DELAY = 15
+    PASSWORD_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789@$#%&*+='
+
+    recipient = models.TextField(_('recipient'))
+    subject = models.CharField(_('subject'), max_length=200)
+    body = models.TextField(_('message'))
+    bill = models.ForeignKey(Bill, verbose_name=_('bill'), null=True, default=None, on_delete=models.CASCADE)
+    print_model = models.IntegerField(verbose_name=_('print model'), null=True, default=None)
+    user = models.ForeignKey(LucteriosUser, verbose_name=_('user'), null=True, default=None, on_delete=models.CASCADE)
+    status = models.IntegerField(verbose_name=_('status'), choices=LIST_STATUS, null=False, default=STATUS_WAITING, db_index=True)
+    nb_try = models.IntegerField(verbose_name=_('tries'), default=0)
+    last_error = models.TextField(_('error'), default='')
+    next_try = models.DateTimeField(verbose_name=_('next try'), null=True, default=None)
+    creation_date = models.DateTimeField(verbose_name=_('creation date'), auto_now_add=True)
+    last_update = models.DateTimeField(verbose_name=_('last update'), auto_now=True)
+    sent_date = models.DateTimeField(verbose_name=_('sent date'), null=True, default=None)
+
+    def __str__(self):
+        return "%s: %s" % (self.recipient, self.subject)
+
+    @classmethod
+    def get_default_fields(cls):
+        return ['creation_date', 'recipient', 'subject', 'status', 'nb_try', 'sent_date', 'last_error']
+
+    @classmethod
+    def enqueue_bill(cls, bill, subject, message, print_model):
+        recipient = bill.third.contact.email
+        if len(split_doubled_email([recipient])) == 0:
+            raise EmailException(_("Invalid email address '%s'!") % recipient)
+        return cls.objects.create(recipient=recipient, subject=subject, body=message, bill=bill, print_model=print_model)
+
+    @classmethod
+    def enqueue_connections(cls, users):
+        if settings.USER_READONLY or (len(users) == 0) or not will_mail_send():
+            return
+        # no password is stored: it is generated, set and sent by MemberEmail.send when the email goes out
+        cls.objects.bulk_create([cls(recipient=user.email, subject=_("Connection password"), body='', user=user) for user in users])
+        cls.launch()
+
+    @classmethod
+    def _ready_query(cls):
+        now = timezone.now()
+        waiting_query = Q(status=cls.STATUS_WAITING) & (Q(next_try__isnull=True) | Q(next_try__lte=now))
+        return waiting_query | (Q(status=cls.STATUS_SENDING) & Q(last_update__lt=now - timedelta(minutes=cls.STALE_DELAY)))
+
+    @classmethod
+    def launch(cls):
+        transaction.on_commit(cls.schedule)
+
+    @classmethod
+    def schedule(cls, delay=1):
+        from lucterios.framework.model_fields import LucteriosScheduler
+        LucteriosScheduler.add_date(run_member_emails, datetime.now() + timedelta(seconds=delay))
+
+    @classmethod
+    def check_pending(cls):
+        if cls.objects.filter(cls._ready_query()).exists():
+            cls.schedule()
+
+    @classmethod
+    def _claim_batch(cls):
+        email_ids = list(cls.objects.filter(cls._ready_query()).order_by('id').values_list('id', flat=True)[:cls.BATCH_SIZE])
+        cls.objects.filter(Q(id__in=email_ids) & cls._ready_query()).update(status=cls.STATUS_SENDING, last_update=timezone.now())
+        return list(cls.objects.filter(id__in=email_ids, status=cls.STATUS_SENDING).select_related('bill', 'user').order_by('id'))
+
+    @classmethod
+    def send_pending(cls):
+        from lucterios.mailing import email_functions
+        nb_sent = 0
+        if not email_functions.will_mail_send():
+            return nb_sent
+        while True:
+            emails = cls._claim_batch()
+            if len(emails) == 0:
+                break
+            sender = MemberEmailSender(email_functions)
+            try:
+                for email in emails:
+                    if email.send(sender):
+                        nb_sent += 1
+            finally:
+                sender.close()
+        return nb_sent
+
+    def send(self, sender):
+        try:
+            bill = self.bill.get_final_child() if self.bill is not None else None
+            if self.user is not None:
+                self._send_connection(sender)
+            else:
+                files = [bill.get_pdfreport(self.print_model)] if (bill is not None) and (self.print_model is not None) else None
+                sender.send(self.recipient, self.subject, self.body, files,
+                            bill.get_cclist() if bill is not None else None, bill.get_bcclist() if bill is not None else None,
+                            withcopy=(bill is not None) and ((bill.categoryBill_id is None) or not bill.categoryBill.no_email_copy))
+            self.status = self.STATUS_SENT
+            self.sent_date = timezone.now()
+            self.last_error = ''
+            if bill is not None:
+                bill.email_sended()
+            success = True
+        except Exception as send_error:
+            logging.getLogger('diacamma.member').warning("email %s: %s", self, send_error)
+            self.nb_try += 1
+            self.last_error = str(send_error)
+            if self.nb_try >= self.MAX_TRY:
+                self.status = self.STATUS_FAILURE
+            else:
+                self.status = self.STATUS_WAITING
+                self.next_try = timezone.now() + timedelta(minutes=2 ** self.nb_try)
+            success = False
+        MemberEmail.objects.filter(id=self.id).update(status=self.status, sent_date=self.sent_date, last_error=self.last_error, nb_try=self.nb_try,
+                                                      next_try=self.next_try, last_update=timezone.now())
+        return success
+
+    def _send_connection(self, sender):
+        # same message as LucteriosUser.generate_password, sent through the batch connection
+        password = get_random_string(12, self.PASSWORD_CHARS)
+        login = self.user.email if settings.ASK_LOGIN_EMAIL else self.user.username
+        message = Params.getvalue('mailing-msg-connection') % {'login': login, 'username': login, 'password': password}
+        message = message.replace('{[newline]}', '<br/>').replace('{[', '<').replace(']}', '>')
+        sender.send(self.recipient, self.subject, "<html>%s</html>" % message, None, None, None, withcopy=False)
+        self.user.set_password(password)
+        self.user.save()
+
+    def retry(self):
+        MemberEmail.objects.filter(id=self.id).update(status=self.STATUS_WAITING, nb_try=0, next_try=None, last_update=timezone.now())
+        self.refresh_from_db()
+
+    class Meta(object):
+        verbose_name = _('email')
+        verbose_name_plural = _('emails')
+        default_permissions = []
+        ordering = ['-id']
+
+
+class MemberEmailSender(object):
+
+    class KeptServer(object):
+
+        def __init__(self, server):
+            self.server = server
+
+        def sendmail(self, *args, **kwargs):
+            return self.server.sendmail(*args, **kwargs)
+
+        def quit(self):
+            pass
+
+    def __init__(self, email_functions):
+        self.email_functions = email_functions
+        sender_obj = LegalEntity.objects.get(id=1)
+        self.sender_name = remove_accent(sender_obj.name, replace_slash=False)
+        self.sender_email = sender_obj.email
+        self.dkim_private_path = Params.getvalue('mailing-dkim-private-path')
+        self.dkim_selector = Params.getvalue('mailing-dkim-selector')
+        self.server = None
+
+    def get_server(self):
+        if self.server is None:
+            self.server = self.email_functions.get_email_server(Params.getvalue('mailing-smtpsecurity'), Params.getvalue('mailing-smtpserver'), Params.getvalue('mailing-smtpport'),
+                                                                Params.getvalue('mailing-smtpuser'), Params.getvalue('mailing-smtppass'))
+        return self.server
+
+    def send(self, recipient, subject, body, files, cclist, bcclist, withcopy=True):
+        recipients = self.email_functions.split_doubled_email([recipient])
+        bcclist = list(bcclist) if bcclist is not None else []
+        if withcopy and (self.sender_email not in bcclist):
+            bcclist.append(self.sender_email)
+        try:
+            self.email_functions.sending_email(recipients, self.sender_name, self.sender_email, subject, body, None, files, cclist, bcclist,
+                                               self.KeptServer(self.get_server()), self.dkim_private_path, self.dkim_selector)
+        except EmailException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+
+def run_member_emails():
+    """Send waiting member emails"""
+    from django.db import connections
+    try:
+        MemberEmail.send_pending()
+        next_try = MemberEmail.objects.filter(status=MemberEmail.STATUS_WAITING).order_by('next_try').values_list('next_try', flat=True).first()
+        if next_try is not None:
+            MemberEmail.schedule(max(1, int((next_try - timezone.now()).total_seconds())))
+    finally:
+        connections.close_all()
 
 
 @Signal.decorate('addon_search')
@@ -2367,8 +4266,7 @@ def member_addon_search(model, search_result):
 
 @Signal.decorate('check_report')
 def check_report_member(year):
-    for taxreceipt in TaxReceipt.objects.filter(fiscal_year=year):
-        taxreceipt.get_saved_pdfreport(False)
+    TaxReceipt.render_pdfreports(list(TaxReceipt.objects.filter(fiscal_year=year).values_list('id', flat=True)))
 
 
 def convert_parameter_team():
@@ -2430,6 +4328,8 @@ def member_convertdata():
     convert_parameter_team()
     convert_parameter_birth()
     convert_prestation()
+    if not MembershipSnapshot.objects.all().exists() and Subscription.objects.all().exists():
+        MembershipSnapshot.rebuild()
 
 
 @Signal.decorate('checkparam')
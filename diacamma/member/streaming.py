@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+'''
+Streaming export of member listings
+
+Above DIACAMMA_MEMBER_STREAMING_LIMIT rows, CSV listings are written chunk
+by chunk, with the layout of the report generators, in a file of the user
+directory, then proposed as a download.
+Listing actions must use StreamingListMixin to be laid out without their rows.
+Other formats need the whole page layout and keep the standard generators:
+a large ODS listing is still built in memory, with a warning in the logs.
+Those files are removed after DIACAMMA_MEMBER_STREAMING_EXPIRY seconds.
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2026 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+import csv
+import logging
+from os import listdir, unlink
+from os.path import join, isfile, getmtime
+from time import time
+from uuid import uuid4
+from lxml import etree
+
+from django.conf import settings
+
+from lucterios.framework.tools import WrapAction
+from lucterios.framework.xferadvance import TITLE_CLOSE
+from lucterios.framework.xfergraphic import XferContainerCustom
+from lucterios.framework.xfercomponents import XferCompLabelForm, XferCompDownLoad, XferCompGrid
+from lucterios.framework.printgenerators import ListingGenerator, ActionGenerator, PrintTable, convert_to_html
+from lucterios.framework.filetools import get_user_path
+from lucterios.framework.reporting_csv import LucteriosXLTExtension
+from lucterios.CORE.models import PrintModel
+from lucterios.CORE.xferprint import XferPrintListing, XferPrintAction
+
+STREAMING_FORMATS = ('csv',)
+NOT_STREAMED_FORMATS = ('ods',)
+STREAMING_DIR = 'member_listing'
+CHUNK_SIZE = 500
+
+
+def get_streaming_limit():
+    return getattr(settings, 'DIACAMMA_MEMBER_STREAMING_LIMIT', 2000)
+
+
+def get_streaming_expiry():
+    return getattr(settings, 'DIACAMMA_MEMBER_STREAMING_EXPIRY', 3600)
+
+
+def new_streaming_filename(report_format):
+    streaming_dir = get_user_path(STREAMING_DIR, '')
+    expiry_time = time() - get_streaming_expiry()
+    for old_filename in listdir(streaming_dir):
+        old_filename = join(streaming_dir, old_filename)
+        if isfile(old_filename) and (getmtime(old_filename) < expiry_time):
+            unlink(old_filename)
+    return join(streaming_dir, 'listing_%s.%s' % (uuid4().hex, report_format))
+
+
+def warn_not_streamed(report_format, nb_items):
+    logging.getLogger('diacamma.member').warning("listing of %d rows in %s: this format is not streamed, it is built in memory", nb_items, report_format)
+
+
+class StreamingCSVWriter(object):
+
+    def __init__(self, csv_file):
+        self.text_writer = csv.writer(csv_file, delimiter=';', quoting=csv.QUOTE_ALL, lineterminator='\n')
+        self.row_writer = csv.writer(csv_file, delimiter=';', quoting=csv.QUOTE_ALL, lineterminator=';\n')
+        self.formater = LucteriosXLTExtension()
+
+    def get_text(self, xml_cell):
+        if (xml_cell.text or '').strip().startswith('data:image'):
+            return ''
+        for xml_br in xml_cell.iter('br'):
+            xml_br.text = ','
+        return self.formater.formater(None, [xml_cell])
+
+    def write_cells(self, xml_cells):
+        if len(xml_cells) > 0:
+            self.row_writer.writerow([self.get_text(xml_cell) for xml_cell in xml_cells])
+        else:
+            self.text_writer.writerow([])
+
+    def write_rows(self, xml_table):
+        for xml_row in xml_table.xpath('rows'):
+            self.write_cells(xml_row.xpath('cell'))
+
+    def write_model(self, xml_model, xml_streaming_table, row_chunks):
+        for xml_page in xml_model.xpath('page'):
+            for part_name in ('header', 'body', 'bottom'):
+                for xml_part in xml_page.xpath(part_name):
+                    for xml_item in xml_part:
+                        if xml_item.tag == 'text':
+                            self.text_writer.writerow([self.get_text(xml_item)])
+                        elif xml_item.tag == 'table':
+                            self.write_cells(xml_item.xpath('columns/cell'))
+                            if xml_item is xml_streaming_table:
+                                # laid out without items, this table only has a blank row
+                                for xml_rows in row_chunks:
+                                    self.write_rows(xml_rows)
+                            else:
+                                self.write_rows(xml_item)
+                    if part_name == 'bottom':
+                        self.text_writer.writerow([])
+
+
+class StreamingGeneratorMixin(object):
+
+    def init_streaming(self, request):
+        self.streaming_file = None
+        self.request = request
+
+    def write_streaming_csv(self, xml_model, row_chunks):
+        xml_model = etree.fromstring(xml_model)
+        filename = new_streaming_filename('csv')
+        with open(filename, 'w', encoding='utf-8', newline='') as csv_file:
+            StreamingCSVWriter(csv_file).write_model(xml_model, xml_model.xpath('//table')[-1], row_chunks)
+        self.streaming_file = filename
+        return b''
+
+
+class StreamingListingGenerator(StreamingGeneratorMixin, ListingGenerator):
+
+    def __init__(self, model):
+        ListingGenerator.__init__(self, model)
+        self.without_items = False
+
+    def get_items_filtered(self):
+        items = ListingGenerator.get_items_filtered(self)
+        if self.without_items:
+            items = items.none()
+        return items
+
+    def get_row_chunks(self, items):
+        xml_table = etree.Element('table')
+        row_id = 1
+        for item in items.iterator(chunk_size=CHUNK_SIZE):
+            item.set_context(self.xfer)
+            new_row = etree.SubElement(xml_table, "rows")
+            if self.with_num:
+                new_row.append(convert_to_html('cell', "%d" % row_id, "sans-serif", 6, 6, "start"))
+            for column in self.columns:
+                new_row.append(convert_to_html('cell', item.evaluate(column[2]), "sans-serif", 9, 10, "start"))
+            if (row_id % CHUNK_SIZE) == 0:
+                yield xml_table
+                xml_table = etree.Element('table')
+            row_id += 1
+        yield xml_table
+
+    def generate_report(self, request, report_format):
+        self.init_streaming(request)
+        if report_format in STREAMING_FORMATS + NOT_STREAMED_FORMATS:
+            if request is not None:
+                self.xfer._initialize(request)
+            items = self.get_items_filtered()
+            nb_items = items.count()
+            if (nb_items > get_streaming_limit()) and (report_format in NOT_STREAMED_FORMATS):
+                warn_not_streamed(report_format, nb_items)
+            elif nb_items > get_streaming_limit():
+                self.change_format(report_format)
+                self.without_items = True
+                try:
+                    xml_model = self.generate(request)
+                finally:
+                    self.without_items = False
+                return self.write_streaming_csv(xml_model, self.get_row_chunks(items))
+        return ListingGenerator.generate_report(self, request, report_format)
+
+
+class StreamingListMixin(object):
+    without_items = False
+
+    def fill_grid(self, row, model, field_id, items):
+        if self.without_items:
+            items = items.none()
+        super().fill_grid(row, model, field_id, items)
+
+
+class StreamingActionGenerator(StreamingGeneratorMixin, ActionGenerator):
+
+    def get_row_table(self, action, items, item_ids):
+        grid = XferCompGrid(action.field_id)
+        grid.set_model(items.filter(pk__in=item_ids), action.fieldnames, action if action.multi_page else None)
+        xml_table = etree.Element('table')
+        PrintTable(grid, self).write_rows(xml_table)
+        return xml_table
+
+    def get_row_chunks(self, action, items):
+        item_ids = []
+        for item_id in items.values_list('pk', flat=True).iterator(chunk_size=CHUNK_SIZE):
+            item_ids.append(item_id)
+            if len(item_ids) == CHUNK_SIZE:
+                yield self.get_row_table(action, items, item_ids)
+                item_ids = []
+        if len(item_ids) > 0:
+            yield self.get_row_table(action, items, item_ids)
+
+    def generate_report(self, request, report_format):
+        self.init_streaming(request)
+        if (report_format in STREAMING_FORMATS + NOT_STREAMED_FORMATS) and isinstance(self.action, StreamingListMixin):
+            action = self.action
+            action._initialize(request)
+            action.params['PRINTING'] = True
+            action.fillresponse_header()
+            items = action.get_items_from_filter()
+            self.action = action.__class__()
+            nb_items = items.count()
+            if (nb_items > get_streaming_limit()) and (report_format in NOT_STREAMED_FORMATS):
+                warn_not_streamed(report_format, nb_items)
+            elif nb_items > get_streaming_limit():
+                self.change_format(report_format)
+                self.action.without_items = True
+                xml_model = self.generate(request)
+                return self.write_streaming_csv(xml_model, self.get_row_chunks(action, items))
+        return ActionGenerator.generate_report(self, request, report_format)
+
+
+class StreamingPrintMixin(object):
+
+    def request_handling(self, request, *args, **kwargs):
+        self.report_generator = None
+        response = super().request_handling(request, *args, **kwargs)
+        streaming_file = getattr(self.report_generator, 'streaming_file', None)
+        if streaming_file is not None:
+            return self._get_streaming_download(streaming_file).request_handling(request, *args, **kwargs)
+        return response
+
+    def _get_streaming_download(self, filename):
+        gui = XferContainerCustom()
+        gui.model = self.model
+        gui._initialize(self.request)
+        gui.is_view_right = self.is_view_right
+        gui.caption = self.caption
+        gui.extension = self.extension
+        gui.action = self.action
+        gui.params = self.params
+        lbl = XferCompLabelForm('title')
+        lbl.set_value_as_title(self.caption)
+        lbl.set_location(1, 0, 6)
+        gui.add_component(lbl)
+        filedown = XferCompDownLoad('filename')
+        filedown.compress = False
+        filedown.http_file = True
+        filedown.maxsize = 0
+        filedown.set_value(filename)
+        filedown.set_download(filename)
+        filedown.set_location(1, 15, 2)
+        gui.add_component(filedown)
+        gui.add_action(WrapAction(TITLE_CLOSE, short_icon='mdi:mdi-close'))
+        return gui
+
+
+class StreamingPrintListing(StreamingPrintMixin, XferPrintListing):
+
+    def get_report_generator(self):
+        dbmodel = PrintModel.get_model_selected(self)
+        gen = StreamingListingGenerator(self.model)
+        gen.filter = self.get_filter()
+        gen.filter_callback = self.filter_callback
+        gen.page_height = dbmodel.page_height
+        gen.page_width = dbmodel.page_width
+        gen.columns = dbmodel.columns
+        gen.mode = dbmodel.mode
+        gen.info = self.info
+        gen.with_num = self.with_num is True
+        self.report_generator = gen
+        return gen
+
+
+class StreamingPrintAction(StreamingPrintMixin, XferPrintAction):
+
+    def get_report_generator(self):
+        if self.action_class is not None:
+            self.report_generator = StreamingActionGenerator(self.action_class(), self.tab_change_page)
+            return self.report_generator
@@ -23,18 +23,23 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import unicode_literals
+from random import Random
+from datetime import date, timedelta
 
 from lucterios.framework.xfergraphic import XferContainerAcknowledge
 
 from lucterios.CORE.models import Parameter
 from lucterios.CORE.parameters import Params
+from lucterios.contacts.models import LegalEntity, Responsability
 
 from diacamma.accounting.test_tools import default_compta_fr, create_third
 from diacamma.invoice.test_tools import default_articles
 from diacamma.payoff.test_tools import default_bankaccount_fr
+from diacamma.payoff.models import Payoff
 from diacamma.member.editors import SeasonEditor
+from diacamma.member.instrumentation import QueryRecorder
 from diacamma.member.models import Season, Activity, Team, Age, Document, \
-    Adherent, SubscriptionType, Prestation, TeamPrestation
+    Adherent, SubscriptionType, Prestation, TeamPrestation, SubscriptionBatch
 from diacamma.invoice.models import Article
 
 
@@ -165,3 +170,56 @@ def default_prestation():
     Prestation.objects.create(name="price 2", team_prestation=TeamPrestation.objects.create(team_id=2, activity_id=2), article_id=2)  # 'team2 [activity2]' - 56.78
     Prestation.objects.create(name="price 3", team_prestation=TeamPrestation.objects.create(team_id=1, activity_id=1), article_id=3)  # 'team1 [activity1]' - 324.97
     Parameter.change_value('member-team-enable', 2)
+
+
+def generate_club(nb_adherent, seed=0, season_ids=(9, 10), first_index=0):
+    random_gen = Random("%s-%d" % (seed, first_index))
+    family_type = Params.getobject("member-family-type")
+    team_enable = Params.getvalue("member-team-enable")
+    subtypes = list(SubscriptionType.objects.filter(duration__in=(SubscriptionType.DURATION_ANNUALLY, SubscriptionType.DURATION_CALENDAR)).exclude(state=SubscriptionType.STATE_UNACTIVATE).order_by('id'))
+    prestations = list(Prestation.objects.filter(team_prestation__isnull=False).select_related('team_prestation').order_by('id'))
+    teams = list(Team.objects.filter(unactive=False).order_by('id'))
+    activities = list(Activity.objects.filter(unactive=False).order_by('id'))
+    adherents = []
+    family = None
+    family_size = 0
+    for index in range(first_index, first_index + nb_adherent):
+        new_adh = create_adherent('Firstname%06d' % index, 'Lastname%06d' % (index - (index % 3)),
+                                  date(1950 + random_gen.randint(0, 60), random_gen.randint(1, 12), random_gen.randint(1, 28)).isoformat())
+        if (family_type is not None) and (random_gen.random() < 0.6):
+            if (family is None) or (family_size >= random_gen.randint(2, 5)):
+                family = LegalEntity.objects.create(name="FAMILY %06d" % index, structure_type=family_type, address=new_adh.address,
+                                                    postal_code=new_adh.postal_code, city=new_adh.city, country=new_adh.country, email=new_adh.email)
+                family_size = 0
+            Responsability.objects.create(individual=new_adh, legal_entity=family)
+            family_size += 1
+        adherents.append(new_adh)
+    for season in Season.objects.filter(id__in=season_ids).order_by('designation'):
+        for chunk_index in range(0, len(adherents), 500):
+            batch = SubscriptionBatch(season.begin_date + timedelta(days=15))
+            for new_adh in adherents[chunk_index:chunk_index + 500]:
+                if (season.id != season_ids[0]) and (random_gen.random() < 0.15):
+                    continue
+                if (team_enable == 2) and (len(prestations) > 0):
+                    batch.add(new_adh, random_gen.choice(subtypes), batch.dateref, prestations=[random_gen.choice(prestations)])
+                else:
+                    batch.add(new_adh, random_gen.choice(subtypes), batch.dateref,
+                              licenses=[(random_gen.choice(teams).id if len(teams) > 0 else None, random_gen.choice(activities).id, 'L%06d' % new_adh.id)])
+            batch.run()
+            for bill in batch.bills:
+                if random_gen.random() < 0.5:
+                    Payoff.objects.create(supporting=bill, date=bill.date + timedelta(days=random_gen.randint(1, 30)), amount=bill.get_total_rest_topay(),
+                                          mode=Payoff.MODE_CASH, payer=str(bill.third), reference='bench')
+    return adherents
+
+
+def check_query_budget(testcase, xfer, url, params, nb_queries=None, max_duplicates=None):
+    with QueryRecorder(url) as recorder:
+        testcase.factory.xfer = xfer
+        testcase.calljson(url, params, False)
+    repeated = "\n".join(["%dx %s" % (nb, sql) for sql, nb in recorder.get_repeated()])
+    if nb_queries is not None:
+        testcase.assertEqual(recorder.nb_queries, nb_queries, repeated)
+    if max_duplicates is not None:
+        testcase.assertLessEqual(recorder.nb_duplicates, max_duplicates, repeated)
+    return recorder
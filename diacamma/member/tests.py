@@ -24,6 +24,13 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import unicode_literals
 from shutil import rmtree
+from datetime import date
+from unittest.mock import patch
+
+from django.db import connection, transaction
+from django.core.cache import cache
+from django.db.models.signals import post_save
+from django.test.utils import CaptureQueriesContext
 
 from lucterios.framework.test import LucteriosTest
 from lucterios.framework.filetools import get_user_dir
@@ -37,6 +44,8 @@ from diacamma.member.views_season import SeasonAddModify, SeasonShow, SeasonSubs
     SeasonActive, DocummentAddModify, DocummentDel, SeasonDocummentClone, \
     PeriodDel, PeriodAddModify, SubscriptionTypeAddModify, SubscriptionTypeShow, \
     SubscriptionTypeDel, SubscriptionTypeUp
+from diacamma.member.models import Season, Period, SeasonCache, Team
+from diacamma.member.tools import bulk_create_with_signals
 from diacamma.member.test_tools import default_season, default_financial, set_parameters
 from diacamma.member.views_conf import CategoryConf, ActivityAddModify, \
     ActivityDel, TeamAddModify, TeamDel, AgeAddModify, AgeDel, CategoryParamEdit, \
@@ -114,7 +123,7 @@ class SeasonTest(LucteriosTest):
         self.factory.xfer = SeasonSubscription()
         self.calljson('/diacamma.member/seasonSubscription', {}, False)
         self.assert_observer('core.custom', 'diacamma.member', 'seasonSubscription')
-        self.assert_count_equal('', 8)
+        self.assert_count_equal('', 9)
         self.assert_grid_equal('season', {'designation': "désignation", 'period_set': "période", 'iscurrent': "courant"}, 5)
         self.assert_json_equal('TAB', '__tab_1', 'Saison')
         self.assert_json_equal('TAB', '__tab_2', 'Les cotisations')
@@ -304,6 +313,46 @@ class SeasonTest(LucteriosTest):
         self.assert_json_equal('', 'period/@1/begin_date', '2009-12-01')
         self.assert_json_equal('', 'period/@2/begin_date', '2010-06-01')
 
+    def test_season_cache(self):
+        self.addCleanup(SeasonCache.clear)
+        with self.captureOnCommitCallbacks(execute=True):
+            default_season()
+        # as after a commit: no season change is waiting any more
+        connection.run_on_commit = []
+        with CaptureQueriesContext(connection) as queries:
+            season = Season.current_season()
+            self.assertEqual(season.id, 10)
+            self.assertEqual(season.begin_date, date(2009, 9, 1))
+            self.assertEqual(season.end_date, date(2010, 8, 31))
+            self.assertEqual(season.get_period_from_date(date(2009, 12, 15)).id, 38)
+            self.assertEqual(Season.get_from_date(date(2011, 1, 15)).designation, "2010/2011")
+            self.assertEqual(Season.current_season().get_months()[0], ('2009-09', date(2009, 9, 1).strftime("%B %Y")))
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(cache.get(SeasonCache.CACHE_KEY)['current'], 10)
+
+        period = Period.objects.get(id=40)
+        period.end_date = date(2010, 9, 20)
+        period.save()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Season.current_season().end_date, date(2010, 9, 20))
+            self.assertEqual(Season.current_season().end_date, date(2010, 9, 20))
+        self.assertEqual(len(queries), 2)
+        self.assertIsNone(cache.get(SeasonCache.CACHE_KEY))
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                period.end_date = date(2010, 9, 30)
+                period.save()
+                self.assertEqual(Season.current_season().end_date, date(2010, 9, 30))
+                raise ValueError()
+        self.assertEqual(Season.current_season().end_date, date(2010, 9, 20))
+        self.assertIsNone(cache.get(SeasonCache.CACHE_KEY))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Season.objects.get(id=11).set_has_actif(no_notif=True)
+        connection.run_on_commit = []
+        self.assertEqual(Season.current_season().id, 11)
+        self.assertEqual(cache.get(SeasonCache.CACHE_KEY)['current'], 11)
+
     def test_subscription(self):
         default_financial()
         default_season()
@@ -312,7 +361,7 @@ class SeasonTest(LucteriosTest):
         self.factory.xfer = SeasonSubscription()
         self.calljson('/diacamma.member/seasonSubscription', {}, False)
         self.assert_observer('core.custom', 'diacamma.member', 'seasonSubscription')
-        self.assert_count_equal('', 8)
+        self.assert_count_equal('', 9)
         self.assert_grid_equal('subscriptiontype', {'order_key': 'ordre', 'name': "nom", 'description': "description", 'duration': "durée", 'state': "état", 'price': "prix"}, 0)
         self.assert_json_equal('TAB', '__tab_1', 'Saison')
         self.assert_json_equal('TAB', '__tab_2', 'Les cotisations')
@@ -380,7 +429,7 @@ class SeasonTest(LucteriosTest):
         self.calljson('/diacamma.member/seasonSubscription', {}, False)
         self.assert_observer('core.custom', 'diacamma.member', 'seasonSubscription')
         self.assert_count_equal('subscriptiontype', 1)
-        self.assert_count_equal('', 8)
+        self.assert_count_equal('', 9)
         self.assertNotIn('member-subscription-delaytorenew', self.json_data.keys())
 
         self.factory.xfer = SubscriptionTypeAddModify()
@@ -392,7 +441,7 @@ class SeasonTest(LucteriosTest):
         self.calljson('/diacamma.member/seasonSubscription', {}, False)
         self.assert_observer('core.custom', 'diacamma.member', 'seasonSubscription')
         self.assert_count_equal('subscriptiontype', 2)
-        self.assert_count_equal('', 10)
+        self.assert_count_equal('', 11)
         self.assert_json_equal('LABELFORM', 'member-subscription-delaytorenew', '0')
 
     def test_change_fiscalyear(self):
@@ -643,6 +692,23 @@ class CategoriesTest(LucteriosTest):
         self.assert_json_equal('TAB', '__tab_2', 'Âge')
         self.assert_json_equal('TAB', '__tab_3', 'Activité')
 
+    def test_team_bulk_create(self):
+        created_teams = []
+
+        def team_created(sender, instance, created, **kwargs):
+            created_teams.append((instance.name, created))
+        post_save.connect(team_created, sender=Team)
+        try:
+            teams = bulk_create_with_signals(Team, [Team(name="abc"), Team(name="def")])
+            self.assertNotIn(None, [team.id for team in teams])
+            with patch.object(type(connection.features), 'can_return_rows_from_bulk_insert', False):
+                teams = bulk_create_with_signals(Team, [Team(name="ghi")])
+            self.assertIsNotNone(teams[0].id)
+        finally:
+            post_save.disconnect(team_created, sender=Team)
+        self.assertEqual(created_teams, [("abc", True), ("def", True), ("ghi", True)])
+        self.assertEqual(Team.objects.count(), 3)
+
     def test_age(self):
         self.factory.xfer = CategoryConf()
         self.calljson('/diacamma.member/categoryConf', {}, False)
@@ -27,37 +27,50 @@ from shutil import rmtree
 from datetime import date, timedelta, datetime
 from _io import StringIO
 from unittest.mock import patch
+from unittest import skipUnless
+from threading import Thread
+import re
 
 from os.path import isfile
 from base64 import b64decode
 
 from django.conf import settings
+from django.db.models import Q, Count
+from django.db import connection
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
 
 from lucterios.framework.test import LucteriosTest
 from lucterios.framework.filetools import get_user_dir
+from lucterios.framework.model_fields import LucteriosScheduler
+from lucterios.framework.error import LucteriosException, IMPORTANT
 from lucterios.CORE.models import Parameter, LucteriosUser, LucteriosGroup, SavedCriteria
 from lucterios.CORE.parameters import Params
-from lucterios.CORE.views import ObjectMerge
+from lucterios.CORE.views import ObjectMerge, StatusMenu
 from lucterios.contacts.views_contacts import LegalEntityShow
-from lucterios.contacts.models import LegalEntity, Responsability
+from lucterios.contacts.models import LegalEntity, Responsability, AbstractContact
 from lucterios.contacts.views import ContactImport
 from lucterios.contacts.test_tools import change_ourdetail
 from lucterios.mailing.test_tools import configSMTP, TestReceiver, decode_b64
+from lucterios.mailing.email_functions import get_email_server, EmailException
 from lucterios.documents.models import DocumentContainer
 
 from diacamma.accounting.views import ThirdShow
-from diacamma.accounting.models import FiscalYear
+from diacamma.accounting.models import FiscalYear, EntryLineAccount
 from diacamma.accounting.test_tools import fill_accounts_fr, create_account, add_entry
 from diacamma.accounting.views_entries import EntryAccountList, EntryAccountClose, EntryAccountLink
 from diacamma.invoice.views import BillList, BillTransition, BillToBill, BillAddModify, BillShow, DetailAddModify
 from diacamma.invoice.models import get_or_create_customer, Article, AccountPosting, \
-    CategoryBill
+    CategoryBill, Bill, Detail, Category, AutomaticReduce
 from diacamma.invoice.test_tools import InvoiceTest, default_categorybill
 from diacamma.payoff.views import PayoffAddModify
 from diacamma.payoff.test_tools import check_pdfreport, default_paymentmethod
+from diacamma.payoff.models import Supporting
 
 from diacamma.member.models import Season, Adherent, SubscriptionType, \
-    Prestation, Subscription, Team
+    Prestation, Subscription, Team, License, AdherentQuerySet, MemberJob, RenewJob, TaxReceipt, check_report_member, MemberSequence, MemberEmail, Age, \
+    clear_age_cache, AdherentImportBatch, MembershipSnapshot, MembershipInvolvement
 from diacamma.member.views import AdherentActiveList, AdherentAddModify, AdherentShow, \
     SubscriptionAddModify, SubscriptionShow, LicenseAddModify, LicenseDel, \
     AdherentDoc, AdherentLicense, AdherentLicenseSave, AdherentStatistic, \
@@ -65,14 +78,16 @@ from diacamma.member.views import AdherentActiveList, AdherentAddModify, Adheren
     AdherentCommandDelete, AdherentCommandModify, AdherentFamilyAdd, \
     AdherentFamilySelect, AdherentFamilyCreate, FamilyAdherentAdd, \
     FamilyAdherentCreate, FamilyAdherentAdded, AdherentListing, \
-    AdherentContactList, AdherentConnection, SubscriptionDel, AdherentDisableConnection, \
+    AdherentContactList, AdherentContactPrint, AdherentConnection, SubscriptionDel, AdherentDisableConnection, \
     AdherentPrint, PrestationList, PrestationDel, PrestationAddModify, \
     PrestationShow, AdherentPrestationAdd, AdherentPrestationSave, \
     AdherentPrestationDel, PrestationSwap, PrestationSplit, \
     PrestationPriceAddModify, PrestationPriceDel, AdherentSendSubscription, \
-    AdherentLabel, SubscriptionAddForCurrent, SubscriptionConfirmCurrent
+    AdherentLabel, SubscriptionAddForCurrent, SubscriptionConfirmCurrent, MemberEmailList, MemberEmailRetry
 from diacamma.member.test_tools import default_season, default_financial, default_params, \
-    default_adherents, default_subscription, set_parameters, default_prestation, create_adherent
+    default_adherents, default_subscription, set_parameters, default_prestation, create_adherent, generate_club, check_query_budget
+from diacamma.member.instrumentation import QueryRecorder
+from diacamma.member.views_job import MemberJobShow
 from diacamma.member.views_conf import TaxReceiptList, TaxReceiptCheck, TaxReceiptShow, TaxReceiptPrint, CategoryConf, TaxReceiptCheckOnlyOn, TaxReceiptValid
 
 
@@ -275,6 +290,50 @@ class AdherentTest(BaseAdherentTest):
         self.assert_json_equal('LABELFORM', 'age_category', "Poussins")
         self.assert_json_equal('LABELFORM', 'user', None)
 
+    def test_num_sequence(self):
+        default_adherents()
+        self.assertEqual(list(Adherent.objects.order_by('id').values_list('num', flat=True)), [1, 2, 3, 4, 5])
+        self.assertEqual(MemberSequence.allocate('adherent', 10), 6)
+        self.assertEqual(create_adherent("Rantanplan", 'Chien', '2010-01-01').num, 16)
+        self.assertEqual(MemberSequence.allocate('taxreceipt-2015'), 1)
+        Adherent.objects.filter(num=16).update(num=8)
+        self.assertEqual(MemberSequence.repair(), ['adherent', 'taxreceipt-2015'])
+        self.assertEqual(MemberSequence.objects.get(name='adherent').value, 8)
+        self.assertEqual(MemberSequence.objects.get(name='taxreceipt-2015').value, 0)
+        self.assertEqual(create_adherent("Ma'a", 'Dalton', '1961-04-12').num, 9)
+        self.assertEqual(MemberSequence.allocate('adherent', 10), 10)
+        self.assertFalse(MemberSequence.release('adherent', 12, 18))
+        self.assertTrue(MemberSequence.release('adherent', 12, 19))
+        self.assertEqual(create_adherent("Jack", 'Dalton', '1962-04-12').num, 12)
+
+    def test_import_batch_state(self):
+        default_adherents()
+        default_subscription()
+        Adherent.initialize_import()
+        import_batch = Adherent.get_import_batch()
+        self.assertIsNotNone(import_batch)
+        thread_batches = []
+        worker = Thread(target=lambda: thread_batches.append(Adherent.get_import_batch()))
+        worker.start()
+        worker.join()
+        self.assertEqual(thread_batches, [None])
+        self.assertEqual(create_adherent("Rantanplan", 'Chien', '2010-01-01').num, 6)
+        self.assertEqual(MemberSequence.objects.get(name='adherent').value, 6)
+        self.assertEqual(import_batch.allocate_num(), 7)
+        self.assertEqual(MemberSequence.objects.get(name='adherent').value, 6 + AdherentImportBatch.NUM_BLOCK)
+        Adherent.initialize_import()
+        self.assertIsNot(Adherent.get_import_batch(), import_batch)
+        self.assertEqual(MemberSequence.objects.get(name='adherent').value, 7)
+        Adherent.finalize_import()
+        self.assertIsNone(Adherent.get_import_batch())
+        self.assertEqual(create_adherent("Ma'a", 'Dalton', '1961-04-12').num, 8)
+        new_adherent = Adherent.import_data({'lastname': 'Dalton', 'firstname': 'Averell', 'address': 'rue de la prison', 'postal_code': '99999',
+                                             'city': 'Daisy Town', 'birthday': '1959-06-01', 'subscriptiontype': 'Annually'}, '%Y-%m-%d')
+        self.assertEqual(new_adherent.num, 9)
+        self.assertIsNone(Adherent.get_import_batch())
+        self.assertEqual(MemberSequence.objects.get(name='adherent').value, 9)
+        self.assertEqual(new_adherent.subscription_set.count(), 1)
+
     def test_add_adherent_with_connexion(self):
         Parameter.change_value('member-connection', 1)
         Parameter.change_value('contacts-createaccount', 1)
@@ -786,6 +845,51 @@ class AdherentTest(BaseAdherentTest):
         self.assertEqual(content_csv[4].strip(), '"statut : en création & validé,,passion : activity2,,group : team2,team3,,Âge : Minimes,Benjamins,Poussins,,genre : Femme"', str(content_csv))
         self.assertEqual(content_csv[6].strip(), '"nom";"adresse";"ville";"tel";"courriel";', str(content_csv))
 
+    def test_subscription_printlisting_streaming(self):
+        self.add_subscriptions()
+        new_context = {'dateref': '2009-10-01', 'PRINT_MODE': '4', 'MODEL': 1}
+        self.factory.xfer = AdherentListing()
+        self.calljson('/diacamma.member/adherentListing', new_context, False)
+        self.assert_observer('core.print', 'diacamma.member', 'adherentListing')
+        csv_value = b64decode(str(self.response_json['print']['content'])).decode("utf-8")
+        with self.settings(DIACAMMA_MEMBER_STREAMING_LIMIT=3):
+            self.factory.xfer = AdherentListing()
+            with QueryRecorder() as recorder:
+                self.calljson('/diacamma.member/adherentListing', new_context, False)
+            self.assert_observer('core.custom', 'diacamma.member', 'adherentListing')
+            self.assert_count_equal('', 2)
+            filename = self.get_json_path('filename')
+            self.assertTrue(isfile(filename), filename)
+            with open(filename, encoding='utf-8', newline='') as csv_file:
+                self.assertEqual([line.strip() for line in csv_file.read().split('\n') if line.strip() != ''], [line.strip() for line in csv_value.split('\n') if line.strip() != ''])
+            self.assertLess(recorder.nb_queries, 40)
+
+            with patch('diacamma.member.streaming.CHUNK_SIZE', 2):
+                self.factory.xfer = AdherentListing()
+                self.calljson('/diacamma.member/adherentListing', new_context, False)
+            self.assert_observer('core.custom', 'diacamma.member', 'adherentListing')
+            self.assertNotEqual(self.get_json_path('filename'), filename)
+            self.assertTrue(isfile(filename), filename)
+            with open(self.get_json_path('filename'), encoding='utf-8', newline='') as csv_file:
+                self.assertEqual([line.strip() for line in csv_file.read().split('\n') if line.strip() != ''], [line.strip() for line in csv_value.split('\n') if line.strip() != ''])
+            with self.settings(DIACAMMA_MEMBER_STREAMING_EXPIRY=-1):
+                self.factory.xfer = AdherentListing()
+                self.calljson('/diacamma.member/adherentListing', new_context, False)
+            self.assertFalse(isfile(filename), filename)
+
+            new_context['PRINT_MODE'] = '2'
+            self.factory.xfer = AdherentListing()
+            with self.assertLogs('diacamma.member', level='WARNING') as logs:
+                self.calljson('/diacamma.member/adherentListing', new_context, False)
+            self.assert_observer('core.print', 'diacamma.member', 'adherentListing')
+            self.assertIn('this format is not streamed', logs.output[0])
+
+            new_context['PRINT_MODE'] = '4'
+            new_context['dateref'] = '2015-10-01'
+            self.factory.xfer = AdherentListing()
+            self.calljson('/diacamma.member/adherentListing', new_context, False)
+            self.assert_observer('core.print', 'diacamma.member', 'adherentListing')
+
     def test_subscription_printlabel(self):
         self.add_subscriptions()
 
@@ -896,6 +1000,196 @@ class AdherentTest(BaseAdherentTest):
         self.assert_json_equal('', 'town_1/@1/Man', '{[b]}2{[/b]}')
         self.assert_json_equal('', 'town_1/@1/ratio', '{[b]}2{[/b]}')
 
+    def test_statistic_seniority(self):
+        self.add_subscriptions(year=2008, season_id=9)
+        self.add_subscriptions(year=2009, season_id=10, status=1, create_adh_sub=False)
+        Subscription.objects.filter(adherent_id=2, season_id=10).update(status=Subscription.STATUS_VALID)
+        season = Season.objects.get(id=10)
+        birthday = date(season.date_ref.year - Params.getvalue("member-age-statistic"), season.date_ref.month, season.date_ref.day)
+        for only_valid in (True, False):
+            query = Q(subscription__status=Subscription.STATUS_VALID) if only_valid else Q(subscription__status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID))
+            query &= Q(subscription__begin_date__lte=season.date_ref) & Q(subscription__end_date__gte=season.date_ref)
+            query &= Q(subscription__subscriptiontype__duration=0)
+            old_histogram = {}
+            for adh in Adherent.objects.filter(query).distinct():
+                nb_sub = adh.subscription_set.filter(Q(subscriptiontype__duration=0) & Q(begin_date__lte=season.date_ref)).count()
+                offset = +1 if not isinstance(adh.birthday, date) or adh.birthday >= birthday else -1
+                if nb_sub not in old_histogram.keys():
+                    old_histogram[nb_sub] = [0, 0, 0, 0]
+                old_histogram[nb_sub][adh.genre + offset] += 1
+            self.assertEqual(season.seniority_histogram(only_valid), old_histogram)
+        self.assertEqual(season.seniority_histogram(True), {2: [0, 0, 1, 0]})
+        self.assertEqual(season.seniority_histogram(False), {2: [1, 0, 1, 0]})
+
+    def test_membership_snapshot(self):
+        self.add_subscriptions(status=1)
+        self.assertEqual(MembershipSnapshot.objects.filter(season_id=10).count(), 5)
+        snapshot = MembershipSnapshot.objects.get(adherent_id=5)
+        self.assertEqual(snapshot.status, Subscription.STATUS_BUILDING)
+        self.assertEqual(snapshot.duration, SubscriptionType.DURATION_CALENDAR)
+        self.assertEqual(list(snapshot.involvements.values_list('team_id', 'activity_id')), [(3, 2)])
+        self.assertEqual(MembershipSnapshot.objects.filter(MembershipSnapshot.get_involvement_query([1])).count(), 2)
+        for snapshot in MembershipSnapshot.objects.all():
+            snapshot.adherent.date_ref = date(2009, 10, 1)
+            self.assertEqual(snapshot.age_category, snapshot.adherent.age_category, snapshot.adherent_id)
+            self.assertIsNone(snapshot.family)
+
+        subscription = Subscription.objects.get(adherent_id=5)
+        subscription.validate()
+        License.objects.create(subscription=subscription, team_id=1, activity_id=1)
+        snapshot = MembershipSnapshot.objects.get(adherent_id=5)
+        self.assertEqual(snapshot.status, Subscription.STATUS_VALID)
+        self.assertEqual(list(snapshot.involvements.order_by('id').values_list('team_id', 'activity_id')), [(3, 2), (1, 1)])
+        self.assertEqual(MembershipSnapshot.objects.filter(MembershipSnapshot.get_involvement_query([1], [2])).count(), 1)
+        subscription.license_set.filter(team_id=3).first().delete()
+        self.assertEqual(list(MembershipSnapshot.objects.get(adherent_id=5).involvements.values_list('team_id', 'activity_id')), [(1, 1)])
+        Subscription.objects.filter(adherent_id=5).update(status=Subscription.STATUS_CANCEL)
+        self.assertEqual(MembershipSnapshot.objects.get(adherent_id=5).status, Subscription.STATUS_CANCEL)
+
+        adherent = Adherent.objects.get(id=5)
+        adherent.birthday = date(1999, 5, 1)
+        adherent.save()
+        self.assertEqual(MembershipSnapshot.objects.get(adherent_id=5).age_category.name, "Poussins")
+        self.addCleanup(clear_age_cache, Age)
+        age_item = Age.objects.get(name="Poussins")
+        age_item.minimum = 11
+        age_item.save()
+        self.assertIsNone(MembershipSnapshot.objects.get(adherent_id=5).age_category_id)
+        Parameter.change_value('member-family-type', 3)
+        Params.clear()
+        family = LegalEntity.objects.create(name='Dalton', structure_type_id=3, address='rue de la liberté', postal_code='97250', city='LE PRECHEUR', country='MARTINIQUE',
+                                            tel2='02-78-45-12-95', email='dalton@worldcompany.com')
+        responsability = Responsability.objects.create(individual=adherent, legal_entity=family)
+        self.assertEqual(MembershipSnapshot.objects.get(adherent_id=5).family_id, family.id)
+        responsability.delete()
+        self.assertIsNone(MembershipSnapshot.objects.get(adherent_id=5).family_id)
+
+        MembershipSnapshot.objects.all().delete()
+        self.assertEqual(MembershipInvolvement.objects.count(), 0)
+        out = StringIO()
+        call_command('member_snapshot', stdout=out)
+        self.assertEqual(out.getvalue().strip(), '5 membership snapshot(s) rebuilt')
+        self.assertEqual(MembershipSnapshot.objects.filter(MembershipSnapshot.get_involvement_query([1])).count(), 3)
+
+    def test_prefetch_virtual_fields(self):
+        self.add_subscriptions()
+        dateref = date(2009, 10, 1)
+        for adherent in Adherent.objects.all().with_virtual_fields(None, dateref):
+            adherent.date_ref = dateref
+            expected = Adherent.objects.get(id=adherent.id)
+            expected.date_ref = dateref
+            for fieldname in AdherentQuerySet.VIRTUAL_FIELDS:
+                self.assertEqual(getattr(adherent, fieldname), getattr(expected, fieldname), fieldname)
+
+        def evaluate_fields(items):
+            with CaptureQueriesContext(connection) as queries:
+                for adherent in items:
+                    adherent.date_ref = dateref
+                    [str(getattr(adherent, fieldname)) for fieldname in AdherentQuerySet.VIRTUAL_FIELDS]
+            return len(queries)
+        self.assertEqual(evaluate_fields(Adherent.objects.all().with_virtual_fields(None, dateref)[:2]),
+                         evaluate_fields(Adherent.objects.all().with_virtual_fields(None, dateref)))
+
+    def test_age_category_annotation(self):
+        self.add_subscriptions()
+        dateref = date(2009, 10, 1)
+        for adherent in Adherent.objects.all().with_age_category(dateref):
+            expected = Adherent.objects.get(id=adherent.id)
+            expected.date_ref = dateref
+            adherent.date_ref = dateref
+            self.assertEqual(adherent.age_category_id, expected.age_category.id if expected.age_category is not None else None)
+            self.assertEqual(adherent.age_category, expected.age_category)
+        self.assertEqual(list(Adherent.objects.all().with_age_category(dateref).order_by('-age_category_id').values_list('id', 'age_category_id')),
+                         [(6, 7), (5, 6), (4, 5), (3, 2), (2, 1)])
+        self.assertEqual(list(Adherent.objects.all().with_age_category(dateref).filter(age_category_id__gte=5).values_list('id', flat=True)), [4, 5, 6])
+        Adherent.objects.filter(id=3).update(birthday=date(1999, 1, 1))
+        self.assertEqual({age_category_id: nb for age_category_id, nb in Adherent.objects.all().with_age_category(dateref).order_by().values('age_category_id').annotate(nb=Count('id')).values_list('age_category_id', 'nb')},
+                         {1: 2, 5: 1, 6: 1, 7: 1})
+        self.addCleanup(clear_age_cache, Age)
+        Age.get_ranges()
+        with CaptureQueriesContext(connection) as age_queries:
+            Age.get_category_case(dateref)
+        self.assertEqual(len(age_queries), 0)
+        age_item = Age.objects.get(name="Poussins")
+        age_item.maximum = 11
+        age_item.save()
+        self.assertIn([age_item.id, 9, 11], [list(age_range) for age_range in Age.get_ranges()])
+
+        self.factory.xfer = AdherentActiveList()
+        self.calljson('/diacamma.member/adherentActiveList', {'dateref': '2009-10-01', 'age': '%d' % age_item.id}, False)
+        self.assert_observer('core.custom', 'diacamma.member', 'adherentActiveList')
+        self.assert_count_equal('adherent', Adherent.objects.all().with_age_category(dateref).filter(age_category_id=age_item.id).count())
+
+    def test_filter_exists(self):
+        self.add_subscriptions(year=2008, season_id=9)
+        self.add_subscriptions(year=2009, season_id=10, status=1, create_adh_sub=False)
+        License.objects.create(subscription=Subscription.objects.get(adherent_id=6, season_id=10), team_id=2, activity_id=1)
+        for dateref in (date(2008, 11, 1), date(2009, 11, 1)):
+            for status in (Subscription.STATUS_WAITING_BUILDING, Subscription.STATUS_BUILDING, Subscription.STATUS_VALID):
+                for teams, activities in ((None, None), ([1], None), ([2, 3], None), (None, [2]), ([1], [2]), ([2], [2]), ([1, 2], [1])):
+                    join_filter = Q(subscription__begin_date__lte=dateref) & Q(subscription__end_date__gte=dateref)
+                    if teams is not None:
+                        join_filter &= Q(subscription__license__team__in=teams) | Q(subscription__prestations__team__in=teams)
+                    if activities is not None:
+                        join_filter &= Q(subscription__license__activity__in=activities) | Q(subscription__prestations__activity__in=activities)
+                    if status == Subscription.STATUS_WAITING_BUILDING:
+                        join_filter &= Q(subscription__status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID))
+                        subscription_filter = Q(status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID))
+                    else:
+                        join_filter &= Q(subscription__status=status)
+                        subscription_filter = Q(status=status)
+                    subscription_filter &= Q(begin_date__lte=dateref) & Q(end_date__gte=dateref) & MembershipSnapshot.get_involvement_query(teams, activities)
+                    expected = list(Adherent.objects.filter(join_filter).distinct().order_by('id').values_list('id', flat=True))
+                    exists_query = Adherent.objects.filter(MembershipSnapshot.get_adherent_exists(subscription_filter)).order_by('id')
+                    self.assertEqual(list(exists_query.values_list('id', flat=True)), expected, (dateref, status, teams, activities))
+                    self.assertNotIn('DISTINCT', str(exists_query.query))
+        self.assertEqual(list(Adherent.objects.filter(MembershipSnapshot.get_adherent_exists(Q(season_id=10) & MembershipSnapshot.get_involvement_query([2], [1]))).values_list('id', flat=True)), [2, 6])
+
+    def test_generate_club(self):
+        default_subscription()
+        adherents = generate_club(12, seed=3)
+        self.assertEqual(len(adherents), 12)
+        self.assertEqual(Subscription.objects.filter(season_id=9).count(), 12)
+        self.assertEqual(License.objects.filter(subscription__season_id=9).count(), 12)
+        self.assertEqual(list(Subscription.objects.filter(season_id=10).order_by('adherent_id').values_list('adherent__firstname', flat=True)),
+                         ['Firstname000000', 'Firstname000002', 'Firstname000004', 'Firstname000005', 'Firstname000007', 'Firstname000008', 'Firstname000010', 'Firstname000011'])
+        self.assertEqual([adherent.birthday for adherent in adherents[:3]], ['2003-10-19', '1975-05-09', '2006-09-28'])
+
+    def test_query_budget(self):
+        default_subscription()
+        generate_club(30)
+        check_query_budget(self, AdherentActiveList(), '/diacamma.member/adherentActiveList', {'dateref': '2009-10-01'})
+        check_query_budget(self, AdherentActiveList(), '/diacamma.member/adherentActiveList', {'dateref': '2009-10-01'}, nb_queries=19)
+        self.assert_count_equal('adherent', 22)
+        generate_club(70, first_index=30)
+        check_query_budget(self, AdherentActiveList(), '/diacamma.member/adherentActiveList', {'dateref': '2009-10-01'})
+        recorder = check_query_budget(self, AdherentActiveList(), '/diacamma.member/adherentActiveList', {'dateref': '2009-10-01'}, nb_queries=19)
+        self.assert_count_equal('adherent', 25)
+        self.assertEqual(recorder.get_exceeded({'queries': 15, 'duplicates': None}), ['queries'])
+        with self.assertLogs('diacamma.member.queries', 'WARNING') as logs:
+            recorder.log({'queries': 15})
+        self.assertIn('adherentActiveList: 19 queries', logs.output[0])
+        Parameter.change_value("member-size-page", 250)
+        Params.clear()
+        generate_club(80, first_index=100)
+        check_query_budget(self, AdherentActiveList(), '/diacamma.member/adherentActiveList', {'dateref': '2009-10-01'})
+        recorder = check_query_budget(self, AdherentActiveList(), '/diacamma.member/adherentActiveList', {'dateref': '2009-10-01'})
+        self.assert_count_equal('adherent', 114)
+        self.assertEqual(recorder.get_exceeded({'queries': 19, 'duplicates': None}), [])
+
+    def test_query_budget_without_dateref(self):
+        Parameter.change_value("member-fields", "firstname;lastname;age_from_ref;last_subscription")
+        Params.clear()
+        default_subscription()
+        generate_club(30)
+        check_query_budget(self, AdherentActiveList(), '/diacamma.member/adherentActiveList', {})
+        recorder = check_query_budget(self, AdherentActiveList(), '/diacamma.member/adherentActiveList', {})
+        self.assertLess(recorder.nb_queries, 20)
+        generate_club(70, first_index=30)
+        check_query_budget(self, AdherentActiveList(), '/diacamma.member/adherentActiveList', {})
+        check_query_budget(self, AdherentActiveList(), '/diacamma.member/adherentActiveList', {}, nb_queries=recorder.nb_queries)
+        self.assert_count_equal('adherent', 25)
+
     @patch("django.utils.timezone.now")
     def test_renew(self, mock_now):
         mock_now.return_value = datetime(year=2015, month=4, day=1)
@@ -1245,6 +1539,145 @@ class AdherentTest(BaseAdherentTest):
         self.assert_json_equal('', 'subscription/@1/involvement', ["team3 [activity2] 470"])
         self.assert_json_equal('', 'subscription/@1/status', 2)
 
+    @patch("django.utils.timezone.now")
+    def test_renew_partial(self, mock_now):
+        mock_now.return_value = datetime(year=2015, month=4, day=1)
+
+        self.add_subscriptions()
+        sub4 = SubscriptionType.objects.get(name="Calendar")
+        sub4.state = SubscriptionType.STATE_UNACTIVATE
+        sub4.save()
+
+        self.factory.xfer = AdherentRenew()
+        self.calljson('/diacamma.member/adherentRenew', {'dateref': '2010-10-01', 'CONFIRME': 'YES', 'adherent': '2;5;6'}, False)
+        self.assert_observer('core.dialogbox', 'diacamma.member', 'adherentRenew')
+        self.assert_json_equal('', 'text', "2 adhérent(s) renouvelé(s), 1 échec(s):{[br/]}Dalton Joe: Aucun type de cotisation actif !")
+        self.assertEqual(self.response_json['close']['id'], "diacamma.member/adherentSendSubscription")
+        self.assertEqual(self.response_json['close']['params']['adherent'], '2;6')
+
+        self.assertEqual(Subscription.objects.filter(adherent_id=5).count(), 1)
+        self.assertEqual(Subscription.objects.filter(adherent_id__in=(2, 6), season_id=11, status=Subscription.STATUS_BUILDING).count(), 2)
+        self.assertEqual(MembershipSnapshot.objects.filter(adherent_id__in=(2, 6), season_id=11, status=Subscription.STATUS_BUILDING).count(), 2)
+        self.assertEqual(Bill.objects.filter(bill_type=Bill.BILLTYPE_QUOTATION, status=Bill.STATUS_VALID).count(), 2)
+
+    @patch("django.utils.timezone.now")
+    def test_renew_background(self, mock_now):
+        mock_now.return_value = datetime(year=2015, month=4, day=1)
+        self.add_subscriptions()
+
+        with patch.object(MemberJob, 'SYNC_LIMIT', 0), patch.object(MemberJob, 'CHUNK_SIZE', 1):
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.factory.xfer = AdherentRenew()
+                self.calljson('/diacamma.member/adherentRenew', {'dateref': '2010-10-01', 'CONFIRME': 'YES', 'adherent': '2;5;6'}, False)
+        self.assertEqual([MemberJob.schedule], callbacks)
+        LucteriosScheduler.get_scheduler().remove_all_jobs()
+        self.assert_observer('core.acknowledge', 'diacamma.member', 'adherentRenew')
+        self.assertEqual(self.response_json['action']['id'], "diacamma.member/memberJobShow")
+        job_id = self.response_json['action']['params']['memberjob']
+        self.assertEqual(Subscription.objects.filter(season_id=11).count(), 0)
+
+        self.factory.xfer = MemberJobShow()
+        self.calljson('/diacamma.member/memberJobShow', {'memberjob': job_id}, False)
+        LucteriosScheduler.get_scheduler().remove_all_jobs()
+        self.assert_observer('core.custom', 'diacamma.member', 'memberJobShow')
+        self.assert_json_equal('LABELFORM', 'status', "en attente")
+        self.assert_json_equal('LABELFORM', 'progress', "0 % (0 / 3)")
+        self.assertEqual(len(self.json_actions), 2)
+
+        other_user = LucteriosUser.objects.create_user(username='other', password='other')
+        admin_user = self.factory.user
+        self.factory.user = other_user
+        try:
+            self.factory.xfer = MemberJobShow()
+            self.calljson('/diacamma.member/memberJobShow', {'memberjob': job_id}, False)
+            self.assert_observer('core.exception', 'diacamma.member', 'memberJobShow')
+            MemberJob.objects.filter(id=job_id).update(user=other_user)
+            self.factory.xfer = MemberJobShow()
+            self.calljson('/diacamma.member/memberJobShow', {'memberjob': job_id}, False)
+            LucteriosScheduler.get_scheduler().remove_all_jobs()
+            self.assert_observer('core.custom', 'diacamma.member', 'memberJobShow')
+        finally:
+            self.factory.user = admin_user
+
+        with patch.object(MemberJob, 'CHUNK_SIZE', 1):
+            self.assertEqual(MemberJob.run_pending(), 1)
+        self.assertEqual(Subscription.objects.filter(adherent_id__in=(2, 5, 6), season_id=11, status=Subscription.STATUS_BUILDING).count(), 3)
+
+        self.factory.xfer = MemberJobShow()
+        self.calljson('/diacamma.member/memberJobShow', {'memberjob': job_id}, False)
+        self.assert_observer('core.custom', 'diacamma.member', 'memberJobShow')
+        self.assert_json_equal('LABELFORM', 'status', "terminé")
+        self.assert_json_equal('LABELFORM', 'progress', "100 % (3 / 3)")
+        self.assert_json_equal('LABELFORM', 'result', "3 adhérent(s) renouvelé(s), 0 échec(s):{[br/]}")
+        self.assertEqual(len(self.json_actions), 2)
+        self.assert_action_equal('POST', self.json_actions[0], ('Envoyer', 'mdi:mdi-email-outline', 'diacamma.member', 'adherentSendSubscription', 1, 1, 1, {'adherent': '2;5;6'}))
+
+    @patch("django.utils.timezone.now")
+    def test_renew_resume(self, mock_now):
+        mock_now.return_value = datetime(year=2015, month=4, day=1)
+        self.add_subscriptions()
+        job = MemberJob.submit('renew', {'adherents': [2, 5, 6], 'dateref': '2010-10-01'})
+        self.assertEqual(job.get_items(), [[2], [5], [6]])
+        original_run_chunk = RenewJob.run_chunk
+
+        def crash_run_chunk(params, items, state):
+            if items == [[5]]:
+                raise KeyboardInterrupt()
+            return original_run_chunk(params, items, state)
+        with patch.object(MemberJob, 'CHUNK_SIZE', 1), patch.object(RenewJob, 'run_chunk', side_effect=crash_run_chunk):
+            self.assertTrue(job.claim())
+            with self.assertRaises(KeyboardInterrupt):
+                job.execute()
+        job.refresh_from_db()
+        self.assertEqual(job.status, MemberJob.STATUS_RUNNING)
+        self.assertEqual(job.done, 1)
+        self.assertEqual(list(Subscription.objects.filter(season_id=11).values_list('adherent_id', flat=True)), [2])
+
+        self.assertEqual(MemberJob.run_pending(), 0)
+        mock_now.return_value = datetime(year=2015, month=4, day=1, hour=1)
+        with patch.object(MemberJob, 'CHUNK_SIZE', 1):
+            self.assertEqual(MemberJob.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, MemberJob.STATUS_FINISHED)
+        self.assertEqual(job.done, 3)
+        self.assertEqual(job.get_state()['adherents'], [2, 5, 6])
+        self.assertEqual(Subscription.objects.filter(adherent_id__in=(2, 5, 6), season_id=11).count(), 3)
+
+    @patch("django.utils.timezone.now")
+    def test_renew_chunk_failure(self, mock_now):
+        mock_now.return_value = datetime(year=2015, month=4, day=1)
+        self.add_subscriptions()
+        job = MemberJob.submit('renew', {'adherents': [2, 5, 6], 'dateref': '2010-10-01'})
+        original_run_chunk = RenewJob.run_chunk
+
+        def failing_run_chunk(params, items, state):
+            if items == [[5]]:
+                state['adherents'].append(5)
+                raise LucteriosException(IMPORTANT, 'chunk failure')
+            return original_run_chunk(params, items, state)
+        with patch.object(MemberJob, 'CHUNK_SIZE', 1), patch.object(RenewJob, 'run_chunk', side_effect=failing_run_chunk):
+            self.assertTrue(job.claim())
+            job.execute()
+        self.assertEqual(job.status, MemberJob.STATUS_FAILURE)
+        self.assertEqual(job.done, 1)
+        self.assertEqual(job.get_state()['adherents'], [2])
+        self.assertEqual(job.get_state()['errors'], ['chunk failure'])
+
+    def test_command_deleted_adherent(self):
+        self.add_subscriptions()
+        adherent_ids = [2, create_adherent("Rantanplan", 'Chien', '2010-01-01').id, create_adherent("Jolly", 'Jumper', '2010-01-01').id]
+        commands = [{"adherent": adherent_id, "type": 1, "team": [], "activity": [], "licence": [], "reduce": 0.0, "prestations": []} for adherent_id in adherent_ids]
+        Adherent.objects.get(id=adherent_ids[1]).delete()
+        job = MemberJob.submit('command', {'commands': commands, 'dateref': '2010-10-01', 'sendemail': None})
+        self.assertEqual(job.total, 2)
+        self.assertEqual(job.get_state()['errors'], ["L'adhérent n°%d n'existe plus !" % adherent_ids[1]])
+        Adherent.objects.get(id=adherent_ids[2]).delete()
+        self.assertTrue(job.claim())
+        job.execute()
+        self.assertEqual(job.status, MemberJob.STATUS_FINISHED)
+        self.assertEqual(job.get_state()['errors'], ["L'adhérent n°%d n'existe plus !" % adherent_ids[1], "L'adhérent n°%d n'existe plus !" % adherent_ids[2]])
+        self.assertEqual(job.get_state()['nb_sub'], 1)
+
     def test_import(self):
         csv_content = """'nom','prenom','sexe','adresse','codePostal','ville','fixe','portable','mail','DateNaissance','LieuNaissance','Type','NumLicence','Equipe','Activite'
 'USIF','Pierre','Homme','37 avenue de la plage','99673','TOUINTOUIN','0502851031','0439423854','pierre572@free.fr','12/09/1961','BIDON SUR MER','Annually','1000029-00099','team1','activity1'
@@ -1671,6 +2104,7 @@ class AdherentTest(BaseAdherentTest):
             self.calljson('/diacamma.member/adherentCommand', {'dateref': '2015-10-01', 'SAVE': 'YES', 'CMD_FILE': cmd_file, 'send_email': True}, False)
             self.assert_observer('core.dialogbox', 'diacamma.member', 'adherentCommand')
 
+            self.assertEqual(2, MemberEmail.send_pending())
             self.assertEqual(2, server.count())
             self.assertEqual('mr-sylvestre@worldcompany.com', server.get(0)[1])
             self.assertEqual(['Joe.Dalton@worldcompany.com', 'mr-sylvestre@worldcompany.com'], server.get(0)[2])
@@ -2162,8 +2596,11 @@ class AdherentTest(BaseAdherentTest):
             self.factory.xfer = AdherentConnection()
             self.calljson('/diacamma.member/adherentConnection', {'CONFIRME': 'YES', 'RELOAD': 'YES'}, False)
             self.assert_observer('core.custom', 'diacamma.member', 'adherentConnection')
+            self.assert_json_equal('LABELFORM', 'info', '{[center]}{[b]}Résultat{[/b]}{[/center]}{[br/]}1 connexion(s) supprimée(s).{[br/]}4 connexion(s) ajoutée(s).{[br/]}1 connexion(s) réactivée(s).')
+            self.assertEqual(0, server.count())
+            self.assertEqual(4, MemberEmail.send_pending())
             print('email sending %s' % [server.get(srv_id)[2] for srv_id in range(server.count())])
-            self.assert_json_equal('LABELFORM', 'info', '{[center]}{[b]}Résultat{[/b]}{[/center]}{[br/]}1 connexion(s) supprimée(s).{[br/]}3 connexion(s) ajoutée(s).{[br/]}1 connexion(s) réactivée(s).{[br/]}{[br/]}1 courriel(s) ont échoué:{[ul]}{[li]}Dalton Joe : ', True)
+            self.assertEqual(['badèèè@worldcompany.com'], [email.recipient for email in MemberEmail.objects.filter(status=MemberEmail.STATUS_WAITING, nb_try=1)])
 
             self.assertEqual([['Avrel.Dalton@worldcompany.com'], ['Jack.Dalton@worldcompany.com'], ['Lucky.Luke@worldcompany.com'], ['William.Dalton@worldcompany.com']], sorted([server.get(srv_id)[2] for srv_id in range(server.count())]))
             self.assertEqual(4, server.count())
@@ -2239,6 +2676,7 @@ class AdherentTest(BaseAdherentTest):
             self.calljson('/diacamma.member/adherentConnection', {'CONFIRME': 'YES', 'RELOAD': 'YES'}, False)
             self.assert_observer('core.custom', 'diacamma.member', 'adherentConnection')
             self.assert_json_equal('LABELFORM', 'info', '{[center]}{[b]}Résultat{[/b]}{[/center]}{[br/]}0 connexion(s) supprimée(s).{[br/]}4 connexion(s) ajoutée(s).{[br/]}1 connexion(s) réactivée(s).')
+            self.assertEqual(5, MemberEmail.send_pending())
 
             print('email sending %s' % [server.get(srv_id)[2] for srv_id in range(server.count())])
             self.assertEqual([['Avrel.Dalton@worldcompany.com'], ['Jack.Dalton@worldcompany.com'], ['Joe.Dalton@worldcompany.com'], ['Lucky.Luke@worldcompany.com'], ['William.Dalton@worldcompany.com']], sorted([server.get(srv_id)[2] for srv_id in range(server.count())]))
@@ -3719,6 +4157,52 @@ class AdherentFamilyTest(BaseAdherentTest):
         self.assert_action_equal('GET', self.get_json_path('#parentbill/action'), ("origine", "mdi:mdi-invoice-edit-outline",
                                                                                    "diacamma.invoice", "billShow", 0, 1, 1, {'bill': 1}))
 
+    @patch("django.utils.timezone.now")
+    def test_regenerate_quotation(self, mock_now):
+        mock_now.return_value = datetime(year=2015, month=4, day=1)
+
+        self.prep_family()
+        self.factory.xfer = SubscriptionAddModify()
+        self.calljson('/diacamma.member/subscriptionAddModify', {'SAVE': 'YES', 'status': 1, 'adherent': 2, 'dateref': '2014-10-01', 'subscriptiontype': 1, 'season': 10, 'team': 2, 'activity': 1, 'value': 'abc123'}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.member', 'subscriptionAddModify')
+        self.factory.xfer = SubscriptionAddModify()
+        self.calljson('/diacamma.member/subscriptionAddModify', {'SAVE': 'YES', 'status': 1, 'adherent': 5, 'dateref': '2014-10-01', 'subscriptiontype': 1, 'season': 10, 'team': 2, 'activity': 1, 'value': 'abc123'}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.member', 'subscriptionAddModify')
+        bill = Bill.objects.get(id=1)
+        self.assertEqual(bill.get_total(), 76.44 + 76.44)
+        detail_ids = list(bill.detail_set.order_by('id').values_list('id', flat=True))
+        self.assertEqual(len(detail_ids), 4)
+
+        Article.objects.filter(reference='ABC5').update(price=70.0)
+        Detail.objects.create(bill=bill, designation='extra', price=10.0, quantity=1)
+
+        job = MemberJob.submit('regenerate_bill', {'season': 10, 'dryrun': True})
+        self.assertTrue(job.launch())
+        self.assertEqual(job.get_result(), "2 cotisations vérifiées: 0 ligne(s) à ajouter, 2 ligne(s) à modifier et 1 ligne(s) à supprimer.")
+        self.assertEqual(bill.detail_set.count(), 5)
+        self.assertEqual(Bill.objects.get(id=1).get_total(), 76.44 + 76.44 + 10.0)
+
+        job = MemberJob.submit('regenerate_bill', {'season': 10})
+        self.assertTrue(job.launch())
+        self.assertEqual(job.get_result(), "2 cotisations ont été régénérés.")
+        self.assertEqual(list(bill.detail_set.order_by('id').values_list('id', flat=True)), detail_ids)
+        self.assertEqual(Bill.objects.get(id=1).get_total(), 82.34 + 82.34)
+
+        Detail.objects.filter(id=detail_ids[0]).update(reduce=5.0)
+        job = MemberJob.submit('regenerate_bill', {'season': 10})
+        self.assertTrue(job.launch())
+        self.assertEqual(list(bill.detail_set.order_by('id').values_list('id', flat=True)), detail_ids)
+        self.assertEqual(Bill.objects.get(id=1).get_total(), 82.34 + 82.34)
+
+        category = Category.objects.create(name='cotisation', designation='cotisation')
+        Article.objects.get(reference='ABC5').categories.add(category)
+        AutomaticReduce.objects.create(name='famille', category=category, mode=AutomaticReduce.MODE_BYVALUE, amount=10.0, occurency=2)
+        FiscalYear.objects.filter(id=FiscalYear.get_current().id).update(begin='2010-01-01')
+        job = MemberJob.submit('regenerate_bill', {'season': 10})
+        self.assertTrue(job.launch())
+        self.assertEqual(bill.detail_set.count(), 4)
+        self.assertEqual(sorted(bill.detail_set.values_list('reduce', flat=True)), [0.0, 0.0, 0.0, 10.0])
+
     @patch("django.utils.timezone.now")
     def test_cancel_cotation(self, mock_now):
         mock_now.return_value = datetime(year=2015, month=4, day=1)
@@ -3851,6 +4335,7 @@ class AdherentFamilyTest(BaseAdherentTest):
             self.calljson('/diacamma.member/adherentCommand', {'dateref': '2015-10-01', 'SAVE': 'YES', 'CMD_FILE': cmd_file, 'send_email': True}, False)
             self.assert_observer('core.dialogbox', 'diacamma.member', 'adherentCommand')
 
+            self.assertEqual(1, MemberEmail.send_pending())
             self.assertEqual(1, server.count())
             self.assertEqual('mr-sylvestre@worldcompany.com', server.get(0)[1])
             self.assertEqual(['dalton@worldcompany.com', 'Avrel.Dalton@worldcompany.com', 'Joe.Dalton@worldcompany.com', 'mr-sylvestre@worldcompany.com'], server.get(0)[2])
@@ -3977,6 +4462,61 @@ class AdherentFamilyTest(BaseAdherentTest):
         self.assert_json_equal('', 'bill/@2/third', "Dalton Jack")
         self.assert_json_equal('', 'bill/@3/third', "Luke Lucky")
 
+    def test_contact_list(self):
+        self.add_subscriptions()
+        family_id = self.add_family()
+        old_family = LegalEntity.objects.create(name="OLD DALTONS", structure_type_id=3, email="old@worldcompany.com")
+        Responsability.objects.create(individual_id=5, legal_entity=old_family)
+        Responsability.objects.create(individual_id=2, legal_entity_id=family_id)
+        Responsability.objects.create(individual_id=5, legal_entity_id=family_id)
+
+        self.factory.xfer = AdherentContactList()
+        with QueryRecorder() as recorder:
+            self.calljson('/diacamma.member/adherentContactList', {'dateref': '2009-10-01'}, False)
+        self.assert_observer('core.custom', 'diacamma.member', 'adherentContactList')
+        self.assert_count_equal('abstractcontact', 5)
+        self.assert_json_equal('', 'abstractcontact/@0/ident', "Dalton Jack")
+        self.assert_json_equal('', 'abstractcontact/@0/adherents', ["Dalton Jack"])
+        self.assert_json_equal('', 'abstractcontact/@1/ident', "Dalton William")
+        self.assert_json_equal('', 'abstractcontact/@2/ident', "LES DALTONS")
+        self.assert_json_equal('', 'abstractcontact/@2/adherents', ["Dalton Avrel", "Dalton Joe"])
+        self.assertEqual(sorted(self.get_json_path('abstractcontact/@2/emails')), ['Avrel.Dalton@worldcompany.com', 'Joe.Dalton@worldcompany.com', 'dalton@worldcompany.com'])
+        self.assert_json_equal('', 'abstractcontact/@3/ident', "Luke Lucky")
+        self.assert_json_equal('', 'abstractcontact/@4/ident', "OLD DALTONS")
+        self.assert_json_equal('', 'abstractcontact/@4/adherents', [])
+        self.assertEqual(sorted(self.get_json_path('abstractcontact/@4/emails')), ['Joe.Dalton@worldcompany.com', 'old@worldcompany.com'])
+        nb_queries = recorder.nb_queries
+
+        for index, adherent_id in enumerate((3, 4, 6)):
+            new_family = LegalEntity.objects.create(name="NEW FAMILY %d" % index, structure_type_id=3, email="")
+            Responsability.objects.create(individual_id=adherent_id, legal_entity=new_family)
+        self.factory.xfer = AdherentContactList()
+        with QueryRecorder() as recorder:
+            self.calljson('/diacamma.member/adherentContactList', {'dateref': '2009-10-01'}, False)
+        self.assert_count_equal('abstractcontact', 5)
+        self.assert_json_equal('', 'abstractcontact/@1/ident', "NEW FAMILY 0")
+        self.assert_json_equal('', 'abstractcontact/@1/adherents', ["Dalton William"])
+        self.assert_json_equal('', 'abstractcontact/@3/ident', "NEW FAMILY 2")
+        self.assert_json_equal('', 'abstractcontact/@3/adherents', ["Luke Lucky"])
+        self.assertEqual(nb_queries, recorder.nb_queries)
+
+        self.factory.xfer = AdherentContactPrint()
+        self.calljson('/diacamma.member/adherentContactPrint', {'dateref': '2009-10-01', "PRINT_MODE": 4}, False)
+        self.assert_observer('core.print', 'diacamma.member', 'adherentContactPrint')
+        csv_value = b64decode(str(self.response_json['print']['content'])).decode("utf-8")
+        self.assertIn('Dalton Avrel', csv_value)
+        self.assertIn('Luke Lucky', csv_value)
+
+        with self.settings(DIACAMMA_MEMBER_STREAMING_LIMIT=2), patch('diacamma.member.streaming.CHUNK_SIZE', 2):
+            self.factory.xfer = AdherentContactPrint()
+            self.calljson('/diacamma.member/adherentContactPrint', {'dateref': '2009-10-01', "PRINT_MODE": 4}, False)
+            self.assert_observer('core.custom', 'diacamma.member', 'adherentContactPrint')
+            with open(self.get_json_path('filename'), encoding='utf-8', newline='') as csv_file:
+                self.assertEqual([line.strip() for line in csv_file.read().split('\n') if line.strip() != ''], [line.strip() for line in csv_value.split('\n') if line.strip() != ''])
+            self.factory.xfer = AdherentContactPrint()
+            with self.assertLogs('diacamma.member', level='WARNING'):
+                self.calljson('/diacamma.member/adherentContactPrint', {'dateref': '2009-10-01', "PRINT_MODE": 2}, False)
+
     def test_import(self):
         csv_content = """"nom","prenom","sexe","famille","adresse","codePostal","ville","fixe","portable","mail","Type"
 "Dalton","Avrel","Homme","LES DALTONS","rue de la liberté","99673","TOUINTOUIN","0502851031","0439423854","avrel.dalton@worldcompany.com","Annually"
@@ -4019,16 +4559,20 @@ class AdherentFamilyTest(BaseAdherentTest):
         self.assert_count_equal('Array', 7)
 
         self.factory.xfer = ContactImport()
-        self.calljson('/lucterios.contacts/contactImport', {'step': 4, 'modelname': 'member.Adherent', 'quotechar': '"', 'delimiter': ',',
-                                                            'encoding': 'utf-8', 'dateformat': '%d/%m/%Y', 'importcontent0': csv_content,
-                                                            "fld_lastname": "nom", "fld_firstname": "prenom", "fld_address": "adresse",
-                                                            "fld_postal_code": "codePostal", "fld_city": "ville", "fld_email": "mail",
-                                                            'fld_subscriptiontype': 'Type', 'fld_family': 'famille', }, False)
+        with patch.object(MemberSequence, 'allocate', wraps=MemberSequence.allocate) as allocate_mock:
+            self.calljson('/lucterios.contacts/contactImport', {'step': 4, 'modelname': 'member.Adherent', 'quotechar': '"', 'delimiter': ',',
+                                                                'encoding': 'utf-8', 'dateformat': '%d/%m/%Y', 'importcontent0': csv_content,
+                                                                "fld_lastname": "nom", "fld_firstname": "prenom", "fld_address": "adresse",
+                                                                "fld_postal_code": "codePostal", "fld_city": "ville", "fld_email": "mail",
+                                                                'fld_subscriptiontype': 'Type', 'fld_family': 'famille', }, False)
         self.assert_observer('core.custom', 'lucterios.contacts', 'contactImport')
         self.assert_count_equal('', 3)
         self.assert_json_equal('LABELFORM', 'result', "7 éléments ont été importés")
         self.assert_json_equal('LABELFORM', 'import_error', [])
         self.assertEqual(len(self.json_actions), 1)
+        self.assertEqual([call_args.args for call_args in allocate_mock.call_args_list], [('adherent', AdherentImportBatch.NUM_BLOCK)])
+        self.assertEqual(list(Adherent.objects.order_by('id').values_list('num', flat=True)), list(range(1, 10)))
+        self.assertEqual(MemberSequence.objects.get(name='adherent').value, 9)
 
         self.factory.xfer = AdherentActiveList()
         self.calljson('/diacamma.member/adherentActiveList', {'dateref': '2010-01-15'}, False)
@@ -4065,6 +4609,9 @@ class AdherentFamilyTest(BaseAdherentTest):
         self.assert_json_equal('', 'bill/@3/total', 76.44)  # Subscription: art1:12.34 + art5:64.10
         self.assert_json_equal('', 'bill/@4/third', "UHADIK-FEPIZIBU")
         self.assert_json_equal('', 'bill/@4/total', 152.88)  # Subscription: art1:12.34 + art5:64.10 x 2
+        self.assertEqual(Detail.objects.filter(bill__third__contact__legalentity__name="LES DALTONS").count(), 4)
+        self.assertEqual(Subscription.objects.filter(bill__isnull=True).count(), 0)
+        self.assertIsNone(Adherent.get_import_batch())
 
         self.factory.xfer = AdherentContactList()
         self.calljson('/diacamma.member/adherentContactList', {'dateref': '2010-01-15'}, False)
@@ -4561,6 +5108,7 @@ class SubscriptionModeTest(BaseAdherentTest):
             self.assertEqual(last_subscription.begin_date.isoformat(), params['begin_date'] if 'begin_date' in params else '2009-09-01')
             self.assertEqual(last_subscription.license_set.first().team_id, params['team'])
             self.assertEqual(last_subscription.license_set.first().activity_id, params['activity'])
+            self.assertEqual(nb_mail, MemberEmail.send_pending())
             self.assertEqual(nb_mail, server.count())
             if nb_mail == 1:
                 _msg_txt, msg, msg_file = server.check_first_message('Nouvelle cotisation', 3, {'To': 'Joe.Dalton@worldcompany.com'})
@@ -5508,6 +6056,85 @@ class TaxtReceiptTest(InvoiceTest):
         self.assert_observer('core.custom', 'diacamma.member', 'taxReceiptList')
         self.assert_count_equal('taxreceipt', 0)
 
+    def _add_paid_donation(self, date_bill, date_payoff, third_id=4):
+        details = [{'article': 4, 'designation': 'article 4', 'price': '100.00', 'quantity': 1}]
+        bill_id = self._create_bill(details, 1, date_bill, third_id, True)
+        self.factory.xfer = PayoffAddModify()
+        self.calljson('/diacamma.payoff/payoffAddModify', {'SAVE': 'YES', 'supporting': bill_id, 'amount': '100.0', 'payer': "Ma'a Dalton", 'date': date_payoff, 'mode': 0, 'reference': 'abc', 'bank_account': 0}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.payoff', 'payoffAddModify')
+        self.factory.xfer = EntryAccountClose()
+        self.calljson('/diacamma.accounting/entryAccountClose',
+                      {'CONFIRME': 'YES', 'year': '1', 'journal': '0', "entryline": ";".join([str(line_id) for line_id in EntryLineAccount.objects.filter(entry__close=False).values_list('id', flat=True)])}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.accounting', 'entryAccountClose')
+
+    def test_extract_link_graph(self):
+        self._add_paid_donation('2015-04-01', '2015-04-03')
+        with CaptureQueriesContext(connection) as one_entry_queries:
+            receipts = TaxReceipt.get_receipts_to_create(2015)
+        self.assertEqual(len(receipts), 1)
+        self.assertEqual(len(receipts[0]['entries']), 1)
+        self.assertEqual(receipts[0]['date'], date(2015, 4, 3))
+
+        self._add_paid_donation('2015-05-01', '2015-05-12')
+        self._add_paid_donation('2015-06-01', '2015-06-20')
+        with CaptureQueriesContext(connection) as three_entries_queries:
+            receipts = TaxReceipt.get_receipts_to_create(2015)
+        self.assertEqual(len(receipts), 1)
+        self.assertEqual(len(receipts[0]['entries']), 3)
+        self.assertEqual(receipts[0]['date'], date(2015, 6, 20))
+        self.assertLessEqual(len(three_entries_queries), len(one_entry_queries))
+
+    def test_valid_render_resume(self):
+        self._add_paid_donation('2015-04-01', '2015-04-03')
+        self._add_paid_donation('2015-04-01', '2015-04-03', 5)
+        TaxReceipt.create_all(2015)
+        taxitem_ids = TaxReceipt.number_all(2015)
+        self.assertEqual(len(taxitem_ids), 2)
+        self.assertEqual(TaxReceipt.objects.get(id=taxitem_ids[0]).num, 1)
+        self.assertEqual(DocumentContainer.objects.filter(metadata='TaxReceipt-%d' % taxitem_ids[0]).count(), 0)
+        with self.settings(DIACAMMA_MEMBER_PDF_WORKERS=2), TaxReceipt.render_pool(), patch.object(TaxReceipt, '_render_in_pool', return_value={}) as render_in_pool:
+            with patch.object(Supporting, 'add_pdf_document', return_value=None), self.assertLogs('diacamma.member', level='ERROR'):
+                self.assertEqual(TaxReceipt.render_pdfreports(taxitem_ids), taxitem_ids)
+        self.assertEqual(render_in_pool.call_count, 1)
+        self.assertEqual([taxitem.id for taxitem in render_in_pool.call_args[0][0]], taxitem_ids)
+        self.assertEqual(DocumentContainer.objects.filter(metadata='TaxReceipt-%d' % taxitem_ids[0]).count(), 0)
+        pdf_content = TaxReceipt.get_pdfreport_content(TaxReceipt.objects.get(id=taxitem_ids[1]))
+        with self.settings(DIACAMMA_MEMBER_PDF_WORKERS=2), TaxReceipt.render_pool(), patch.object(TaxReceipt, '_render_in_pool', return_value={taxitem_ids[1]: pdf_content}):
+            with patch.object(TaxReceipt, 'generate_pdfreport', return_value=None), self.assertLogs('diacamma.member', level='ERROR'):
+                self.assertEqual(TaxReceipt.render_pdfreports(taxitem_ids), [taxitem_ids[0]])
+        self.assertEqual(DocumentContainer.objects.filter(metadata='TaxReceipt-%d' % taxitem_ids[1]).count(), 1)
+        with patch.object(Supporting, 'add_pdf_document', return_value=None), patch.object(TaxReceipt, '_render_in_pool') as render_in_pool:
+            with self.assertLogs('diacamma.member', level='ERROR'):
+                self.assertEqual(TaxReceipt.render_pdfreports(taxitem_ids), [taxitem_ids[0]])
+        self.assertEqual(render_in_pool.call_count, 0)
+        admin_user = LucteriosUser.objects.get(username='admin')
+        self.assertEqual(TaxReceipt.render_pdfreports(taxitem_ids, admin_user), [])
+        self.assertEqual(DocumentContainer.objects.filter(metadata='TaxReceipt-%d' % taxitem_ids[0]).count(), 1)
+        self.assertEqual(DocumentContainer.objects.get(metadata='TaxReceipt-%d' % taxitem_ids[0]).creator, admin_user)
+        self.assertEqual(TaxReceipt.get_pdfreport_content(TaxReceipt.objects.get(id=taxitem_ids[0]))[:4], b'%PDF')
+        self.assertEqual(DocumentContainer.objects.filter(metadata='TaxReceipt-%d' % taxitem_ids[0]).count(), 1)
+        self.assertEqual(TaxReceipt.render_pdfreports(taxitem_ids), [])
+        check_report_member(FiscalYear.get_current())
+        self.assertEqual(DocumentContainer.objects.filter(metadata='TaxReceipt-%d' % taxitem_ids[0]).count(), 1)
+
+    def test_valid_job_render_pool(self):
+        self._add_paid_donation('2015-04-01', '2015-04-03')
+        self._add_paid_donation('2015-04-01', '2015-04-03', 5)
+        TaxReceipt.create_all(2015)
+        job = MemberJob.submit('taxreceipt_valid', {'year': 2015})
+        self.assertEqual(len(job.get_items()), 2)
+        with patch('diacamma.member.models.ProcessPoolExecutor') as pool_executor, patch.object(TaxReceipt, '_render_in_pool', return_value={}) as render_in_pool:
+            with self.settings(DIACAMMA_MEMBER_PDF_WORKERS=3), patch.object(MemberJob, 'CHUNK_SIZE', 1):
+                self.assertTrue(job.claim())
+                job.execute(raise_error=True)
+        self.assertEqual(job.status, MemberJob.STATUS_FINISHED)
+        self.assertEqual(pool_executor.call_count, 1)
+        self.assertEqual(pool_executor.call_args[1]['max_workers'], 3)
+        self.assertEqual(render_in_pool.call_count, 2)
+        self.assertEqual(TaxReceipt.objects.filter(year=2015, num__isnull=False).count(), 2)
+        self.assertEqual(DocumentContainer.objects.filter(metadata__startswith='TaxReceipt-').count(), 2)
+        self.assertEqual(TaxReceipt.number_all(2015), [])
+
 
 class AdherentConnectionTest(BaseAdherentTest):
 
@@ -5751,3 +6378,198 @@ class AdherentConnectionTest(BaseAdherentTest):
         self.assert_json_equal('', '', 'OK')
 
         self.assertEqual([str(grp) for grp in LucteriosUser.objects.get(username='avrelD').groups.all()], [])
+
+    def test_connection_bulk(self):
+        default_subscription()
+        generate_club(30)
+        new_groupe = LucteriosGroup.objects.create(name='new_groupe')
+        Parameter.change_value('contacts-defaultgroup', new_groupe.id)
+        Params.clear()
+        season9 = Season.objects.get(id=9)
+        season10 = Season.objects.get(id=10)
+        nb_season10 = Adherent.objects.filter(subscription__season=season10).count()
+        self.assertEqual(20, nb_season10)
+        server = TestReceiver()
+        server.start(AdherentConnectionTest.smtp_port)
+        try:
+            with QueryRecorder() as recorder:
+                self.assertEqual((0, 30, 0), season9.check_connection())
+            self.assertEqual(1, len([sql for sql, _duration in recorder.statements if sql.startswith('INSERT INTO "auth_user"')]))
+            self.assertEqual(1, len([sql for sql, _duration in recorder.statements if sql.startswith('INSERT') and ('"auth_user_groups"' in sql)]))
+            self.assertEqual([], [sql for sql, _duration in recorder.statements if sql.startswith('SELECT "auth_user"."username"')])
+            self.assertEqual(1, len([sql for sql, _duration in recorder.statements if sql.startswith('INSERT INTO "member_memberemail"')]))
+            self.assertEqual(0, server.count())
+            self.assertEqual(30, MemberEmail.objects.filter(body='', user__isnull=False).count())
+            self.assertEqual(0, LucteriosUser.objects.filter(username__startswith='firstname').exclude(password='').count())
+            with patch('lucterios.mailing.email_functions.get_email_server', wraps=get_email_server) as mock_server:
+                self.assertEqual(30, MemberEmail.send_pending())
+            self.assertEqual(2, mock_server.call_count)  # one connection per batch of MemberEmail.BATCH_SIZE emails
+            self.assertEqual(30, server.count())
+            self.assertEqual(['Firstname000000.Lastname000000@worldcompany.com'], server.get(0)[2])
+            _msg, msg = server.check_first_message('Mot de passe de connexion', 2)
+            message = decode_b64(msg.get_payload())
+            self.assertIn('firstname000000L', message)
+            password = re.search(r'[Mm]ot de passe\s*:\s*(.+?)<br/>', message).group(1)
+            self.assertTrue(LucteriosUser.objects.get(username='firstname000000L').check_password(password))
+            self.assertEqual(0, MemberEmail.objects.filter(body__contains=password).count())
+            self.assertEqual(30, MemberEmail.objects.filter(body='', status=MemberEmail.STATUS_SENT).count())
+            self.assertEqual(30, LucteriosUser.objects.filter(is_active=True, username__startswith='firstname').count())
+            self.assertEqual(30, new_groupe.user_set.filter(username__startswith='firstname').count())
+            user = LucteriosUser.objects.get(username='firstname000000L')
+            self.assertNotEqual('', user.password)
+            self.assertEqual('Firstname000000.Lastname000000@worldcompany.com', user.email)
+
+            with QueryRecorder() as recorder:
+                self.assertEqual(30 - nb_season10, season10.disabled_old_connection())
+            self.assertEqual(1, recorder.nb_queries)
+            self.assertEqual(nb_season10, LucteriosUser.objects.filter(is_active=True, username__startswith='firstname').count())
+
+            self.assertEqual((0, 0, 30 - nb_season10), season9.check_connection())
+            self.assertEqual(30 - nb_season10, MemberEmail.send_pending())
+            self.assertEqual(30 + 30 - nb_season10, server.count())
+
+            homonyms = [create_adherent('Jean', 'Dupont', '1980-01-01'), create_adherent('Jean', 'Durand', '1981-01-01'), create_adherent('Jéan', 'Dubois', '1982-01-01')]
+            result = {'nb_add': 0, 'nb_update': 0}
+            season9.check_adherents_connection(homonyms, result)
+            self.assertEqual({'nb_add': 3, 'nb_update': 0}, result)
+            self.assertEqual(['jeanD', 'jeanD1', 'jeanD2'], sorted([Adherent.objects.get(id=adherent.id).user.username for adherent in homonyms]))
+            self.assertEqual(3, MemberEmail.send_pending())
+            self.assertEqual(30 + 30 - nb_season10 + 3, server.count())
+
+            job = MemberJob.submit('check_connection', {'season': 10})
+            self.assertEqual(nb_season10, job.total)
+            with patch.object(MemberJob, 'CHUNK_SIZE', 5):
+                self.assertTrue(job.claim())
+                job.execute()
+            self.assertEqual(job.status, MemberJob.STATUS_FINISHED)
+            self.assertEqual({'errors': [], 'nb_del': 30 - nb_season10 + 3, 'nb_add': 0, 'nb_update': 0, 'prepared': True}, job.get_state())
+            self.assertEqual(nb_season10, LucteriosUser.objects.filter(is_active=True, username__startswith='firstname').count())
+        finally:
+            server.stop()
+
+    def test_connection_bulk_ask_email(self):
+        default_subscription()
+        season9 = Season.objects.get(id=9)
+        adherents = [create_adherent('Jean', 'Dupont', '1980-01-01'), create_adherent('Paul', 'Dupont', '1981-01-01'), create_adherent('Marc', 'Durand', '1982-01-01')]
+        Adherent.objects.filter(id__in=[adherents[0].id, adherents[1].id]).update(email='dupont@worldcompany.com')
+        LucteriosUser.objects.create(username='marc', email='Marc.Durand@worldcompany.com')
+        settings.ASK_LOGIN_EMAIL = True
+        try:
+            result = {'nb_add': 0, 'nb_update': 0, 'errors': []}
+            season9.check_adherents_connection(list(Adherent.objects.filter(id__in=[adherent.id for adherent in adherents]).select_related('user').order_by('id')), result)
+        finally:
+            settings.ASK_LOGIN_EMAIL = False
+        self.assertEqual({'nb_add': 1, 'nb_update': 0, 'errors': []}, result)
+        self.assertEqual(['jeanD', None, None], [adherent.user.username if adherent.user_id is not None else None for adherent in Adherent.objects.filter(id__in=[adherent.id for adherent in adherents]).order_by('id')])
+        email = MemberEmail.objects.get()
+        self.assertEqual('dupont@worldcompany.com', email.recipient)
+        self.assertEqual('jeanD', email.user.username)
+        self.assertEqual('', email.body)
+
+    def test_email_outbox(self):
+        self.add_subscriptions()
+        bills = list(Bill.objects.filter(third__contact__email__contains='@').order_by('id'))
+        for bill in bills:
+            MemberEmail.enqueue_bill(bill, 'New subscription', '<html>Hello</html>', None)
+        self.assertEqual(len(bills), MemberEmail.objects.filter(status=MemberEmail.STATUS_WAITING).count())
+        AbstractContact.objects.filter(id=bills[0].third.contact_id).update(email='badèèè')
+        with self.assertRaises(EmailException):
+            MemberEmail.enqueue_bill(Bill.objects.get(id=bills[0].id), 'New subscription', '<html>Hello</html>', None)
+
+        self.assertEqual(0, MemberEmail.send_pending())
+        email = MemberEmail.objects.order_by('id').first()
+        self.assertEqual(MemberEmail.STATUS_WAITING, email.status)
+        self.assertEqual(1, email.nb_try)
+        self.assertNotEqual('', email.last_error)
+        self.assertTrue(email.next_try > timezone.now())
+        self.assertEqual(0, MemberEmail.send_pending())
+        self.assertEqual(1, MemberEmail.objects.order_by('id').first().nb_try)
+
+        server = TestReceiver()
+        server.start(AdherentConnectionTest.smtp_port)
+        try:
+            with patch('lucterios.mailing.email_functions.get_email_server', wraps=get_email_server) as mock_server:
+                with self.captureOnCommitCallbacks() as callbacks:
+                    self.factory.xfer = MemberEmailRetry()
+                    self.calljson('/diacamma.member/memberEmailRetry', {'memberemail': ";".join([str(email_id) for email_id in MemberEmail.objects.values_list('id', flat=True)])}, False)
+                    self.assert_observer('core.acknowledge', 'diacamma.member', 'memberEmailRetry')
+                self.assertEqual([MemberEmail.schedule], callbacks)
+                self.assertEqual(0, mock_server.call_count)
+                self.assertEqual(len(bills), MemberEmail.send_pending())
+                self.assertEqual(1, mock_server.call_count)
+            self.assertEqual(len(bills), server.count())
+            self.assertEqual([bills[0].third.contact.email], server.get(0)[2][:1])
+        finally:
+            server.stop()
+        self.assertEqual(len(bills), MemberEmail.objects.filter(status=MemberEmail.STATUS_SENT).count())
+        self.assertEqual(0, MemberEmail.send_pending())
+
+        self.factory.xfer = MemberEmailList()
+        self.calljson('/diacamma.member/memberEmailList', {'status_filter': MemberEmail.STATUS_SENT}, False)
+        self.assert_observer('core.custom', 'diacamma.member', 'memberEmailList')
+        self.assert_count_equal('memberemail', len(bills))
+        self.assert_json_equal('', 'memberemail/@0/status', MemberEmail.STATUS_SENT)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'query plans checked on SQLite only')
+class AdherentQueryPlanTest(BaseAdherentTest):
+
+    INDEXED_TABLES = ('member_subscription', 'member_license', 'member_docadherent', 'member_subscription_prestations', 'member_membershipsnapshot', 'event_degree')
+
+    def setUp(self):
+        BaseAdherentTest.setUp(self)
+        Parameter.change_value('member-family-type', 3)
+        self.add_subscriptions(year=2008, season_id=9)
+        self.add_subscriptions(year=2009, season_id=10, status=1, create_adh_sub=False)
+
+    def get_query_plan(self, sql):
+        aliases = {alias: table for table, alias in re.findall(r'"(\w+)" ([A-Z]\d+)\b', sql)}
+        plan = []
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            for row in cursor.fetchall():
+                detail = row[-1]
+                for alias, table in aliases.items():
+                    detail = re.sub(r'^(SCAN|SEARCH) %s\b' % alias, r'\1 %s' % table, detail)
+                plan.append(detail)
+        return plan
+
+    def assert_no_full_scan(self, xfer, url, params):
+        with CaptureQueriesContext(connection) as ctx:
+            self.factory.xfer = xfer
+            self.calljson(url, params, False)
+        nb_checked = 0
+        for query in ctx.captured_queries:
+            if not query['sql'].startswith('SELECT') or not any('"%s"' % table in query['sql'] for table in self.INDEXED_TABLES):
+                continue
+            nb_checked += 1
+            for detail in self.get_query_plan(query['sql']):
+                for table in self.INDEXED_TABLES:
+                    self.assertFalse(re.match(r'^SCAN %s\b' % table, detail), "%s\n%s" % (detail, query['sql']))
+        self.assertGreater(nb_checked, 0)
+
+    def test_active_list(self):
+        self.assert_no_full_scan(AdherentActiveList(), '/diacamma.member/adherentActiveList', {'dateref': '2009-10-01'})
+        self.assert_no_full_scan(AdherentActiveList(), '/diacamma.member/adherentActiveList', {'dateref': '2009-10-01', 'team': '1;2', 'activity': '1', 'status': 1})
+
+    def test_renew_list(self):
+        self.assert_no_full_scan(AdherentRenewList(), '/diacamma.member/adherentRenewList', {'dateref': '2010-10-01', 'enddate_delay': -90, 'reminder': False})
+        self.assert_no_full_scan(AdherentRenewList(), '/diacamma.member/adherentRenewList', {'dateref': '2009-10-01', 'enddate_delay': 0, 'reminder': True})
+
+    def test_statistic(self):
+        self.assert_no_full_scan(AdherentStatistic(), '/diacamma.member/adherentStatistic', {'season': 10})
+
+    def test_summary(self):
+        self.assert_no_full_scan(StatusMenu(), '/CORE/statusMenu', {})
+        self.assert_json_equal('LABELFORM', 'membernb', "Adhérents actifs : 0")
+        self.assert_json_equal('LABELFORM', 'familynb', "Foyers actifs : 5")
+        self.assert_json_equal('LABELFORM', 'memberadhcreat', "Adhérents non-validés : 5")
+
+    def test_foreign_key_indexes(self):
+        with connection.cursor() as cursor:
+            for table, column in (('member_subscription', 'season_id'), ('member_subscription', 'adherent_id'), ('member_docadherent', 'subscription_id'),
+                                  ('member_license', 'subscription_id'), ('member_membershipsnapshot', 'adherent_id'), ('member_membershipsnapshot', 'season_id'),
+                                  ('event_degree', 'adherent_id')):
+                indexes = [constraint['columns'] for constraint in connection.introspection.get_constraints(cursor, table).values() if constraint['index']]
+                self.assertNotIn([column], indexes, table)
+                self.assertIn(column, [index_columns[0] for index_columns in indexes], table)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+'''
+Shared database helpers for member treatments
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2026 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+
+from django.db import connection
+from django.db.models.signals import post_save
+
+
+def bulk_create_with_signals(model, items):
+    if not connection.features.can_return_rows_from_bulk_insert:
+        for item in items:
+            item.save()
+        return items
+    model.objects.bulk_create(items)
+    for item in items:
+        post_save.send(sender=model, instance=item, created=True, update_fields=None, raw=False, using=None)
+    return items
@@ -27,7 +27,7 @@ from importlib import import_module
 from datetime import timedelta
 
 from django.conf import settings
-from django.db.models import Q, Value
+from django.db.models import Q, Value, OuterRef, Subquery, Count
 from django.db.models.functions import Concat, Trim
 from django.utils import formats
 from django.utils.translation import gettext_lazy as _
@@ -50,7 +50,7 @@ from lucterios.framework.xfercomponents import XferCompLabelForm, \
     XferCompCheckList, XferCompButton, XferCompSelect, XferCompDate, \
     XferCompImage, XferCompEdit, XferCompGrid, XferCompFloat, XferCompCheck, \
     GRID_ORDER, GRID_SIZE
-from lucterios.framework.xfergraphic import XferContainerAcknowledge, XferContainerCustom
+from lucterios.framework.xfergraphic import XferContainerAcknowledge, XferContainerCustom, XFER_DBOX_WARNING
 from lucterios.framework.xfersearch import get_search_query_from_criteria
 from lucterios.CORE.editors import XferSavedCriteriaSearchEditor
 from lucterios.CORE.models import Preference
@@ -58,7 +58,6 @@ from lucterios.CORE.parameters import Params, notfree_mode_connect
 from lucterios.CORE.views import ObjectMerge
 from lucterios.CORE.xferprint import XferPrintAction
 from lucterios.CORE.xferprint import XferPrintLabel
-from lucterios.CORE.xferprint import XferPrintListing
 from lucterios.contacts.models import Individual, LegalEntity, Responsability, AbstractContact
 from lucterios.contacts.views_contacts import LegalEntityAddModify, AbstractContactFindDouble
 from lucterios.mailing.email_functions import will_mail_send
@@ -69,7 +68,10 @@ from diacamma.invoice.views import BillPayableEmail, BillPrint
 from diacamma.invoice.views_summary import CurrentPayableShow
 from diacamma.payoff.models import PaymentMethod
 from diacamma.member.editors import SubscriptionEditor
-from diacamma.member.models import Adherent, Subscription, Season, Age, Team, Activity, License, DocAdherent, SubscriptionType, CommandManager, Prestation, TeamPrestation, ContactAdherent
+from diacamma.member.models import Adherent, Subscription, Season, Age, Team, Activity, License, DocAdherent, SubscriptionType, CommandManager, Prestation, TeamPrestation, ContactAdherent, \
+    MembershipSnapshot, AdherentQuerySet, MemberJob, MemberEmail
+from diacamma.member.streaming import StreamingPrintListing, StreamingPrintAction, StreamingListMixin
+from diacamma.member.views_job import MemberJobShow
 
 MenuManage.add_sub("association", None, short_icon='mdi:mdi-human-male-female-child', caption=_("Association"), desc=_("Association tools"), pos=30)
 
@@ -85,30 +87,28 @@ class AdherentFilter(object):
         age = self.getparam("age", Preference.get_value('adherent-age', self.request.user))
         status = self.getparam("status", Preference.get_value('adherent-status', self.request.user))
         dateref = convert_date(self.getparam("dateref", ""), Season.current_season().date_ref)
-        current_filter = Q(subscription__begin_date__lte=dateref) & Q(subscription__end_date__gte=dateref)
-        if Params.getvalue("member-team-enable") != 0:
-            if len(team) > 0:
-                current_filter &= Q(subscription__license__team__in=team) | Q(subscription__prestations__team__in=team)
-        if Params.getvalue("member-activite-enable"):
-            if len(activity) > 0:
-                current_filter &= Q(subscription__license__activity__in=activity) | Q(subscription__prestations__activity__in=activity)
+        subscription_filter = Q(begin_date__lte=dateref) & Q(end_date__gte=dateref)
+        if status == Subscription.STATUS_WAITING_BUILDING:
+            subscription_filter &= Q(status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID))
+        else:
+            subscription_filter &= Q(status=status)
+        teams = team if (Params.getvalue("member-team-enable") != 0) and (len(team) > 0) else None
+        activities = activity if Params.getvalue("member-activite-enable") and (len(activity) > 0) else None
+        if (teams is not None) or (activities is not None):
+            subscription_filter &= MembershipSnapshot.get_involvement_query(teams, activities)
+        current_filter = MembershipSnapshot.get_adherent_exists(subscription_filter)
         if Params.getvalue("member-age-enable"):
             if len(age) > 0:
-                age_filter = Q()
-                for age_item in Age.objects.filter(id__in=age):
-                    age_filter |= Q(birthday__gte="%d-01-01" % (dateref.year - age_item.maximum)) & Q(birthday__lte="%d-12-31" % (dateref.year - age_item.minimum))
-                current_filter &= age_filter
+                current_filter &= Q(id__in=Adherent.objects.with_age_category(dateref).filter(age_category_id__in=age).values('id'))
         if Params.getvalue("member-filter-genre"):
             if genre != Adherent.GENRE_ALL:
                 current_filter &= Q(genre=genre)
-        if status == Subscription.STATUS_WAITING_BUILDING:
-            current_filter &= Q(subscription__status__in=(Subscription.STATUS_BUILDING, Subscription.STATUS_VALID))
-        else:
-            current_filter &= Q(subscription__status=status)
         return current_filter
 
     def filter_callback(self, items):
         if self.getparam("reminder") is None:
+            if isinstance(items, AdherentQuerySet):
+                items = items.with_virtual_fields(None, convert_date(self.getparam("dateref")))
             return items
         else:
             dateref = convert_date(self.getparam("dateref", ""), Season.current_season().date_ref)
@@ -117,21 +117,26 @@ class AdherentFilter(object):
             savecritera_renew = Params.getobject("member-renew-filter")
             sub_end_date = dateref + timedelta(days=enddate_delay)
             if reminder:
-                self.current_filter = Q(subscription__begin_date__lte=sub_end_date) & Q(subscription__end_date__gte=sub_end_date) & Q(subscription__status__in=(Subscription.STATUS_WAITING, Subscription.STATUS_BUILDING))
-                self.exclude_filter = Q()
+                subscription_filter = Q(begin_date__lte=sub_end_date) & Q(end_date__gte=sub_end_date) & Q(status__in=(Subscription.STATUS_WAITING, Subscription.STATUS_BUILDING))
+                exclude_filter = None
             elif enddate_delay < 0:
-                self.current_filter = Q(subscription__end_date__gte=sub_end_date) & Q(subscription__end_date__lte=dateref)
-                self.exclude_filter = Q(subscription__begin_date__gt=sub_end_date)
+                subscription_filter = Q(end_date__gte=sub_end_date) & Q(end_date__lte=dateref)
+                exclude_filter = Q(begin_date__gt=sub_end_date)
             elif enddate_delay > 0:
-                self.current_filter = Q(subscription__end_date__lte=sub_end_date) & Q(subscription__end_date__gt=dateref)
-                self.exclude_filter = Q(subscription__begin_date__gte=dateref)
+                subscription_filter = Q(end_date__lte=sub_end_date) & Q(end_date__gt=dateref)
+                exclude_filter = Q(begin_date__gte=dateref)
             else:
-                self.current_filter = Q(subscription__end_date=dateref)
-                self.exclude_filter = Q(subscription__begin_date__gt=dateref)
+                subscription_filter = Q(end_date=dateref)
+                exclude_filter = Q(begin_date__gt=dateref)
+            self.current_filter = MembershipSnapshot.get_adherent_exists(subscription_filter)
+            self.exclude_filter = MembershipSnapshot.get_adherent_exists(exclude_filter) if exclude_filter is not None else Q()
+            items = self.model.objects.filter(self.current_filter).exclude(self.exclude_filter)
             if savecritera_renew is not None:
                 filter_result, _desc = get_search_query_from_criteria(savecritera_renew.criteria, Adherent)
-                self.current_filter &= filter_result
-            return self.model.objects.filter(self.current_filter).exclude(self.exclude_filter).distinct()
+                items = items.filter(filter_result).distinct()
+            renew_end_date = MembershipSnapshot.objects.filter(Q(adherent_id=OuterRef('pk')) & subscription_filter).order_by('-end_date').values('end_date')[:1]
+            items = items.annotate(renew_end_date=Subquery(renew_end_date))
+            return items.with_virtual_fields(getattr(self, 'fieldnames', None), convert_date(self.getparam("dateref")))
 
 
 class AdherentAbstractList(XferListEditor, AdherentFilter):
@@ -144,7 +149,8 @@ class AdherentAbstractList(XferListEditor, AdherentFilter):
         self.size_by_page = Params.getvalue("member-size-page")
 
     def get_items_from_filter(self):
-        return self.model.objects.filter(self.get_filter()).distinct()
+        fieldnames = self.fieldnames if self.fieldnames is not None else self.model.get_default_fields()
+        return self.model.objects.filter(self.get_filter()).with_virtual_fields(fieldnames, convert_date(self.getparam("dateref")))
 
     def fillresponse_body(self):
         lineorder = self.getparam(GRID_ORDER + 'adherent', ())
@@ -303,7 +309,7 @@ def show_thirdlist(request):
 
 
 @MenuManage.describ(show_thirdlist, FORMTYPE_NOMODAL, 'member.actions', _('List of  families of members up to date with their subscription'))
-class AdherentContactList(XferListEditor):
+class AdherentContactList(StreamingListMixin, XferListEditor):
     short_icon = 'mdi:mdi-badge-account-horizontal-outline'
     model = ContactAdherent
     field_id = 'abstractcontact'
@@ -316,7 +322,7 @@ class AdherentContactList(XferListEditor):
 
     def get_items_from_filter(self):
         items = self.model.objects.annotate(completename=Trim(Concat('legalentity__name', Value(' '), 'individual__lastname', Value(' '), 'individual__firstname')))
-        return items.filter(self.filter).order_by('completename').distinct()
+        return items.filter(self.filter).select_related('individual', 'legalentity').order_by('completename').distinct()
 
     def fillresponse_header(self):
         family_type = Params.getobject("member-family-type")
@@ -763,9 +769,9 @@ class AdherentRenewList(XferListEditor, AdherentFilter):
     def fillresponse_body(self):
         lineorder = self.getparam(GRID_ORDER + 'adherent', ())
         if len(lineorder) > 0:
-            self.params[GRID_ORDER + 'adherent'] = ','.join([item.replace('last_subscription', 'subscription__end_date') for item in lineorder])
+            self.params[GRID_ORDER + 'adherent'] = ','.join([item.replace('last_subscription', 'renew_end_date') for item in lineorder])
         else:
-            self.params[GRID_ORDER + 'adherent'] = 'subscription__end_date'
+            self.params[GRID_ORDER + 'adherent'] = 'renew_end_date'
         XferListEditor.fillresponse_body(self)
         grid = self.get_components('adherent')
         family_header = grid.get_header('last_subscription')
@@ -870,7 +876,7 @@ class AdherentAddModify(XferAddEditor):
 
 @ActionsManage.affect_list(TITLE_PRINT, short_icon='mdi:mdi-printer-outline', condition=lambda xfer: Params.getobject("member-family-type") is not None)
 @MenuManage.describ('contacts.change_abstractcontact')
-class AdherentContactPrint(XferPrintAction):
+class AdherentContactPrint(StreamingPrintAction):
     short_icon = 'mdi:mdi-badge-account-horizontal-outline'
     model = ContactAdherent
     field_id = 'abstractcontact'
@@ -1019,13 +1025,21 @@ class AdherentRenew(XferContainerAcknowledge):
         text = _("{[b]}Do you want that those %d old selected adherent(s) has been renew?{[/b]}{[br/]}Same subscription(s) will be applicated (or the first subscription type valid if old is unvalid).{[br/]}Validated quotation will be created for each subscritpion.") % len(self.items)
         if self.confirme(text):
             dateref = convert_date(self.getparam("dateref", ""), Season.current_season().date_ref)
-            adh_success = []
-            for item in self.items:
-                if item.renew(dateref):
-                    adh_success.append(str(item.id))
+            job = MemberJob.submit('renew', {'adherents': [item.id for item in self.items], 'dateref': dateref.isoformat()}, self.request.user)
+            if not job.launch():
+                self.redirect_action(MemberJobShow.get_action(), close=CLOSE_NO, params={'memberjob': job.id})
+                return
+            state = job.get_state()
+            adh_success = sorted(state['adherents'])
+            if (len(adh_success) == 0) and (len(state['errors']) > 0):
+                raise LucteriosException(IMPORTANT, "{[br/]}".join(state['errors']))
             if len(adh_success) > 0:
-                adh_success.sort()
-                self.redirect_action(AdherentSendSubscription.get_action(), close=CLOSE_NO, params={'adherent': ";".join(adh_success)})
+                adh_success = [str(adherent_id) for adherent_id in adh_success]
+                if len(state['errors']) > 0:
+                    self.message(job.get_result(), XFER_DBOX_WARNING)
+                    self.set_close_action(AdherentSendSubscription.get_action(), close=CLOSE_NO, params={'adherent': ";".join(adh_success)})
+                else:
+                    self.redirect_action(AdherentSendSubscription.get_action(), close=CLOSE_NO, params={'adherent': ";".join(adh_success)})
 
 
 @ActionsManage.affect_grid(_("command"), short_icon='mdi:mdi-pencil-plus-outline', unique=SELECT_MULTI, condition=lambda xfer, gridname='': not xfer.getparam('reminder', True))
@@ -1079,12 +1093,14 @@ class AdherentCommand(XferContainerAcknowledge):
                 param_email = get_url_from_request(self.request), self.language
             else:
                 param_email = None
-            nb_sub, nb_bill = cmd_manager.create_subscription(dateref, param_email)
-            if send_email:
-                msg = _('%(nbsub)d new subscription and %(nbbill)d quotation have been sent.') % {'nbsub': nb_sub, 'nbbill': nb_bill}
-            else:
-                msg = _('%d new subscription have been prepared.') % nb_sub
-            self.message(msg)
+            job = MemberJob.submit('command', {'commands': cmd_manager.commands, 'dateref': dateref.isoformat(), 'sendemail': param_email}, self.request.user)
+            if not job.launch():
+                self.redirect_action(MemberJobShow.get_action(), close=CLOSE_NO, params={'memberjob': job.id})
+                return
+            state = job.get_state()
+            if (state['nb_sub'] == 0) and (len(state['errors']) > 0):
+                raise LucteriosException(IMPORTANT, "{[br/]}".join(state['errors']))
+            self.message(job.get_result())
 
 
 @MenuManage.describ('member.add_subscription')
@@ -1230,7 +1246,7 @@ class AdherentLabel(XferPrintLabel, AdherentFilter):
 
 @ActionsManage.affect_list(TITLE_LISTING, short_icon='mdi:mdi-printer-pos-edit-outline')
 @MenuManage.describ('contacts.change_abstractcontact')
-class AdherentListing(XferPrintListing, AdherentFilter):
+class AdherentListing(StreamingPrintListing, AdherentFilter):
     short_icon = 'mdi:mdi-badge-account-horizontal-outline'
     model = Adherent
     field_id = 'adherent'
@@ -1240,7 +1256,7 @@ class AdherentListing(XferPrintListing, AdherentFilter):
         if self.getparam('CRITERIA') is None:
             return AdherentFilter.get_filter(self)
         else:
-            return XferPrintListing.get_filter(self)
+            return StreamingPrintListing.get_filter(self)
 
     def filter_callback(self, items):
         return AdherentFilter.filter_callback(self, items)
@@ -1264,15 +1280,47 @@ class AdherentConnection(XferContainerAcknowledge):
     def fillresponse(self):
         if self.confirme(_("Do you want to check the access right for all adherents ?")):
             if self.traitment("mdi:mdi-information-outline", _("Please, waiting..."), ""):
-                nb_del, nb_add, nb_update, error_sending = Season.current_season().check_connection()
-                ending_msg = _("{[center]}{[b]}Result{[/b]}{[/center]}{[br/]}%(nb_del)s removed connection(s).{[br/]}%(nb_add)s added connection(s).{[br/]}%(nb_update)s updated connection(s).") % {'nb_del': nb_del, 'nb_add': nb_add, 'nb_update': nb_update}
-                if len(error_sending) > 0:
-                    ending_msg += _("{[br/]}{[br/]}%d email(s) failed:") % len(error_sending)
-                    ending_msg += "{[ul]}"
-                    for error_item in error_sending:
-                        ending_msg += "{[li]}%s : %s{[/li]}" % error_item
-                    ending_msg += "{[/ul]}"
-                self.traitment_data[2] = ending_msg
+                job = MemberJob.submit('check_connection', {'season': Season.current_season().id}, self.request.user)
+                if job.launch():
+                    self.traitment_data[2] = job.get_result()
+                else:
+                    self.traitment_data = None
+                    self.redirect_action(MemberJobShow.get_action(), close=CLOSE_YES, params={'memberjob': job.id})
+
+
+@MenuManage.describ('member.change_adherent', FORMTYPE_NOMODAL, 'member.actions', _('Emails of subscriptions waiting to be sent'))
+class MemberEmailList(XferListEditor):
+    short_icon = 'mdi:mdi-email-fast-outline'
+    model = MemberEmail
+    field_id = 'memberemail'
+    caption = _("Emails outbox")
+
+    def fillresponse_header(self):
+        status_filter = self.getparam('status_filter', -1)
+        sel = XferCompSelect('status_filter')
+        sel.set_select([(-1, '---')] + list(MemberEmail.LIST_STATUS))
+        sel.set_value(status_filter)
+        sel.set_location(1, 1)
+        sel.set_action(self.request, self.return_action(), close=CLOSE_NO, modal=FORMTYPE_REFRESH)
+        sel.description = _('status')
+        self.add_component(sel)
+        self.filter = Q(status=status_filter) if status_filter != -1 else Q()
+        MemberEmail.check_pending()
+
+
+@ActionsManage.affect_grid(_("Retry"), short_icon='mdi:mdi-email-sync-outline', unique=SELECT_MULTI)
+@MenuManage.describ('member.change_adherent')
+class MemberEmailRetry(XferContainerAcknowledge):
+    short_icon = 'mdi:mdi-email-fast-outline'
+    model = MemberEmail
+    field_id = 'memberemail'
+    caption = _("Retry email")
+
+    def fillresponse(self):
+        for item in self.items:
+            if item.status != MemberEmail.STATUS_SENT:
+                item.retry()
+        MemberEmail.launch()
 
 
 class BaseAdherentFamilyList(XferContainerCustom):
@@ -1813,7 +1861,8 @@ def summary_member(xfer):
                 lab.set_value_as_headername(str(current_season))
                 lab.set_location(0, row + 1, 4)
                 xfer.add_component(lab)
-                nb_adh = Adherent.objects.filter(Q(subscription__begin_date__lte=dateref) & Q(subscription__end_date__gte=dateref) & Q(subscription__status=Subscription.STATUS_VALID)).distinct().count()
+                nb_by_status = dict(MembershipSnapshot.objects.filter(Q(begin_date__lte=dateref) & Q(end_date__gte=dateref)).order_by().values('status').annotate(nb=Count('adherent_id', distinct=True)).values_list('status', 'nb'))
+                nb_adh = nb_by_status.get(Subscription.STATUS_VALID, 0)
                 lab = XferCompLabelForm('membernb')
                 lab.set_value_as_header(_("Active adherents: %d") % nb_adh)
                 lab.set_location(0, row + 2, 4)
@@ -1827,13 +1876,13 @@ def summary_member(xfer):
                     lab.set_value_as_header(_("Active families: %d") % nb_family)
                     lab.set_location(0, row + 3, 4)
                     xfer.add_component(lab)
-                nb_adhcreat = Adherent.objects.filter(Q(subscription__begin_date__lte=dateref) & Q(subscription__end_date__gte=dateref) & Q(subscription__status=Subscription.STATUS_BUILDING)).distinct().count()
+                nb_adhcreat = nb_by_status.get(Subscription.STATUS_BUILDING, 0)
                 if nb_adhcreat > 0:
                     lab = XferCompLabelForm('memberadhcreat')
                     lab.set_value_as_header(_("No validated adherents: %d") % nb_adhcreat)
                     lab.set_location(0, row + 4, 4)
                     xfer.add_component(lab)
-                nb_adhwait = Adherent.objects.filter(Q(subscription__begin_date__lte=dateref) & Q(subscription__end_date__gte=dateref) & Q(subscription__status=Subscription.STATUS_WAITING)).distinct().count()
+                nb_adhwait = nb_by_status.get(Subscription.STATUS_WAITING, 0)
                 if nb_adhwait > 0:
                     lab = XferCompLabelForm('memberadhwait')
                     lab.set_value_as_header(_("Adherents waiting moderation: %d") % nb_adhwait)
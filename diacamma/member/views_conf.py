@@ -41,7 +41,8 @@ from lucterios.CORE.parameters import Params
 from lucterios.CORE.views import ParamEdit, ObjectMerge
 
 from diacamma.member.models import Activity, Age, Team, Season, SubscriptionType, Adherent, TaxReceipt, \
-    Subscription
+    Subscription, MemberJob
+from diacamma.member.views_job import MemberJobShow
 from diacamma.payoff.views import SupportingPrint, can_send_email
 
 
@@ -311,7 +312,9 @@ class TaxReceiptValid(XferContainerAcknowledge):
 
     def fillresponse(self, year=0):
         if self.confirme(_('Do you want to validate tax receiptes for year "%s" ?{[br/]}{[u]}Warning:{[/u]} Tax receipts are not removable.') % year):
-            TaxReceipt.valid_all(year)
+            job = MemberJob.submit('taxreceipt_valid', {'year': year, 'user': self.request.user.id}, self.request.user)
+            if not job.launch():
+                self.redirect_action(MemberJobShow.get_action(), close=CLOSE_NO, params={'memberjob': job.id})
 
 
 @ActionsManage.affect_list(_('Check'), short_icon="mdi:mdi-refresh")
@@ -324,7 +327,9 @@ class TaxReceiptCheck(XferContainerAcknowledge):
 
     def fillresponse(self, year=0):
         if self.confirme(_('Do you want to generate tax receiptes for year "%s" ?') % year):
-            TaxReceipt.create_all(year)
+            job = MemberJob.submit('taxreceipt_check', {'year': year}, self.request.user)
+            if not job.launch():
+                self.redirect_action(MemberJobShow.get_action(), close=CLOSE_NO, params={'memberjob': job.id})
 
 
 @ActionsManage.affect_show(_('Check'), short_icon="mdi:mdi-refresh", condition=lambda xfer: xfer.item.num is None)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+'''
+Background treatment view of member jobs
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2026 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import unicode_literals
+
+from django.utils.translation import gettext_lazy as _
+
+from lucterios.framework.tools import MenuManage, FORMTYPE_REFRESH, CLOSE_NO, CLOSE_YES, WrapAction
+from lucterios.framework.error import LucteriosException, IMPORTANT
+from lucterios.framework.model_fields import get_value_if_choices
+from lucterios.framework.xferadvance import TITLE_CLOSE
+from lucterios.framework.xfercomponents import XferCompLabelForm, XferCompImage
+from lucterios.framework.xfergraphic import XferContainerCustom
+from lucterios.CORE.parameters import notfree_mode_connect
+
+from diacamma.member.models import MemberJob
+
+
+def right_memberjob(request):
+    return not notfree_mode_connect() or request.user.is_authenticated
+
+
+@MenuManage.describ(right_memberjob)
+class MemberJobShow(XferContainerCustom):
+    short_icon = 'mdi:mdi-progress-clock'
+    model = MemberJob
+    field_id = 'memberjob'
+    caption = _("Background treatment")
+
+    def fillresponse(self):
+        if notfree_mode_connect() and (self.item.user_id != self.request.user.id) and not self.request.user.has_perm('member.change_adherent'):
+            raise LucteriosException(IMPORTANT, _("Background treatment of another user!"))
+        if not self.item.is_ended:
+            MemberJob.check_pending()
+        img = XferCompImage('img')
+        img.set_value(self.short_icon, '#')
+        img.set_location(0, 0, 1, 3)
+        self.add_component(img)
+        lbl = XferCompLabelForm('status')
+        lbl.set_value(get_value_if_choices(self.item.status, self.item._meta.get_field('status')))
+        lbl.set_location(1, 0)
+        lbl.description = _('status')
+        self.add_component(lbl)
+        lbl = XferCompLabelForm('progress')
+        lbl.set_value("%d %% (%d / %d)" % (self.item.progress, self.item.done, self.item.total))
+        lbl.set_location(1, 1)
+        lbl.description = _('progress')
+        self.add_component(lbl)
+        lbl = XferCompLabelForm('result')
+        lbl.set_location(1, 2)
+        if self.item.status == MemberJob.STATUS_FINISHED:
+            lbl.set_value(self.item.get_result())
+        elif self.item.status == MemberJob.STATUS_FAILURE:
+            lbl.set_value("{[br/]}".join(self.item.get_state()['errors']))
+        self.add_component(lbl)
+        if not self.item.is_ended:
+            self.add_action(self.return_action(_('Refresh'), short_icon='mdi:mdi-refresh'), modal=FORMTYPE_REFRESH, close=CLOSE_NO)
+        elif (self.item.kind == 'renew') and (len(self.item.get_state()['adherents']) > 0):
+            self.add_action(WrapAction(_("Send"), short_icon="mdi:mdi-email-outline", url_text='diacamma.member/adherentSendSubscription', is_view_right='member.add_subscription'), close=CLOSE_YES,
+                            params={'adherent': ";".join([str(adherent_id) for adherent_id in sorted(self.item.get_state()['adherents'])])})
+        self.add_action(WrapAction(TITLE_CLOSE, short_icon='mdi:mdi-close'))
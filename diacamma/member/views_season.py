@@ -37,8 +37,9 @@ from lucterios.framework.xfercomponents import XferCompSelect, XferCompButton
 from lucterios.framework.error import LucteriosException, IMPORTANT
 from lucterios.CORE.parameters import Params
 
-from diacamma.member.models import Season, Period, SubscriptionType, Document
+from diacamma.member.models import Season, Period, SubscriptionType, Document, MemberJob
 from diacamma.member.views_conf import CategoryParamEdit
+from diacamma.member.views_job import MemberJobShow
 
 MenuManage.add_sub("member.conf", "core.extensions", short_icon='mdi:mdi-human-queue', caption=_("Member"), pos=5)
 
@@ -82,6 +83,10 @@ class SeasonSubscription(XferListEditor):
         btn.set_location(0, row_max + 5)
         btn.set_action(self.request, SubscriptionReloadBill.get_action(_('Regenerate'), short_icon='mdi:mdi-invoice-edit-outline'), modal=FORMTYPE_MODAL, close=CLOSE_NO)
         self.add_component(btn)
+        btn = XferCompButton('checkBill')
+        btn.set_location(1, row_max + 5)
+        btn.set_action(self.request, SubscriptionReloadBill.get_action(_('Simulate'), short_icon='mdi:mdi-invoice-text-outline'), modal=FORMTYPE_MODAL, close=CLOSE_NO, params={'dryrun': True})
+        self.add_component(btn)
         if SubscriptionType.objects.filter(duration=SubscriptionType.DURATION_CALENDAR).count() > 0:
             param_lists = ['member-subscription-delaytorenew']
             Params.fill(self, param_lists, 1, self.get_max_row() + 1, nb_col=1)
@@ -223,19 +228,23 @@ class SubscriptionReloadBill(XferContainerAcknowledge):
     short_icon = 'mdi:mdi-invoice-edit-outline'
     caption = _("Quotation regeneration")
 
-    def run_regenerate(self):
-        from diacamma.member.models import Subscription
-        nb_subscriptions = 0
-        for sub in Subscription.objects.filter(season=self.season, status=Subscription.STATUS_BUILDING):
-            sub.change_bill()
-            nb_subscriptions += 1
-        return nb_subscriptions
+    def run_regenerate(self, dryrun):
+        job = MemberJob.submit('regenerate_bill', {'season': self.season.id, 'dryrun': dryrun}, self.request.user)
+        if job.launch():
+            self.traitment_data[2] = job.get_result()
+        else:
+            self.traitment_data = None
+            self.redirect_action(MemberJobShow.get_action(), close=CLOSE_YES, params={'memberjob': job.id})
 
-    def fillresponse(self, nb_quotations=None):
+    def fillresponse(self, nb_quotations=None, dryrun=False):
         from diacamma.accounting.models import FiscalYear
         self.season = Season.current_season()
         if FiscalYear.get_current() != FiscalYear.get_current(self.season.date_ref):
             raise LucteriosException(IMPORTANT, _('Active fiscal year different of current season !'))
-        if self.confirme(_('Do you want regenerate quotations of building subscriptions ?')):
+        if dryrun:
+            confirm_text = _('Do you want to check changes that a regeneration of quotations would do ?')
+        else:
+            confirm_text = _('Do you want regenerate quotations of building subscriptions ?')
+        if self.confirme(confirm_text):
             if self.traitment(self.icon, _('Please, waiting a minutes ...'), ''):
-                self.traitment_data[2] = _('%s subscriptions were regenerated.') % self.run_regenerate()
+                self.run_regenerate(dryrun)
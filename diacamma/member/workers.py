@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+'''
+Worker process functions for member treatments
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2026 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+
+
+def setup_worker():
+    import django
+    django.setup()
+
+
+def render_taxreceipt(taxreceipt_id):
+    from diacamma.member.models import TaxReceipt
+    taxreceipt = TaxReceipt.objects.filter(id=taxreceipt_id, num__isnull=False).first()
+    if taxreceipt is None:
+        return None
+    return taxreceipt.get_pdfreport_content()